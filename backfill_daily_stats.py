@@ -0,0 +1,83 @@
+# =========================================================
+# 📊 BACKFILL DO ROLLUP DIÁRIO (daily_stats)
+# =========================================================
+# Reconstrói daily_stats a partir das tabelas pedidos e leads.
+# Rode uma vez depois de criar a tabela (e sempre que quiser recalcular):
+#   python backfill_daily_stats.py
+#   python backfill_daily_stats.py --bot-id 12
+#
+# Tudo roda numa transação só: apaga o rollup (do bot ou de todos) e grava
+# de novo, agrupando por bot / dia / link de rastreamento.
+
+import argparse
+import logging
+from datetime import date
+from sqlalchemy import func
+
+from database import SessionLocal, DailyStat, Pedido, Lead
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Mesma lista de STATUS_RECEITA do main.py (pagos + expirados contam como faturamento)
+STATUS_RECEITA = ("approved", "paid", "active", "completed", "succeeded", "expired")
+
+def _como_data(valor):
+    # func.date() devolve date no Postgres e 'YYYY-MM-DD' no SQLite
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor
+
+def executar_backfill(bot_id=None):
+    db = SessionLocal()
+    try:
+        linhas = {}  # (bot_id, dia, tracking_id) -> {"revenue", "sales", "leads"}
+
+        def linha(chave):
+            return linhas.setdefault(chave, {"revenue": 0.0, "sales": 0, "leads": 0})
+
+        dia_pedido = func.date(Pedido.created_at)
+        vendas = db.query(
+            Pedido.bot_id, dia_pedido, func.coalesce(Pedido.tracking_id, 0),
+            func.sum(Pedido.valor), func.count(Pedido.id)
+        ).filter(
+            func.lower(Pedido.status).in_(STATUS_RECEITA),
+            Pedido.created_at.isnot(None)
+        )
+        if bot_id: vendas = vendas.filter(Pedido.bot_id == bot_id)
+        for b_id, dia, track, receita, qtd in vendas.group_by(Pedido.bot_id, dia_pedido, func.coalesce(Pedido.tracking_id, 0)).all():
+            item = linha((b_id, _como_data(dia), track))
+            item["revenue"] += float(receita or 0.0)
+            item["sales"] += int(qtd or 0)
+
+        dia_lead = func.date(Lead.created_at)
+        leads = db.query(
+            Lead.bot_id, dia_lead, func.coalesce(Lead.tracking_id, 0), func.count(Lead.id)
+        ).filter(Lead.created_at.isnot(None), Lead.bot_id.isnot(None))
+        if bot_id: leads = leads.filter(Lead.bot_id == bot_id)
+        for b_id, dia, track, qtd in leads.group_by(Lead.bot_id, dia_lead, func.coalesce(Lead.tracking_id, 0)).all():
+            linha((b_id, _como_data(dia), track))["leads"] += int(qtd or 0)
+
+        apagar = db.query(DailyStat)
+        if bot_id: apagar = apagar.filter(DailyStat.bot_id == bot_id)
+        removidas = apagar.delete(synchronize_session=False)
+
+        db.bulk_insert_mappings(DailyStat, [
+            {"bot_id": b_id, "day": dia, "tracking_id": track, **valores}
+            for (b_id, dia, track), valores in linhas.items()
+        ])
+        db.commit()
+        logger.info(f"✅ daily_stats reconstruído: {removidas} linhas antigas removidas, {len(linhas)} gravadas.")
+        return True
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Erro no backfill de daily_stats: {e}")
+        return False
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstrói a tabela daily_stats a partir de pedidos e leads")
+    parser.add_argument("--bot-id", type=int, default=None, help="Recalcula só este bot")
+    args = parser.parse_args()
+    executar_backfill(args.bot_id)
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import create_engine, text, Column, Integer, String, Float, DateTime, Date, Boolean, Text, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.pool import QueuePool
@@ -82,6 +82,12 @@ class Bot(Base):
     miniapp_config = relationship("MiniAppConfig", uselist=False, back_populates="bot", cascade="all, delete-orphan")
     miniapp_categories = relationship("MiniAppCategory", back_populates="bot", cascade="all, delete-orphan")
 
+    # Passos de fluxo agendados (delay entre mensagens)
+    tarefas_agendadas = relationship("TarefaAgendada", backref="bot_ref", cascade="all, delete-orphan")
+
+    # file_id do Telegram para cada URL de mídia já enviada por este bot
+    midias_cache = relationship("MidiaCache", backref="bot_ref", cascade="all, delete-orphan")
+
 class BotAdmin(Base):
     __tablename__ = "bot_admins"
     id = Column(Integer, primary_key=True, index=True)
@@ -159,6 +165,29 @@ class RemarketingCampaign(Base):
     blocked_count = Column(Integer, default=0)
     data_envio = Column(DateTime, default=datetime.utcnow)
 
+    # Destinatários do disparo (checkpoint por pessoa)
+    envios = relationship("RemarketingEnvio", backref="campanha", cascade="all, delete-orphan")
+
+# =========================================================
+# 📬 ENVIOS DE REMARKETING (UM REGISTRO POR DESTINATÁRIO)
+# =========================================================
+class RemarketingEnvio(Base):
+    __tablename__ = "remarketing_envios"
+    __table_args__ = (
+        UniqueConstraint("campaign_id", "telegram_id", name="uq_remarketing_envio_destinatario"),
+        Index("ix_remarketing_envios_campanha_status", "campaign_id", "status"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    campaign_id = Column(Integer, ForeignKey("remarketing_campaigns.id"))
+    telegram_id = Column(String)
+
+    status = Column(String(20), default="pendente")  # 'pendente', 'processando', 'enviado', 'bloqueado', 'erro'
+    lote = Column(String, nullable=True)              # Quem reservou (worker/lote)
+    reservado_em = Column(DateTime, nullable=True)
+    enviado_em = Column(DateTime, nullable=True)
+    erro = Column(String, nullable=True)
+
 # =========================================================
 # 💬 FLUXO (ESTRUTURA HÍBRIDA V1 + V2 + MINI APP)
 # =========================================================
@@ -210,6 +239,56 @@ class BotFlowStep(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     bot = relationship("Bot", back_populates="steps")
 
+# =========================================================
+# ⏰ TAREFAS AGENDADAS DO FLUXO (DELAY + AUTO-DESTRUIR)
+# =========================================================
+class TarefaAgendada(Base):
+    __tablename__ = "tarefas_agendadas"
+    id = Column(Integer, primary_key=True, index=True)
+    bot_id = Column(Integer, ForeignKey("bots.id"))
+    chat_id = Column(String)
+
+    tipo = Column(String(20))                    # 'passo' ou 'oferta'
+    step_order = Column(Integer, nullable=True)  # Passo a enviar (tipo 'passo')
+    apagar_message_id = Column(Integer, nullable=True)  # Mensagem a auto-destruir antes de enviar
+
+    executar_em = Column(DateTime, index=True)
+    status = Column(String(20), default="pendente")  # 'pendente', 'processando', 'erro'
+    tentativas = Column(Integer, default=0)
+    reservado_em = Column(DateTime, nullable=True)   # Quando o worker pegou (claim)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# =========================================================
+# 🖼️ CACHE DE MÍDIA (URL -> file_id DO TELEGRAM)
+# =========================================================
+class MidiaCache(Base):
+    __tablename__ = "media_cache"
+    __table_args__ = (UniqueConstraint("bot_id", "media_url", name="uq_media_cache_bot_url"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    bot_id = Column(Integer, ForeignKey("bots.id"), index=True)  # file_id só vale para o bot que subiu
+    media_url = Column(String)
+    file_id = Column(String)
+    tipo = Column(String(10))  # 'foto' ou 'video'
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# =========================================================
+# 📊 ROLLUP DIÁRIO (FATURAMENTO / VENDAS / LEADS POR DIA)
+# =========================================================
+class DailyStat(Base):
+    __tablename__ = "daily_stats"
+    __table_args__ = (UniqueConstraint("bot_id", "day", "tracking_id", name="uq_daily_stats_bot_dia_tracking"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    bot_id = Column(Integer, ForeignKey("bots.id"), nullable=False)
+    day = Column(Date, nullable=False, index=True)
+    tracking_id = Column(Integer, nullable=False, default=0)  # 0 = sem link de rastreamento
+
+    revenue = Column(Float, nullable=False, default=0.0)
+    sales = Column(Integer, nullable=False, default=0)
+    leads = Column(Integer, nullable=False, default=0)
+
 # =========================================================
 # 🔗 TRACKING (RASTREAMENTO DE LINKS)
 # =========================================================
@@ -248,6 +327,30 @@ class TrackingLink(Base):
 # =========================================================
 class Pedido(Base):
     __tablename__ = "pedidos"
+    # Índices dos caminhos quentes (gatekeeper, /status, recuperação do /start,
+    # webhooks de pagamento, Ceifador e listas do painel).
+    # Bancos já existentes recebem estes índices via migrate.py (versão 7).
+    __table_args__ = (
+        Index("ix_pedidos_bot_telegram_status_criado", "bot_id", "telegram_id", "status", "created_at"),
+        Index("ix_pedidos_bot_criado", "bot_id", "created_at", "id"),
+        Index("ix_pedidos_transaction_id", "transaction_id"),
+        # Referência do gateway normalizada (webhooks / status): versão 10 do migrate.py
+        Index("uq_pedidos_payment_ref", "payment_ref", unique=True),
+        # Parciais: só as linhas que as consultas realmente procuram
+        Index(
+            "ix_pedidos_pendentes", "bot_id", "created_at",
+            postgresql_where=text("status = 'pending'"),
+            sqlite_where=text("status = 'pending'"),
+        ),
+        # Vencimentos de pedidos ativos (PIX liquida como 'approved', site como 'paid'):
+        # faixa global em custom_expiration (Ceifador, lembretes). Versão 14 do migrate.py.
+        Index(
+            "ix_pedidos_ativos_vencimento", "custom_expiration",
+            postgresql_where=text("status IN ('paid', 'approved') AND custom_expiration IS NOT NULL"),
+            sqlite_where=text("status IN ('paid', 'approved') AND custom_expiration IS NOT NULL"),
+        ),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     bot_id = Column(Integer, ForeignKey("bots.id"))
     
@@ -263,6 +366,8 @@ class Pedido(Base):
     txid = Column(String, unique=True, index=True) 
     qr_code = Column(Text, nullable=True)
     transaction_id = Column(String, nullable=True)
+    # txid/transaction_id em minúsculo: única chave usada para achar o pedido pelo gateway
+    payment_ref = Column(String, nullable=True)
     
     data_aprovacao = Column(DateTime, nullable=True)
     data_expiracao = Column(DateTime, nullable=True)
@@ -295,12 +400,133 @@ class Pedido(Base):
     tracking_id = Column(Integer, ForeignKey("tracking_links.id"), nullable=True)
 
 
+# =========================================================
+# 📦 ENTREGAS (LIQUIDAÇÃO DE PAGAMENTOS)
+# =========================================================
+# O webhook de pagamento só grava o pedido como pago e cria esta linha.
+# Um pool de workers faz a entrega em etapas (acesso, bônus, admin),
+# com status por etapa e novas tentativas até dar certo.
+class Entrega(Base):
+    __tablename__ = "entregas"
+    __table_args__ = (
+        Index("ix_entregas_status_proxima", "status", "proxima_tentativa"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    pedido_id = Column(Integer, ForeignKey("pedidos.id"), unique=True)
+    bot_id = Column(Integer, ForeignKey("bots.id"), index=True)
+    origem = Column(String(20), default="pix")        # 'pix', 'site', 'recuperacao'
+
+    status = Column(String(20), default="pendente")   # 'pendente', 'processando', 'concluida', 'erro', 'falhou'
+    # Etapas: 'pendente', 'ok', 'erro', 'nao_aplica'
+    etapa_acesso = Column(String(20), default="pendente")
+    etapa_bump = Column(String(20), default="nao_aplica")
+    etapa_admin = Column(String(20), default="pendente")
+
+    link_convite = Column(String, nullable=True)      # Guardado para o retry não gerar outro link
+    tentativas = Column(Integer, default=0)
+    ultimo_erro = Column(Text, nullable=True)
+    proxima_tentativa = Column(DateTime, default=datetime.utcnow)
+    reservada_em = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    concluida_em = Column(DateTime, nullable=True)
+
+# =========================================================
+# 🧾 LEDGER DE EVENTOS DE PAGAMENTO
+# =========================================================
+# Todo webhook de pagamento aprovado passa por aqui antes de mexer no pedido.
+# gateway_ref é único: retry do gateway vira INSERT ignorado (não liquida de novo).
+# Sem FK para pedidos de propósito: o histórico financeiro sobrevive à exclusão do bot.
+# Reprocessável com: python replay_pagamentos.py
+class PagamentoEvento(Base):
+    __tablename__ = "payment_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    gateway_ref = Column(String, unique=True, nullable=False)  # ID da transação no gateway (minúsculo, sem espaços)
+    origem = Column(String(20))                                # 'pix', 'site'
+    status_gateway = Column(String(30))
+    payload = Column(Text, nullable=True)
+    pedido_id = Column(Integer, nullable=True, index=True)
+    resultado = Column(String(20), default="recebido")         # 'liquidado', 'ja_pago', 'nao_encontrado'
+    recebido_em = Column(DateTime, default=datetime.utcnow)
+
+# =========================================================
+# 🎟️ POOL DE CONVITES DO CANAL VIP
+# =========================================================
+# Links de uso único (member_limit=1) criados antes da venda por um worker em
+# segundo plano. A entrega só "tira" um da pilha (UPDATE atômico) em vez de
+# chamar o Telegram na hora. Usados são revogados em lote depois.
+class ConviteVip(Base):
+    __tablename__ = "convites_vip"
+    __table_args__ = (
+        Index("ix_convites_vip_pilha", "bot_id", "canal_id", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    bot_id = Column(Integer, ForeignKey("bots.id"))
+    canal_id = Column(String)                          # id_canal_vip do bot quando o link foi criado
+    invite_link = Column(String, unique=True, nullable=False)
+    status = Column(String(20), default="disponivel")  # 'disponivel', 'usado', 'revogado'
+    pedido_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    usado_em = Column(DateTime, nullable=True)
+    revogado_em = Column(DateTime, nullable=True)
+
+# =========================================================
+# 🎫 ASSINATURAS (DIREITO DE ACESSO AO VIP)
+# =========================================================
+# Uma linha por (bot, usuário) com a validade do acesso. É o que o porteiro,
+# o /status, o reenvio e o Ceifador consultam (busca pela PK), em vez de
+# varrer o histórico de pedidos. Mantida pelo main.py na liquidação, na
+# edição manual do painel e no vencimento. Bancos existentes: versão 13 do migrate.py.
+class Assinatura(Base):
+    __tablename__ = "subscriptions"
+    __table_args__ = (
+        # Parcial: vitalícios (expires_at NULL) nunca entram na varredura de vencimentos
+        Index(
+            "ix_subscriptions_expires_at", "expires_at",
+            postgresql_where=text("expires_at IS NOT NULL"),
+            sqlite_where=text("expires_at IS NOT NULL"),
+        ),
+    )
+
+    bot_id = Column(Integer, ForeignKey("bots.id"), primary_key=True)
+    telegram_id = Column(String, primary_key=True)
+    expires_at = Column(DateTime, nullable=True)  # None = vitalício
+    source_pedido_id = Column(Integer, ForeignKey("pedidos.id"), nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# =========================================================
+# ⏰ LEMBRETES DE RENOVAÇÃO (ANTES DO VENCIMENTO)
+# =========================================================
+# Uma linha por (pedido, tipo, vencimento): o INSERT ... ON CONFLICT DO NOTHING
+# é o que reserva o envio, então o mesmo lembrete nunca sai duas vezes.
+# O vencimento entra na chave para o pedido estendido no painel ser lembrado de novo.
+class LembreteRenovacao(Base):
+    __tablename__ = "lembretes_renovacao"
+    __table_args__ = (
+        UniqueConstraint("pedido_id", "tipo", "vencimento", name="uq_lembretes_pedido_tipo_vencimento"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    pedido_id = Column(Integer, ForeignKey("pedidos.id"), nullable=False)
+    bot_id = Column(Integer, ForeignKey("bots.id"), index=True)
+    tipo = Column(String(10))                         # '3d', '1d'
+    vencimento = Column(DateTime)                     # custom_expiration no momento do lembrete
+    status = Column(String(20), default="reservado")  # 'reservado', 'enviado', 'erro', 'ignorado'
+    created_at = Column(DateTime, default=datetime.utcnow)
+    enviado_em = Column(DateTime, nullable=True)
+
 # =========================================================
 # 🎯 TABELA: LEADS (TOPO DO FUNIL)
 # =========================================================
 class Lead(Base):
     __tablename__ = "leads"
-    
+    __table_args__ = (
+        Index("ix_leads_user_bot", "user_id", "bot_id"),
+        Index("ix_leads_bot_criado", "bot_id", "created_at", "id"),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, nullable=False)  # Telegram ID
     nome = Column(String)
@@ -0,0 +1,137 @@
+# =========================================================
+# 🧪 GATEWAY PUSHIN PAY FAKE (LOCAL) + BENCHMARK DO CLIENTE
+# =========================================================
+# Servidor HTTP que imita o POST /api/pix/cashIn da PushinPay, com latência
+# e taxa de erro configuráveis. Serve para testar o bot sem gerar cobrança
+# de verdade e para medir o cliente pooled (main.pushinpay).
+#
+# Servidor (aponte o app para ele com PUSHINPAY_API_URL):
+#   python fake_pushinpay.py --porta 9100 --latencia 0.15
+#   PUSHINPAY_API_URL=http://127.0.0.1:9100 uvicorn main:app
+#
+# Benchmark (sobe o fake numa thread e compara com requests.post sem pool):
+#   python fake_pushinpay.py --bench 500 --concorrencia 20
+#   python fake_pushinpay.py --bench 200 --falhar 1.0      (circuito abrindo)
+#
+# Em loopback não há handshake TLS, que é onde o pool mais economiza contra
+# api.pushinpay.com.br: use --latencia para aproximar o tempo do gateway real.
+
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+class GatewayFake(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, igual ao gateway real
+    latencia = 0.0
+    taxa_falha = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _responder(self, status, corpo):
+        dados = json.dumps(corpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_POST(self):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(tamanho) or b"{}")
+        if self.latencia:
+            time.sleep(self.latencia)
+
+        if self.path.rstrip("/") != "/api/pix/cashIn":
+            return self._responder(404, {"message": "rota não encontrada"})
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            return self._responder(401, {"message": "Unauthenticated."})
+        if random.random() < self.taxa_falha:
+            return self._responder(502, {"message": "gateway fake instável"})
+
+        tx = str(uuid.uuid4()).upper()
+        self._responder(201, {
+            "id": tx,
+            "qr_code": f"00020101021226fake{tx}5204000053039865802BR",
+            "status": "created",
+            "value": payload.get("value"),
+            "webhook_url": payload.get("webhook_url"),
+            "qr_code_base64": "",
+        })
+
+class ServidorFake(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # o modo sem pool abre uma conexão por cobrança
+
+def subir_servidor(porta, latencia, taxa_falha):
+    GatewayFake.latencia = latencia
+    GatewayFake.taxa_falha = taxa_falha
+    return ServidorFake(("127.0.0.1", porta), GatewayFake)
+
+def medir(nome, total, concorrencia, chamada):
+    tempos, erros = [], 0
+    inicio = time.perf_counter()
+
+    def uma(i):
+        t0 = time.perf_counter()
+        ok = chamada(i)
+        return time.perf_counter() - t0, ok
+
+    with ThreadPoolExecutor(concorrencia) as ex:
+        for dur, ok in ex.map(uma, range(total)):
+            tempos.append(dur)
+            erros += 0 if ok else 1
+    total_s = time.perf_counter() - inicio
+    tempos.sort()
+    p50 = tempos[len(tempos) // 2] * 1000
+    p99 = tempos[min(len(tempos) - 1, int(len(tempos) * 0.99))] * 1000
+    print(f"{nome:<28} {total / total_s:8.1f} req/s   p50 {p50:7.1f} ms   p99 {p99:7.1f} ms   falhas {erros}")
+
+def benchmark(porta, total, concorrencia):
+    url = f"http://127.0.0.1:{porta}"
+    os.environ["PUSHINPAY_API_URL"] = url
+    import requests
+    from main import pushinpay
+
+    def sem_pool(i):
+        try:
+            r = requests.post(f"{url}/api/pix/cashIn", json={"value": 1990, "external_reference": f"b{i}"},
+                              headers={"Authorization": "Bearer bench"}, timeout=10)
+        except requests.RequestException:
+            return False
+        return r.status_code in (200, 201)
+
+    def pooled(i):
+        return pushinpay.criar_cobranca("bench", 19.9, f"b{i}") is not None
+
+    medir("requests.post (sem pool)", total, concorrencia, sem_pool)
+    medir("ClientePushinPay (pooled)", total, concorrencia, pooled)
+    if pushinpay.aberto():
+        print("⚡ Circuito do cliente ficou ABERTO (chamadas recusadas sem ir ao gateway).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gateway PushinPay fake para testes e benchmark")
+    parser.add_argument("--porta", type=int, default=9100)
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos de espera por cobrança")
+    parser.add_argument("--falhar", type=float, default=0.0, help="Fração de respostas 502 (0.0 a 1.0)")
+    parser.add_argument("--bench", type=int, default=0, help="Roda N cobranças contra o fake e sai")
+    parser.add_argument("--concorrencia", type=int, default=20)
+    args = parser.parse_args()
+
+    servidor = subir_servidor(args.porta, args.latencia, args.falhar)
+    if not args.bench:
+        print(f"🧪 PushinPay fake em http://127.0.0.1:{args.porta}/api/pix/cashIn (Ctrl+C para sair)")
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        benchmark(args.porta, args.bench, args.concorrencia)
+        servidor.shutdown()
@@ -0,0 +1,112 @@
+# =========================================================
+# 🏋️ TESTE DE CARGA - WEBHOOK DO TELEGRAM
+# =========================================================
+# Dispara N updates "/start" AO MESMO TEMPO espalhados entre B bots
+# e mede a latência da resposta da rota /webhook/{token}.
+#
+# Uso (com o servidor rodando):
+#   python load_test_webhook.py --url http://localhost:8000 --seed
+#   python load_test_webhook.py --url http://localhost:8000 --updates 500 --bots 50
+#
+# --seed cria (uma vez) os bots fake "loadtest_N" no banco apontado por DATABASE_URL.
+# Rode antes e depois de uma mudança e compare o p99 impresso no final.
+
+import argparse
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+TOKEN_PREFIXO = "loadtest"
+
+def token_do_bot(i):
+    # Formato parecido com um token real (id:hash) para não cair em validações
+    return f"{900000000 + i}:{TOKEN_PREFIXO}_{i:04d}"
+
+def semear_bots(total_bots):
+    """Cria os bots fake no banco (idempotente)."""
+    from database import SessionLocal, Bot
+
+    db = SessionLocal()
+    try:
+        criados = 0
+        for i in range(total_bots):
+            token = token_do_bot(i)
+            if db.query(Bot).filter(Bot.token == token).first():
+                continue
+            db.add(Bot(
+                nome=f"LoadTest {i}", token=token, username=f"loadtest_{i}_bot",
+                id_canal_vip="-1000000000000", status="ativo"
+            ))
+            criados += 1
+        db.commit()
+        print(f"🌱 {criados} bots fake criados ({total_bots} no total).")
+    finally:
+        db.close()
+
+def montar_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Carga"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Carga", "username": f"carga{user_id}"},
+            "text": "/start"
+        }
+    }
+
+def percentil(valores, p):
+    if not valores: return 0.0
+    ordenados = sorted(valores)
+    k = max(0, min(len(ordenados) - 1, int(round(p / 100.0 * len(ordenados) + 0.5)) - 1))
+    return ordenados[k]
+
+def executar(url_base, total_updates, total_bots, timeout):
+    barreira = threading.Barrier(total_updates)
+    sessao = requests.Session()
+    adaptador = requests.adapters.HTTPAdapter(pool_connections=total_updates, pool_maxsize=total_updates)
+    sessao.mount("http://", adaptador)
+    sessao.mount("https://", adaptador)
+
+    def disparar(i):
+        token = token_do_bot(i % total_bots)
+        payload = montar_update(i + 1, 100000000 + i)
+        barreira.wait()  # Todos saem juntos
+        inicio = time.perf_counter()
+        try:
+            r = sessao.post(f"{url_base}/webhook/{token}", json=payload, timeout=timeout)
+            status = r.status_code
+        except Exception:
+            status = 0
+        return (time.perf_counter() - inicio) * 1000.0, status
+
+    inicio_total = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=total_updates) as pool:
+        resultados = list(pool.map(disparar, range(total_updates)))
+    duracao_total = time.perf_counter() - inicio_total
+
+    latencias = [ms for ms, st in resultados if st == 200]
+    erros = [st for ms, st in resultados if st != 200]
+
+    print(f"\n📊 {total_updates} updates / {total_bots} bots em {duracao_total:.2f}s")
+    print(f"   ✅ 200 OK: {len(latencias)}   ❌ falhas: {len(erros)}")
+    if latencias:
+        print(f"   p50: {percentil(latencias, 50):8.1f} ms")
+        print(f"   p95: {percentil(latencias, 95):8.1f} ms")
+        print(f"   p99: {percentil(latencias, 99):8.1f} ms")
+        print(f"   max: {max(latencias):8.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga do webhook do Telegram")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--bots", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", action="store_true", help="Cria os bots fake no banco antes do teste")
+    args = parser.parse_args()
+
+    if args.seed:
+        semear_bots(args.bots)
+
+    executar(args.url.rstrip("/"), args.updates, args.bots, args.timeout)
@@ -5,30 +5,33 @@ import requests
 import time
 import urllib.parse
 import threading
+import heapq
+import zlib
 from telebot import types
 import json
 import uuid
+import base64
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
 # --- IMPORTS CORRIGIDOS ---
-from sqlalchemy import func, desc, text
+from sqlalchemy import func, desc, text, select, union, union_all, exists, insert, literal, case, and_, tuple_, cast, null, DateTime, create_engine
+from sqlalchemy.pool import NullPool
 from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from typing import List, Optional
 from datetime import datetime, timedelta
 from database import Lead  # Não esqueça de importar Lead!
-from force_migration import forcar_atualizacao_tabelas
 
 
 # Importa o banco e o script de reparo
-from database import SessionLocal, init_db, Bot, PlanoConfig, BotFlow, BotFlowStep, Pedido, SystemConfig, RemarketingCampaign, BotAdmin, Lead, OrderBumpConfig, TrackingFolder, TrackingLink, MiniAppConfig, MiniAppCategory, engine
-import update_db 
-
-from migration_v3 import executar_migracao_v3
-from migration_v4 import executar_migracao_v4
-from migration_v5 import executar_migracao_v5  # <--- ADICIONE ESTA LINHA
-from migration_v6 import executar_migracao_v6  # <--- ADICIONE AQUI
+from database import SessionLocal, Bot, PlanoConfig, BotFlow, BotFlowStep, Pedido, SystemConfig, RemarketingCampaign, BotAdmin, Lead, OrderBumpConfig, TrackingFolder, TrackingLink, MiniAppConfig, MiniAppCategory, TarefaAgendada, MidiaCache, RemarketingEnvio, DailyStat, Entrega, PagamentoEvento, ConviteVip, LembreteRenovacao, Assinatura, engine
+from migrate import VERSAO_ATUAL as VERSAO_SCHEMA, versao_do_banco
 
 # Configuração de Log
 logging.basicConfig(level=logging.INFO)
@@ -36,12 +39,6 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Zenyx Gbot SaaS")
 
-# 🔥 FORÇA A CRIAÇÃO DAS COLUNAS AO INICIAR
-try:
-    forcar_atualizacao_tabelas()
-except Exception as e:
-    print(f"Erro na migração forçada: {e}")
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -60,6 +57,799 @@ def get_db():
     finally:
         db.close()
 
+# =========================================================
+# 🧵 POOL DE WORKERS DOS UPDATES DO TELEGRAM
+# =========================================================
+# A rota do webhook é async: nada bloqueante pode rodar no event loop.
+# O update é entregue a um pool limitado de threads e a rota responde na hora.
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_MAX_PENDENTES = int(os.getenv("WEBHOOK_MAX_PENDENTES", "5000"))
+
+webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="tg-update")
+_vagas_webhook = threading.BoundedSemaphore(WEBHOOK_MAX_PENDENTES)
+
+def despachar_update_telegram(token: str, body: dict) -> bool:
+    """
+    Enfileira o update no pool. Retorna False se a fila estiver cheia
+    (o Telegram reenvia o update quando recebe erro).
+    """
+    if not _vagas_webhook.acquire(blocking=False):
+        logger.warning("⚠️ Fila de updates do Telegram cheia, pedindo reenvio.")
+        return False
+
+    def _executar():
+        try:
+            processar_update_telegram(token, body)
+        except Exception as e:
+            logger.error(f"Erro no worker de update: {e}")
+        finally:
+            _vagas_webhook.release()
+
+    try:
+        webhook_executor.submit(_executar)
+    except RuntimeError:
+        # Executor já foi encerrado (shutdown em andamento)
+        _vagas_webhook.release()
+        return False
+    return True
+
+# =========================================================
+# 🚦 DISPATCHER DE SAÍDA DO TELEGRAM (LIMITES + 429)
+# =========================================================
+# Toda chamada de envio passa por aqui (os clientes do bot_registry já vêm
+# embrulhados). Token buckets seguram o ritmo antes do Telegram recusar:
+#   - por bot:   ~30 msg/s no total
+#   - por chat:  ~1 msg/s (com pequena rajada, ex.: PIX + copia e cola)
+#   - por grupo: ~20 msg/min (chat_id negativo)
+# Um 429 pausa o bot inteiro pelo retry_after devolvido e a chamada é refeita.
+TG_LIMITE_BOT_POR_SEG = float(os.getenv("TG_LIMITE_BOT_POR_SEG", "30"))
+TG_LIMITE_CHAT_POR_SEG = float(os.getenv("TG_LIMITE_CHAT_POR_SEG", "1"))
+TG_LIMITE_GRUPO_POR_MIN = float(os.getenv("TG_LIMITE_GRUPO_POR_MIN", "20"))
+TG_MAX_TENTATIVAS_429 = int(os.getenv("TG_MAX_TENTATIVAS_429", "3"))
+
+# Métodos que mandam mensagem para um chat (contam no bucket do chat)
+METODOS_ENVIO = frozenset({
+    "send_message", "send_photo", "send_video", "send_document", "send_animation",
+    "send_audio", "send_voice", "copy_message", "forward_message"
+})
+# Demais chamadas que só contam no limite global do bot
+METODOS_LIMITADOS = METODOS_ENVIO | frozenset({
+    "delete_message", "edit_message_text", "edit_message_reply_markup", "answer_callback_query",
+    "ban_chat_member", "unban_chat_member", "kick_chat_member",
+    "create_chat_invite_link", "revoke_chat_invite_link", "get_chat_member"
+})
+
+class TokenBucket:
+    __slots__ = ("taxa", "capacidade", "tokens", "atualizado")
+
+    def __init__(self, taxa: float, capacidade: float):
+        self.taxa = taxa  # tokens por segundo
+        self.capacidade = capacidade
+        self.tokens = capacidade
+        self.atualizado = time.monotonic()
+
+    def reservar(self, agora: float) -> float:
+        """Consome 1 token (pode ficar negativo) e devolve quantos segundos esperar."""
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.taxa
+
+    def ocioso(self, agora: float) -> bool:
+        return self.tokens + (agora - self.atualizado) * self.taxa >= self.capacidade
+
+class TelegramDispatcher:
+    LIMPEZA_CHATS = 50000  # acima disso, buckets de chats ociosos são descartados
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_bot = {}       # token -> TokenBucket
+        self._por_chat = {}      # (token, chat_id) -> TokenBucket
+        self._pausado_ate = {}   # token -> monotonic (retry_after do 429)
+        self._aguardando = {}    # token -> chamadas esperando vaga agora
+        self._enviados = {}      # token -> total de chamadas feitas
+        self._erros_429 = {}     # token -> total de 429 recebidos
+
+    def _bucket_chat(self, token: str, chat_id) -> TokenBucket:
+        chave = (token, str(chat_id))
+        bucket = self._por_chat.get(chave)
+        if bucket is None:
+            if str(chat_id).startswith("-"):
+                bucket = TokenBucket(TG_LIMITE_GRUPO_POR_MIN / 60.0, 3)
+            else:
+                bucket = TokenBucket(TG_LIMITE_CHAT_POR_SEG, 3)
+            self._por_chat[chave] = bucket
+        return bucket
+
+    def _limpar_chats_ociosos(self, agora: float):
+        for chave in [k for k, b in self._por_chat.items() if b.ocioso(agora)]:
+            del self._por_chat[chave]
+
+    def _esperar_vaga(self, token: str, chat_id=None):
+        with self._lock:
+            agora = time.monotonic()
+            bucket_bot = self._por_bot.get(token)
+            if bucket_bot is None:
+                bucket_bot = self._por_bot[token] = TokenBucket(TG_LIMITE_BOT_POR_SEG, TG_LIMITE_BOT_POR_SEG)
+            espera = bucket_bot.reservar(agora)
+            if chat_id is not None:
+                if len(self._por_chat) > self.LIMPEZA_CHATS:
+                    self._limpar_chats_ociosos(agora)
+                espera = max(espera, self._bucket_chat(token, chat_id).reservar(agora))
+            espera = max(espera, self._pausado_ate.get(token, 0) - agora)
+            if espera > 0:
+                self._aguardando[token] = self._aguardando.get(token, 0) + 1
+        if espera <= 0:
+            return
+        try:
+            time.sleep(espera)
+        finally:
+            with self._lock:
+                self._aguardando[token] -= 1
+
+    def pausar(self, token: str, segundos: float):
+        with self._lock:
+            ate = time.monotonic() + segundos
+            if ate > self._pausado_ate.get(token, 0):
+                self._pausado_ate[token] = ate
+            self._erros_429[token] = self._erros_429.get(token, 0) + 1
+
+    def executar(self, token: str, chat_id, funcao, /, *args, **kwargs):
+        tentativa = 0
+        while True:
+            self._esperar_vaga(token, chat_id)
+            try:
+                resultado = funcao(*args, **kwargs)
+                with self._lock:
+                    self._enviados[token] = self._enviados.get(token, 0) + 1
+                return resultado
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or tentativa >= TG_MAX_TENTATIVAS_429:
+                    raise
+                tentativa += 1
+                parametros = (e.result_json or {}).get("parameters") or {}
+                retry_after = parametros.get("retry_after", 1)
+                logger.warning(f"🚦 [TELEGRAM] 429 no bot {token.split(':')[0]}: pausando {retry_after}s (tentativa {tentativa})")
+                self.pausar(token, retry_after)
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            agora = time.monotonic()
+            tokens = set(self._por_bot) | set(self._pausado_ate)
+            bots = {}
+            for token in tokens:
+                bots[token.split(":")[0]] = {
+                    "aguardando": self._aguardando.get(token, 0),
+                    "enviados": self._enviados.get(token, 0),
+                    "erros_429": self._erros_429.get(token, 0),
+                    "pausado_por": max(0.0, round(self._pausado_ate.get(token, 0) - agora, 1))
+                }
+            return {
+                "aguardando_total": sum(self._aguardando.values()),
+                "chats_rastreados": len(self._por_chat),
+                "bots": bots
+            }
+
+telegram_dispatcher = TelegramDispatcher()
+
+class ClienteTelegram:
+    """TeleBot com as chamadas de envio passando pelo telegram_dispatcher."""
+
+    def __init__(self, tb: telebot.TeleBot, dispatcher: TelegramDispatcher):
+        self._tb = tb
+        self._dispatcher = dispatcher
+        self.token = tb.token
+
+    def __getattr__(self, nome):
+        atributo = getattr(self._tb, nome)
+        if nome not in METODOS_LIMITADOS:
+            return atributo
+
+        def chamada(*args, **kwargs):
+            chat_id = None
+            if nome in METODOS_ENVIO:
+                chat_id = args[0] if args else kwargs.get("chat_id")
+            return self._dispatcher.executar(self.token, chat_id, atributo, *args, **kwargs)
+        return chamada
+
+# =========================================================
+# 🗂️ REGISTRO DE BOTS EM MEMÓRIA (TOKEN -> SNAPSHOT + CLIENTE)
+# =========================================================
+# Cada update do Telegram precisa do Bot pelo token. Em vez de consultar o banco
+# e montar um TeleBot novo por update, o processo mantém um snapshot de cada bot
+# e UM cliente TeleBot reaproveitado por token. As rotas que alteram a tabela
+# bots (criar/editar/pausar/excluir/admins/token PIX) invalidam a entrada.
+# O TTL limita o tempo de desatualização entre workers diferentes.
+BOT_REGISTRY_TTL = int(os.getenv("BOT_REGISTRY_TTL", "60"))
+
+class BotSnapshot:
+    """Cópia leve de uma linha de 'bots' (não depende de sessão aberta)."""
+    __slots__ = (
+        "id", "nome", "token", "username", "id_canal_vip", "admin_principal_id",
+        "suporte_username", "status", "pushin_token", "created_at", "admin_ids"
+    )
+
+    def __init__(self, bot: Bot):
+        self.id = bot.id
+        self.nome = bot.nome
+        self.token = bot.token
+        self.username = bot.username
+        self.id_canal_vip = bot.id_canal_vip
+        self.admin_principal_id = bot.admin_principal_id
+        self.suporte_username = bot.suporte_username
+        self.status = bot.status
+        self.pushin_token = bot.pushin_token
+        self.created_at = bot.created_at
+        # Telegram IDs dos admins extras (tabela BotAdmin)
+        self.admin_ids = tuple(str(a.telegram_id).strip() for a in bot.admins if a.telegram_id)
+
+class BotRegistry:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._por_token = {}   # token -> (snapshot | None, expira_em)
+        self._por_id = {}      # bot_id -> (snapshot | None, expira_em)
+        self._clientes = {}    # token -> ClienteTelegram
+
+    def _carregar(self, filtro, db: Optional[Session] = None):
+        sessao = db or SessionLocal()
+        try:
+            bot = sessao.query(Bot).filter(filtro).first()
+            return BotSnapshot(bot) if bot else None
+        finally:
+            if db is None:
+                sessao.close()
+
+    def _guardar(self, snap: Optional[BotSnapshot], token=None, bot_id=None):
+        expira = time.monotonic() + self.ttl
+        with self._lock:
+            if snap:
+                self._por_token[snap.token] = (snap, expira)
+                self._por_id[snap.id] = (snap, expira)
+            else:
+                # Cache negativo: tokens desconhecidos não batem no banco a cada update
+                if token is not None: self._por_token[token] = (None, expira)
+                if bot_id is not None: self._por_id[bot_id] = (None, expira)
+
+    def obter_por_token(self, token: str, db: Optional[Session] = None) -> Optional[BotSnapshot]:
+        with self._lock:
+            item = self._por_token.get(token)
+        if item and item[1] > time.monotonic():
+            return item[0]
+        snap = self._carregar(Bot.token == token, db)
+        self._guardar(snap, token=token)
+        return snap
+
+    def obter_por_id(self, bot_id: int, db: Optional[Session] = None) -> Optional[BotSnapshot]:
+        with self._lock:
+            item = self._por_id.get(bot_id)
+        if item and item[1] > time.monotonic():
+            return item[0]
+        snap = self._carregar(Bot.id == bot_id, db)
+        self._guardar(snap, bot_id=bot_id)
+        return snap
+
+    def cliente(self, token: str) -> "ClienteTelegram":
+        """Cliente TeleBot reaproveitado para o token (envios limitados pelo dispatcher)."""
+        with self._lock:
+            tb = self._clientes.get(token)
+            if tb is None:
+                tb = ClienteTelegram(telebot.TeleBot(token), telegram_dispatcher)
+                self._clientes[token] = tb
+            return tb
+
+    def invalidar(self, bot_id: Optional[int] = None, token: Optional[str] = None):
+        with self._lock:
+            if bot_id is not None:
+                item = self._por_id.pop(bot_id, None)
+                if item and item[0]:
+                    self._por_token.pop(item[0].token, None)
+                    self._clientes.pop(item[0].token, None)
+            if token is not None:
+                item = self._por_token.pop(token, None)
+                self._clientes.pop(token, None)
+                if item and item[0]:
+                    self._por_id.pop(item[0].id, None)
+
+bot_registry = BotRegistry(BOT_REGISTRY_TTL)
+
+# =========================================================
+# 🧊 SNAPSHOT DO FLUXO POR BOT (FLUXO + PASSOS + PLANOS + BUMP)
+# =========================================================
+# O caminho quente da conversa (/start, step_N, checkout_, bump_, promo_) lê
+# tudo daqui. O snapshot é imutável (namedtuples + tuplas + mappings somente
+# leitura) e só é reconstruído quando as rotas de fluxo/passos/planos/order bump
+# salvam (ou quando o TTL vence, para outros workers enxergarem a mudança).
+FLOW_CACHE_TTL = int(os.getenv("FLOW_CACHE_TTL", "60"))
+
+# Os campos espelham as colunas das tabelas: o código que lia a linha do ORM
+# continua funcionando igual com o snapshot (passo.msg_texto, plano.preco_atual...)
+FluxoSnapshot = namedtuple("FluxoSnapshot", BotFlow.__table__.columns.keys())
+PassoSnapshot = namedtuple("PassoSnapshot", BotFlowStep.__table__.columns.keys())
+PlanoSnapshot = namedtuple("PlanoSnapshot", PlanoConfig.__table__.columns.keys())
+OrderBumpSnapshot = namedtuple("OrderBumpSnapshot", OrderBumpConfig.__table__.columns.keys())
+
+def _congelar(linha, tipo):
+    if linha is None:
+        return None
+    return tipo(**{campo: getattr(linha, campo) for campo in tipo._fields})
+
+class FlowSnapshot:
+    """Fluxo completo de um bot, indexado para o caminho quente."""
+    __slots__ = ("bot_id", "fluxo", "passos", "passos_por_ordem", "planos", "planos_por_id", "bump")
+
+    def __init__(self, bot_id, fluxo, passos, planos, bump):
+        self.bot_id = bot_id
+        self.fluxo = _congelar(fluxo, FluxoSnapshot)
+        self.passos = tuple(_congelar(p, PassoSnapshot) for p in passos)
+        self.passos_por_ordem = MappingProxyType({p.step_order: p for p in self.passos})
+        self.planos = tuple(_congelar(p, PlanoSnapshot) for p in planos)
+        self.planos_por_id = MappingProxyType({p.id: p for p in self.planos})
+        self.bump = _congelar(bump, OrderBumpSnapshot)
+
+    def passo(self, step_order):
+        return self.passos_por_ordem.get(step_order)
+
+    def plano(self, plano_id):
+        try: return self.planos_por_id.get(int(plano_id))
+        except (TypeError, ValueError): return None
+
+    @property
+    def bump_ativo(self):
+        return self.bump if (self.bump and self.bump.ativo) else None
+
+class FlowCache:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshots = {}  # bot_id -> (FlowSnapshot, expira_em)
+        self._geracao = {}    # bot_id -> contador de invalidações
+
+    def _montar(self, bot_id: int, db: Session) -> FlowSnapshot:
+        fluxo = db.query(BotFlow).filter(BotFlow.bot_id == bot_id).first()
+        passos = db.query(BotFlowStep).filter(BotFlowStep.bot_id == bot_id).order_by(BotFlowStep.step_order).all()
+        planos = db.query(PlanoConfig).filter(PlanoConfig.bot_id == bot_id).order_by(PlanoConfig.id).all()
+        bump = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == bot_id).first()
+        return FlowSnapshot(bot_id, fluxo, passos, planos, bump)
+
+    def obter(self, bot_id: int, db: Optional[Session] = None) -> FlowSnapshot:
+        with self._lock:
+            item = self._snapshots.get(bot_id)
+            geracao = self._geracao.get(bot_id, 0)
+        if item and item[1] > time.monotonic():
+            return item[0]
+
+        sessao = db or SessionLocal()
+        try:
+            snap = self._montar(bot_id, sessao)
+        finally:
+            if db is None:
+                sessao.close()
+
+        with self._lock:
+            # Se alguém salvou enquanto montávamos, não guarda a versão velha
+            if self._geracao.get(bot_id, 0) == geracao:
+                self._snapshots[bot_id] = (snap, time.monotonic() + self.ttl)
+        return snap
+
+    def invalidar(self, bot_id: int):
+        with self._lock:
+            self._snapshots.pop(bot_id, None)
+            self._geracao[bot_id] = self._geracao.get(bot_id, 0) + 1
+
+flow_cache = FlowCache(FLOW_CACHE_TTL)
+
+# =========================================================
+# 🖼️ CACHE DE MÍDIA (URL -> file_id DO TELEGRAM, POR BOT)
+# =========================================================
+# Mandar a URL faz o Telegram baixar o arquivo de novo a cada envio.
+# Na primeira vez a URL é enviada e o file_id devolvido fica salvo em
+# media_cache; dali em diante todos os envios desse bot usam o file_id.
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", "600"))
+EXTENSOES_VIDEO = ('.mp4', '.mov', '.avi')
+
+def tipo_da_midia(media_url: str) -> str:
+    return "video" if media_url.lower().endswith(EXTENSOES_VIDEO) else "foto"
+
+def extrair_file_id(msg) -> Optional[str]:
+    if msg is None: return None
+    if getattr(msg, "photo", None): return msg.photo[-1].file_id  # Maior resolução
+    for campo in ("video", "animation", "document"):
+        anexo = getattr(msg, campo, None)
+        if anexo: return anexo.file_id
+    return None
+
+class MediaRegistry:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._file_ids = {}    # (bot_id, url) -> file_id
+        self._carregados = {}  # bot_id -> expira_em (mapa do bot lido do banco)
+        # Só um upload por URL: travas fixas por hash de (bot_id, url), como no
+        # checkout PIX, para não guardar um Lock por URL pela vida do processo
+        self._travas = [threading.Lock() for _ in range(64)]
+
+    def _carregar_bot(self, bot_id: int):
+        db = SessionLocal()
+        try:
+            linhas = db.query(MidiaCache.media_url, MidiaCache.file_id).filter(MidiaCache.bot_id == bot_id).all()
+        finally:
+            db.close()
+        with self._lock:
+            for chave in [k for k in self._file_ids if k[0] == bot_id]:
+                del self._file_ids[chave]
+            for url, file_id in linhas:
+                self._file_ids[(bot_id, url)] = file_id
+            self._carregados[bot_id] = time.monotonic() + self.ttl
+
+    def obter(self, bot_id: int, media_url: str, consultar_banco: bool = False) -> Optional[str]:
+        with self._lock:
+            expira = self._carregados.get(bot_id)
+        if not expira or expira < time.monotonic():
+            self._carregar_bot(bot_id)
+        elif consultar_banco:
+            # Outro processo pode ter subido a mesma URL depois da nossa carga
+            db = SessionLocal()
+            try:
+                linha = db.query(MidiaCache.file_id).filter(
+                    MidiaCache.bot_id == bot_id, MidiaCache.media_url == media_url
+                ).first()
+            finally:
+                db.close()
+            if linha:
+                with self._lock: self._file_ids[(bot_id, media_url)] = linha[0]
+        with self._lock:
+            return self._file_ids.get((bot_id, media_url))
+
+    def registrar(self, bot_id: int, media_url: str, file_id: str, tipo: str):
+        with self._lock:
+            self._file_ids[(bot_id, media_url)] = file_id
+        db = SessionLocal()
+        try:
+            linha = db.query(MidiaCache).filter(MidiaCache.bot_id == bot_id, MidiaCache.media_url == media_url).first()
+            if linha:
+                linha.file_id = file_id
+                linha.tipo = tipo
+            else:
+                db.add(MidiaCache(bot_id=bot_id, media_url=media_url, file_id=file_id, tipo=tipo))
+            db.commit()
+        except Exception as e:
+            db.rollback()  # Corrida com outro processo: o file_id dele serve igual
+            logger.warning(f"⚠️ [MÍDIA] Não salvou file_id de {media_url}: {e}")
+        finally:
+            db.close()
+
+    def invalidar(self, bot_id: int, media_url: Optional[str]):
+        if not media_url: return
+        with self._lock:
+            self._file_ids.pop((bot_id, media_url), None)
+        db = SessionLocal()
+        try:
+            db.query(MidiaCache).filter(MidiaCache.bot_id == bot_id, MidiaCache.media_url == media_url).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"⚠️ [MÍDIA] Erro ao invalidar {media_url}: {e}")
+        finally:
+            db.close()
+
+    def substituida(self, bot_id: int, antiga: Optional[str], nova: Optional[str]):
+        """Chamado pelas rotas de admin quando um campo de mídia é salvo."""
+        if antiga and antiga != nova:
+            self.invalidar(bot_id, antiga)
+
+    def esquecer_bot(self, bot_id: int):
+        with self._lock:
+            self._carregados.pop(bot_id, None)
+            for chave in [k for k in self._file_ids if k[0] == bot_id]:
+                del self._file_ids[chave]
+
+    def trava(self, bot_id: int, media_url: str) -> threading.Lock:
+        return self._travas[hash((bot_id, media_url)) % len(self._travas)]
+
+media_registry = MediaRegistry(MEDIA_CACHE_TTL)
+
+def enviar_midia(bot_temp, bot_id: int, chat_id, media_url: str, caption=None, reply_markup=None, parse_mode=None):
+    """
+    Envia foto/vídeo pelo file_id já conhecido; sobe a URL só na primeira vez.
+    Levanta a exceção do Telegram normalmente (quem chama mantém seu fallback).
+    """
+    tipo = tipo_da_midia(media_url)
+    enviar = bot_temp.send_video if tipo == "video" else bot_temp.send_photo
+
+    file_id = media_registry.obter(bot_id, media_url)
+    if file_id:
+        try:
+            return enviar(chat_id, file_id, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
+        except telebot.apihelper.ApiTelegramException as e:
+            # "wrong file identifier": file_id perdido, sobe a URL de novo
+            if e.error_code != 400 or "file" not in str(e.description).lower():
+                raise
+            media_registry.invalidar(bot_id, media_url)
+
+    # Num disparo em massa, só o primeiro envio sobe a URL; os outros esperam o file_id
+    with media_registry.trava(bot_id, media_url):
+        file_id = media_registry.obter(bot_id, media_url, consultar_banco=True)
+        if file_id:
+            return enviar(chat_id, file_id, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
+
+        msg = enviar(chat_id, media_url, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
+        novo_file_id = extrair_file_id(msg)
+        if novo_file_id:
+            media_registry.registrar(bot_id, media_url, novo_file_id, tipo)
+        return msg
+
+# =========================================================
+# ⏰ AGENDADOR DE PASSOS (HEAP EM MEMÓRIA + TABELA tarefas_agendadas)
+# =========================================================
+# Passos com delay não seguram mais uma thread dormindo: cada continuação
+# vira uma linha em tarefas_agendadas e entra num heap em memória. Uma única
+# thread dorme até o próximo vencimento e joga as tarefas no pool.
+# Após um redeploy, as pendentes são recarregadas do banco no startup.
+# Tarefa que falha (429, rede) volta com backoff até AGENDADOR_MAX_TENTATIVAS
+# e depois é apagada; a varredura devolve claims abandonados à fila.
+AGENDADOR_WORKERS = int(os.getenv("AGENDADOR_WORKERS", "8"))
+AGENDADOR_VARREDURA_SEGUNDOS = int(os.getenv("AGENDADOR_VARREDURA_SEGUNDOS", "60"))
+AGENDADOR_TRAVADA_MINUTOS = 10  # 'processando' há mais que isso (desde o claim) = processo morreu no meio
+AGENDADOR_MAX_TENTATIVAS = int(os.getenv("AGENDADOR_MAX_TENTATIVAS", "5"))
+AGENDADOR_BACKOFF_SEGUNDOS = (30, 120, 600, 1800)
+
+class FilaDeTempo:
+    """Heap de (quando, item) com uma thread que dorme até o próximo vencimento."""
+
+    def __init__(self, nome: str, ao_vencer):
+        self.nome = nome
+        self._ao_vencer = ao_vencer  # recebe a lista de itens vencidos
+        self._heap = []
+        self._seq = 0                # desempate estável entre itens do mesmo instante
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def agendar(self, quando: datetime, item):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (quando, self._seq, item))
+            # Só acorda a thread se o novo item passou a ser o próximo
+            if self._heap[0][1] == self._seq:
+                self._cond.notify()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def iniciar(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name=self.nome, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                espera = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+                if espera > 0:
+                    self._cond.wait(timeout=espera)
+                    continue
+                agora = datetime.utcnow()
+                vencidos = []
+                while self._heap and self._heap[0][0] <= agora:
+                    vencidos.append(heapq.heappop(self._heap)[2])
+            try:
+                self._ao_vencer(vencidos)
+            except Exception as e:
+                logger.error(f"❌ [{self.nome}] Erro ao despachar itens vencidos: {e}")
+
+agendador_executor = ThreadPoolExecutor(max_workers=AGENDADOR_WORKERS, thread_name_prefix="fluxo-agendado")
+
+def _despachar_tarefas_vencidas(tarefa_ids):
+    for tarefa_id in tarefa_ids:
+        agendador_executor.submit(executar_tarefa_fluxo, tarefa_id)
+
+fila_fluxo = FilaDeTempo("agendador-fluxo", _despachar_tarefas_vencidas)
+
+def agendar_tarefa_fluxo(db: Session, bot_id: int, chat_id, tipo: str, atraso_segundos: int,
+                         step_order: Optional[int] = None, apagar_message_id: Optional[int] = None):
+    """Persiste a continuação do fluxo e coloca no heap. tipo: 'passo' ou 'oferta'."""
+    tarefa = TarefaAgendada(
+        bot_id=bot_id,
+        chat_id=str(chat_id),
+        tipo=tipo,
+        step_order=step_order,
+        apagar_message_id=apagar_message_id,
+        executar_em=datetime.utcnow() + timedelta(seconds=atraso_segundos),
+        status="pendente"
+    )
+    db.add(tarefa)
+    db.commit()
+    fila_fluxo.agendar(tarefa.executar_em, tarefa.id)
+    return tarefa
+
+def executar_tarefa_fluxo(tarefa_id: int):
+    db = SessionLocal()
+    try:
+        # Claim atômico: se outro worker/processo já pegou, rowcount = 0
+        pegou = db.query(TarefaAgendada).filter(
+            TarefaAgendada.id == tarefa_id,
+            TarefaAgendada.status.in_(["pendente", "erro"]),
+            TarefaAgendada.executar_em <= datetime.utcnow()  # retry só depois do backoff
+        ).update({
+            TarefaAgendada.status: "processando",
+            TarefaAgendada.tentativas: func.coalesce(TarefaAgendada.tentativas, 0) + 1,
+            TarefaAgendada.reservado_em: datetime.utcnow(),
+        }, synchronize_session=False)
+        db.commit()
+        if not pegou:
+            return
+
+        tarefa = db.query(TarefaAgendada).filter(TarefaAgendada.id == tarefa_id).first()
+        bot_db = bot_registry.obter_por_id(tarefa.bot_id, db)
+
+        if bot_db:
+            bot_temp = bot_registry.cliente(bot_db.token)
+
+            # Auto-destruir a mensagem do passo anterior antes de seguir
+            if tarefa.apagar_message_id:
+                try: bot_temp.delete_message(tarefa.chat_id, tarefa.apagar_message_id)
+                except: pass
+
+            snap = flow_cache.obter(bot_db.id, db)
+            passo = snap.passo(tarefa.step_order) if tarefa.tipo == "passo" else None
+            if passo:
+                enviar_passo_automatico(bot_temp, tarefa.chat_id, passo, bot_db, db)
+            else:
+                # Tipo 'oferta' (ou o passo foi removido do fluxo nesse meio tempo)
+                enviar_oferta_final(bot_temp, tarefa.chat_id, snap.fluxo, bot_db.id, db)
+
+        db.query(TarefaAgendada).filter(TarefaAgendada.id == tarefa_id).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        try:
+            _reagendar_tarefa_com_erro(db, tarefa_id, e)
+        except Exception:
+            db.rollback()
+    finally:
+        db.close()
+
+def _reagendar_tarefa_com_erro(db: Session, tarefa_id: int, erro: Exception):
+    """Falhou (429, rede...): nova tentativa com backoff; esgotou = apaga."""
+    tarefa = db.query(TarefaAgendada).filter(
+        TarefaAgendada.id == tarefa_id, TarefaAgendada.status == "processando"
+    ).first()
+    if not tarefa:
+        return
+    tentativas = tarefa.tentativas or 0
+    if tentativas >= AGENDADOR_MAX_TENTATIVAS:
+        db.delete(tarefa)
+        db.commit()
+        logger.error(f"❌ [AGENDADOR] Tarefa {tarefa_id} descartada após {tentativas} tentativas: {erro}")
+        return
+
+    espera = AGENDADOR_BACKOFF_SEGUNDOS[min(tentativas, len(AGENDADOR_BACKOFF_SEGUNDOS)) - 1]
+    tarefa.status = "erro"
+    tarefa.executar_em = datetime.utcnow() + timedelta(seconds=espera)
+    db.commit()
+    fila_fluxo.agendar(tarefa.executar_em, tarefa_id)
+    logger.warning(f"⚠️ [AGENDADOR] Tarefa {tarefa_id} falhou (tentativa {tentativas}): {erro}. Nova tentativa em {espera}s")
+
+def agendar_continuacao_fluxo(db: Session, bot_temp, chat_id, passo, bot_db, sent_msg):
+    """
+    Passo sem botão: depois de delay_seconds segue para o próximo passo
+    (ou para a oferta final, se era o último), auto-destruindo a mensagem se configurado.
+    """
+    if passo.mostrar_botao:
+        return
+
+    snap = flow_cache.obter(bot_db.id, db)
+    proximo = snap.passo(passo.step_order + 1)
+    apagar_id = sent_msg.message_id if (passo.autodestruir and sent_msg) else None
+    atraso = passo.delay_seconds or 0
+
+    if atraso <= 0:
+        if apagar_id:
+            try: bot_temp.delete_message(chat_id, apagar_id)
+            except: pass
+        if proximo: enviar_passo_automatico(bot_temp, chat_id, proximo, bot_db, db)
+        else: enviar_oferta_final(bot_temp, chat_id, snap.fluxo, bot_db.id, db)
+        return
+
+    logger.info(f"⏰ [BOT {bot_db.id}] Passo {passo.step_order}: próximo agendado para daqui {atraso}s")
+    agendar_tarefa_fluxo(
+        db, bot_db.id, chat_id,
+        "passo" if proximo else "oferta", atraso,
+        step_order=proximo.step_order if proximo else None,
+        apagar_message_id=apagar_id
+    )
+
+def _liberar_tarefas_travadas(db: Session):
+    # Presas em 'processando' por um processo que morreu (pela hora do claim;
+    # linhas de antes da coluna reservado_em caem no executar_em)
+    limite = datetime.utcnow() - timedelta(minutes=AGENDADOR_TRAVADA_MINUTOS)
+    db.query(TarefaAgendada).filter(
+        TarefaAgendada.status == "processando",
+        func.coalesce(TarefaAgendada.reservado_em, TarefaAgendada.executar_em) < limite
+    ).update({TarefaAgendada.status: "erro"}, synchronize_session=False)
+    db.commit()
+
+def carregar_tarefas_pendentes():
+    """Joga no heap as tarefas pendentes do banco (startup)."""
+    db = SessionLocal()
+    try:
+        _liberar_tarefas_travadas(db)
+        pendentes = db.query(TarefaAgendada.id, TarefaAgendada.executar_em).filter(
+            TarefaAgendada.status.in_(["pendente", "erro"])
+        ).all()
+        for tarefa_id, executar_em in pendentes:
+            fila_fluxo.agendar(executar_em, tarefa_id)
+        return len(pendentes)
+    finally:
+        db.close()
+
+def _varredura_agendador():
+    # Pega tarefas criadas por outros processos, perdidas num restart ou
+    # abandonadas no meio por um worker que morreu
+    while True:
+        time.sleep(AGENDADOR_VARREDURA_SEGUNDOS)
+        db = SessionLocal()
+        try:
+            _liberar_tarefas_travadas(db)
+            atrasadas = db.query(TarefaAgendada.id).filter(
+                TarefaAgendada.status.in_(["pendente", "erro"]),
+                TarefaAgendada.executar_em <= datetime.utcnow() - timedelta(seconds=AGENDADOR_VARREDURA_SEGUNDOS)
+            ).all()
+            if atrasadas:
+                _despachar_tarefas_vencidas([t[0] for t in atrasadas])
+        except Exception as e:
+            logger.error(f"❌ [AGENDADOR] Erro na varredura: {e}")
+        finally:
+            db.close()
+
+def iniciar_agendador_fluxo():
+    total = carregar_tarefas_pendentes()
+    fila_fluxo.iniciar()
+    threading.Thread(target=_varredura_agendador, name="agendador-varredura", daemon=True).start()
+    logger.info(f"⏰ Agendador de fluxo iniciado ({total} tarefas pendentes recuperadas)")
+
+# =========================================================
+# 📊 ROLLUP DIÁRIO (daily_stats)
+# =========================================================
+# Dashboard, perfil e lista de bots leem faturamento/vendas/leads daqui em vez
+# de reagregar a tabela pedidos inteira. O rollup é atualizado na mesma
+# transação de quem muda o status do pedido ou cria o lead.
+# Para reconstruir o histórico: python backfill_daily_stats.py
+STATUS_RECEITA = ("approved", "paid", "active", "completed", "succeeded", "expired")
+
+def incrementar_daily_stats(db: Session, bot_id: int, quando: Optional[datetime], tracking_id: Optional[int] = None,
+                            revenue: float = 0.0, sales: int = 0, leads: int = 0):
+    """UPSERT somando no dia (não faz commit: entra na transação de quem chamou)."""
+    chave = {"bot_id": bot_id, "day": (quando or datetime.utcnow()).date(), "tracking_id": tracking_id or 0}
+    incrementos = {"revenue": revenue, "sales": sales, "leads": leads}
+
+    upsert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = upsert(DailyStat).values(**chave, **incrementos)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["bot_id", "day", "tracking_id"],
+        set_={campo: getattr(DailyStat, campo) + stmt.excluded[campo] for campo in incrementos}
+    )
+    db.execute(stmt)
+
+def contabilizar_status_pedido(db: Session, pedido: Pedido, status_anterior: Optional[str]):
+    """Chamar sempre que o status de um pedido mudar: entra/sai da receita do dia em que foi criado."""
+    antes = str(status_anterior or "").lower() in STATUS_RECEITA
+    depois = str(pedido.status or "").lower() in STATUS_RECEITA
+    if antes == depois:
+        return
+    sinal = 1 if depois else -1
+    incrementar_daily_stats(
+        db, pedido.bot_id, pedido.created_at, pedido.tracking_id,
+        revenue=sinal * (pedido.valor or 0.0), sales=sinal
+    )
+
+def contabilizar_novo_lead(db: Session, lead: Lead):
+    incrementar_daily_stats(db, lead.bot_id, datetime.utcnow(), lead.tracking_id, leads=1)
+
 # ============================================================
 # 👇 COLE TODAS AS 5 FUNÇÕES AQUI (DEPOIS DO get_db)
 # ============================================================
@@ -101,6 +891,7 @@ def criar_ou_atualizar_lead(
             tracking_id=tracking_id # 🔥 Salva a origem
         )
         db.add(lead)
+        contabilizar_novo_lead(db, lead)
     
     db.commit()
     db.refresh(lead)
@@ -222,349 +1013,807 @@ def registrar_remarketing(
         db.commit()
         logger.info(f"📧 Remarketing registrado (MEIO): {pedido.first_name}")
 
-    # 2. FORÇA A CRIAÇÃO DE TODAS AS COLUNAS FALTANTES (TODAS AS VERSÕES)
-    try:
-        with engine.connect() as conn:
-            logger.info("🔧 [STARTUP] Verificando integridade completa do banco...")
-            
-            comandos_sql = [
-                # --- [CORREÇÃO 1] TABELA DE PLANOS ---
-                "ALTER TABLE planos_config ADD COLUMN IF NOT EXISTS key_id VARCHAR;",
-                "ALTER TABLE planos_config ADD COLUMN IF NOT EXISTS descricao TEXT;",
-                "ALTER TABLE planos_config ADD COLUMN IF NOT EXISTS preco_cheio FLOAT;",
-
-                # --- [CORREÇÃO 2] TABELA DE PEDIDOS ---
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS plano_id INTEGER;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS plano_nome VARCHAR;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS txid VARCHAR;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS qr_code TEXT;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS transaction_id VARCHAR;", 
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS data_aprovacao TIMESTAMP WITHOUT TIME ZONE;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS data_expiracao TIMESTAMP WITHOUT TIME ZONE;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS custom_expiration TIMESTAMP WITHOUT TIME ZONE;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS link_acesso VARCHAR;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS mensagem_enviada BOOLEAN DEFAULT FALSE;",
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS tem_order_bump BOOLEAN DEFAULT FALSE;", 
-                "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS tracking_id INTEGER;",
-
-                # --- [CORREÇÃO 3] FLUXO DE MENSAGENS ---
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS autodestruir_1 BOOLEAN DEFAULT FALSE;",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS msg_2_texto TEXT;",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS msg_2_media VARCHAR;",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS mostrar_planos_2 BOOLEAN DEFAULT TRUE;",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS mostrar_planos_1 BOOLEAN DEFAULT FALSE;",
-                
-                # --- [CORREÇÃO 4] REMARKETING AVANÇADO ---
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS target VARCHAR DEFAULT 'todos';",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS type VARCHAR DEFAULT 'massivo';",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS plano_id INTEGER;",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS promo_price FLOAT;",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS expiration_at TIMESTAMP WITHOUT TIME ZONE;",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS dia_atual INTEGER DEFAULT 0;",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS data_inicio TIMESTAMP WITHOUT TIME ZONE DEFAULT now();",
-                "ALTER TABLE remarketing_campaigns ADD COLUMN IF NOT EXISTS proxima_execucao TIMESTAMP WITHOUT TIME ZONE;",
-                
-                # --- [CORREÇÃO 5] TABELA NOVA (FLOW V2) ---
-                """
-                CREATE TABLE IF NOT EXISTS bot_flow_steps (
-                    id SERIAL PRIMARY KEY,
-                    bot_id INTEGER REFERENCES bots(id),
-                    step_order INTEGER DEFAULT 1,
-                    msg_texto TEXT,
-                    msg_media VARCHAR,
-                    btn_texto VARCHAR DEFAULT 'Próximo ▶️',
-                    mostrar_botao BOOLEAN DEFAULT TRUE,
-                    autodestruir BOOLEAN DEFAULT FALSE,
-                    delay_seconds INTEGER DEFAULT 0,
-                    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
-                );
-                """,
-                
-                # --- [CORREÇÃO 6] SUPORTE NO BOT ---
-                "ALTER TABLE bots ADD COLUMN IF NOT EXISTS suporte_username VARCHAR;",
-
-                # --- [CORREÇÃO 7] TABELAS DE TRACKING ---
-                """
-                CREATE TABLE IF NOT EXISTS tracking_folders (
-                    id SERIAL PRIMARY KEY,
-                    nome VARCHAR,
-                    plataforma VARCHAR,
-                    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS tracking_links (
-                    id SERIAL PRIMARY KEY,
-                    folder_id INTEGER REFERENCES tracking_folders(id),
-                    bot_id INTEGER REFERENCES bots(id),
-                    nome VARCHAR,
-                    codigo VARCHAR UNIQUE,
-                    origem VARCHAR DEFAULT 'outros',
-                    clicks INTEGER DEFAULT 0,
-                    leads INTEGER DEFAULT 0,
-                    vendas INTEGER DEFAULT 0,
-                    faturamento FLOAT DEFAULT 0.0,
-                    created_at TIMESTAMP WITHOUT TIME ZONE DEFAULT now()
-                );
-                """,
-                "ALTER TABLE leads ADD COLUMN IF NOT EXISTS tracking_id INTEGER REFERENCES tracking_links(id);",
-
-                # --- [CORREÇÃO 8] 🔥 TABELAS DA LOJA (MINI APP) ---
-                """
-                CREATE TABLE IF NOT EXISTS miniapp_config (
-                    bot_id INTEGER PRIMARY KEY REFERENCES bots(id),
-                    logo_url VARCHAR,
-                    background_type VARCHAR DEFAULT 'solid',
-                    background_value VARCHAR DEFAULT '#000000',
-                    hero_video_url VARCHAR,
-                    hero_title VARCHAR DEFAULT 'ACERVO PREMIUM',
-                    hero_subtitle VARCHAR DEFAULT 'O maior acervo da internet.',
-                    hero_btn_text VARCHAR DEFAULT 'LIBERAR CONTEÚDO 🔓',
-                    enable_popup BOOLEAN DEFAULT FALSE,
-                    popup_video_url VARCHAR,
-                    popup_text VARCHAR DEFAULT 'VOCÊ GANHOU UM PRESENTE!',
-                    footer_text VARCHAR DEFAULT '© 2026 Premium Club.'
-                );
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS miniapp_categories (
-                    id SERIAL PRIMARY KEY,
-                    bot_id INTEGER REFERENCES bots(id),
-                    slug VARCHAR,
-                    title VARCHAR,
-                    description VARCHAR,
-                    cover_image VARCHAR,
-                    theme_color VARCHAR DEFAULT '#c333ff',
-                    deco_line_url VARCHAR,
-                    is_direct_checkout BOOLEAN DEFAULT FALSE,
-                    is_hacker_mode BOOLEAN DEFAULT FALSE,
-                    banner_desk_url VARCHAR,
-                    banner_mob_url VARCHAR,
-                    footer_banner_url VARCHAR,
-                    content_json TEXT
-                );
-                """,
-
-                # --- [CORREÇÃO 9] NOVAS COLUNAS PARA CATEGORIA RICA ---
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS bg_color VARCHAR DEFAULT '#000000';",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS banner_desk_url VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS video_preview_url VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS model_img_url VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS model_name VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS model_desc TEXT;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS footer_banner_url VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS deco_lines_url VARCHAR;",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS model_name_color VARCHAR DEFAULT '#ffffff';",
-                "ALTER TABLE miniapp_categories ADD COLUMN IF NOT EXISTS model_desc_color VARCHAR DEFAULT '#cccccc';",
-
-                # --- [CORREÇÃO 10] TOKEN PUSHINPAY E ORDER BUMP ---
-                "ALTER TABLE bots ADD COLUMN IF NOT EXISTS pushin_token VARCHAR;",
-                "ALTER TABLE order_bump_config ADD COLUMN IF NOT EXISTS autodestruir BOOLEAN DEFAULT FALSE;",
-
-                # 👇👇👇 [CORREÇÃO 11] SUPORTE A WEB APP NO FLUXO (CRÍTICO) 👇👇👇
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS start_mode VARCHAR DEFAULT 'padrao';",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS miniapp_url VARCHAR;",
-                "ALTER TABLE bot_flows ADD COLUMN IF NOT EXISTS miniapp_btn_text VARCHAR DEFAULT 'ABRIR LOJA 🛍️';"
-            ]
-            
-            for cmd in comandos_sql:
+# =========================================================
+# 👑 COORDENADOR DE JOBS (UM PROCESSO POR JOB)
+# =========================================================
+# Com `uvicorn --workers N` todo processo roda o on_startup. Job periódico
+# (Ceifador, pool de convites...) em todos os workers = kicks e avisos
+# duplicados. Cada job tem uma trava:
+# - Postgres: pg_try_advisory_lock numa conexão dedicada. Se o processo
+#   morre a conexão cai e a trava solta sozinha.
+# - SQLite: flock num arquivo ao lado do banco (o SO solta quando o
+#   processo morre).
+# Quem não pegou tenta de novo a cada COORDENADOR_INTERVALO_SEGUNDOS, então
+# outro worker assume o job em segundos se o líder cair. Os loops dos jobs
+# conferem coordenador_jobs.lider(nome) a cada ciclo.
+COORDENADOR_INTERVALO_SEGUNDOS = int(os.getenv("COORDENADOR_INTERVALO_SEGUNDOS", "15"))
+CLASSE_LOCK_JOBS = 7_202_602  # 1ª metade da chave do advisory lock (a 2ª vem do nome do job)
+
+class CoordenadorJobs:
+    def __init__(self, engine_app):
+        self.postgres = engine_app.dialect.name == "postgresql"
+        # Engine à parte, sem pool: as conexões que seguram travas não saem do pool do app
+        self._engine = create_engine(engine_app.url, poolclass=NullPool) if self.postgres else None
+        self._arquivo_base = engine_app.url.database or "sql_app.db"
+        self._jobs = {}          # nome -> função que inicia o job (uma vez por processo)
+        self._travas = {}        # nome -> conexão (Postgres) ou arquivo (SQLite) segurando a trava
+        self._iniciados = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def registrar(self, nome: str, iniciar):
+        self._jobs[nome] = iniciar
+
+    def lider(self, nome: str) -> bool:
+        with self._lock:
+            return nome in self._travas
+
+    def _tentar_travar(self, nome: str):
+        if self.postgres:
+            conn = self._engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            chave = zlib.crc32(nome.encode()) & 0x7FFFFFFF
+            try:
+                if conn.execute(text("SELECT pg_try_advisory_lock(:c, :k)"), {"c": CLASSE_LOCK_JOBS, "k": chave}).scalar():
+                    return conn
+            except Exception:
+                conn.close()
+                raise
+            conn.close()
+            return None
+
+        import fcntl
+        arquivo = open(f"{self._arquivo_base}.job-{nome}.lock", "w")
+        try:
+            fcntl.flock(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return arquivo
+        except OSError:
+            arquivo.close()
+            return None
+
+    def _ainda_lider(self, trava) -> bool:
+        if not self.postgres:
+            return True
+        try:
+            trava.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    def _ciclo(self):
+        for nome, iniciar in self._jobs.items():
+            with self._lock:
+                trava = self._travas.get(nome)
+            if trava is not None:
+                if not self._ainda_lider(trava):
+                    # Conexão caiu = o banco já soltou a trava; outro processo pode assumir
+                    logger.error(f"👑 [JOBS] Conexão da trava de '{nome}' caiu, liderança perdida.")
+                    with self._lock:
+                        self._travas.pop(nome, None)
+                    try: trava.close()
+                    except Exception: pass
+                continue
+
+            try:
+                trava = self._tentar_travar(nome)
+            except Exception as e:
+                logger.error(f"👑 [JOBS] Erro ao disputar '{nome}': {e}")
+                continue
+            if trava is None:
+                continue
+            with self._lock:
+                self._travas[nome] = trava
+            logger.info(f"👑 [JOBS] Processo {os.getpid()} assumiu o job '{nome}'")
+            if nome not in self._iniciados:
+                self._iniciados.add(nome)
                 try:
-                    conn.execute(text(cmd))
-                    conn.commit()
-                except Exception as e_sql:
-                    # Ignora erro se a coluna já existir (segurança para não parar o deploy)
-                    if "duplicate column" not in str(e_sql) and "already exists" not in str(e_sql):
-                        logger.warning(f"Aviso SQL: {e_sql}")
-            
-            logger.info("✅ [STARTUP] Banco de dados 100% Verificado!")
-            
-    except Exception as e:
-        logger.error(f"❌ Falha no reparo do banco: {e}")
+                    iniciar()
+                except Exception as e:
+                    logger.error(f"👑 [JOBS] Erro ao iniciar '{nome}': {e}")
 
-    # 3. Inicia o Agendador (Scheduler)
-    try:
-        # Se você usa scheduler, inicia aqui
-        if 'scheduler' in globals():
-            scheduler.add_job(verificar_vencimentos, 'interval', hours=12)
-            scheduler.add_job(executar_remarketing, 'interval', minutes=30) 
-            scheduler.start()
-            logger.info("⏰ [STARTUP] Agendador de tarefas iniciado.")
-    except Exception as e:
-        logger.error(f"❌ [STARTUP] Erro no Scheduler: {e}")
+    def _loop(self):
+        while True:
+            self._ciclo()
+            time.sleep(COORDENADOR_INTERVALO_SEGUNDOS)
 
-    # 3. Inicia o Ceifador
-    thread = threading.Thread(target=loop_verificar_vencimentos)
-    thread.daemon = True
-    thread.start()
-    logger.info("💀 O Ceifador (Auto-Kick) foi iniciado!")
+    def iniciar(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._loop, name="coordenador-jobs", daemon=True)
+        self._thread.start()
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {"pid": os.getpid(), "jobs": {nome: nome in self._travas for nome in self._jobs}}
+
+coordenador_jobs = CoordenadorJobs(engine)
 
 # =========================================================
-# 💀 O CEIFADOR: VERIFICA VENCIMENTOS E REMOVE (KICK SUAVE)
+# 💀 O CEIFADOR: MOTOR DE VENCIMENTOS (HEAP)
 # =========================================================
-def loop_verificar_vencimentos():
-    """Roda a cada 60 minutos para remover usuários vencidos"""
+# Antes: varredura de todos os pedidos pagos de todos os bots a cada 1 hora
+# (kick até 1h atrasado e custo cheio mesmo sem ninguém vencendo).
+# Agora os vencimentos das próximas VENCIMENTOS_HORIZONTE_HORAS ficam num heap
+# (FilaDeTempo) e a thread dorme até o próximo. O webhook de pagamento e o
+# update_user agendam na hora; a recarga periódica (faixa em custom_expiration
+# dos pedidos ativos + faixa em expires_at da tabela subscriptions, dois
+# índices parciais) traz a janela seguinte e pega o que foi alterado por fora
+# (outro worker, SQL manual).
+VENCIMENTOS_HORIZONTE_HORAS = int(os.getenv("VENCIMENTOS_HORIZONTE_HORAS", "6"))
+VENCIMENTOS_RECARGA_MINUTOS = int(os.getenv("VENCIMENTOS_RECARGA_MINUTOS", "30"))
+VENCIMENTOS_LOTE = 200
+# Status de pedido que dá acesso e portanto vence (PIX do bot liquida como
+# 'approved', o checkout do site como 'paid')
+STATUS_EXPIRAVEIS = ("paid", "approved")
+# Kicks em paralelo (vários bots ao mesmo tempo); o telegram_dispatcher
+# continua segurando o limite de cada bot
+CEIFADOR_PARALELISMO = int(os.getenv("CEIFADOR_PARALELISMO", "16"))
+CEIFADOR_KICKS_POR_TAREFA = 25
+
+ceifador_executor = ThreadPoolExecutor(max_workers=CEIFADOR_PARALELISMO, thread_name_prefix="ceifador")
+_vencimentos_agendados = {}  # pedido_id -> quando (a recarga não duplica o que já está no heap)
+_vencimentos_lock = threading.Lock()
+
+def _vencimentos_venceram(pedido_ids):
+    agora = datetime.utcnow()
+    with _vencimentos_lock:
+        for pedido_id in pedido_ids:
+            # Item antigo de um pedido reagendado para depois não apaga o agendamento novo
+            if _vencimentos_agendados.get(pedido_id, agora) <= agora:
+                _vencimentos_agendados.pop(pedido_id, None)
+    ids = list(dict.fromkeys(pedido_ids))
+    for i in range(0, len(ids), VENCIMENTOS_LOTE):
+        try:
+            ceifar_pedidos(ids[i:i + VENCIMENTOS_LOTE])
+        except Exception as e:
+            logger.error(f"❌ [CEIFADOR] Erro no lote de vencimentos: {e}")
+
+fila_vencimentos = FilaDeTempo("motor-vencimentos", _vencimentos_venceram)
+
+def agendar_vencimento(pedido_id: Optional[int], quando: Optional[datetime]):
+    """Coloca o vencimento no heap (se cair dentro do horizonte; o resto vem na recarga)."""
+    if not pedido_id or not isinstance(quando, datetime):
+        return
+    if quando > datetime.utcnow() + timedelta(hours=VENCIMENTOS_HORIZONTE_HORAS):
+        return
+    with _vencimentos_lock:
+        if _vencimentos_agendados.get(pedido_id) == quando:
+            return
+        _vencimentos_agendados[pedido_id] = quando
+    fila_vencimentos.agendar(quando, pedido_id)
+
+def recarregar_vencimentos() -> int:
+    limite = datetime.utcnow() + timedelta(hours=VENCIMENTOS_HORIZONTE_HORAS)
+    db = SessionLocal()
+    try:
+        # Pedidos ativos vencendo (inclusive os substituídos por uma renovação,
+        # que precisam virar expired) + o pedido de origem de cada assinatura
+        proximos = db.execute(union(
+            select(Pedido.id, Pedido.custom_expiration).where(
+                Pedido.status.in_(STATUS_EXPIRAVEIS),
+                Pedido.custom_expiration.isnot(None),
+                Pedido.custom_expiration <= limite
+            ),
+            select(Assinatura.source_pedido_id, Assinatura.expires_at).where(
+                Assinatura.expires_at.isnot(None),
+                Assinatura.expires_at <= limite
+            ),
+        )).all()
+    finally:
+        db.close()
+    for pedido_id, quando in proximos:
+        agendar_vencimento(pedido_id, quando)
+    return len(proximos)
+
+def _loop_recarga_vencimentos():
     while True:
+        time.sleep(VENCIMENTOS_RECARGA_MINUTOS * 60)
+        if not coordenador_jobs.lider("ceifador"):
+            continue
         try:
-            logger.info("⏳ Verificando assinaturas vencidas...")
-            verificar_expiracao_massa()
+            recarregar_vencimentos()
         except Exception as e:
-            logger.error(f"Erro no loop de vencimento: {e}")
-        
-        time.sleep(3600) # Espera 1 hora (3600 segundos)
+            logger.error(f"❌ [CEIFADOR] Erro ao recarregar vencimentos: {e}")
+
+def iniciar_motor_vencimentos():
+    total = recarregar_vencimentos()
+    fila_vencimentos.iniciar()
+    threading.Thread(target=_loop_recarga_vencimentos, name="vencimentos-recarga", daemon=True).start()
+    logger.info(f"💀 O Ceifador (Auto-Kick) foi iniciado! ({total} vencimentos nas próximas {VENCIMENTOS_HORIZONTE_HORAS}h)")
+
+# A recarga (e a carga inicial) roda num processo só. Os vencimentos que o
+# webhook/update_user agendam ficam no heap do worker que os recebeu: o claim
+# -> expired do ceifar_pedidos impede kick duplicado entre processos.
+coordenador_jobs.registrar("ceifador", iniciar_motor_vencimentos)
 
 # =========================================================
 # 💀 O CEIFADOR: REMOVEDOR BASEADO EM DATA (SAAS)
 # =========================================================
-def verificar_expiracao_massa():
+def _admins_do_bot(bot_data) -> set:
+    # Snapshot do registro já traz principal + extras (BotAdmin): zero consulta por usuário
+    admins = set(bot_data.admin_ids)
+    if bot_data.admin_principal_id:
+        admins.add(str(bot_data.admin_principal_id).strip())
+    return admins
+
+def ceifar_pedidos(pedido_ids):
+    """
+    Encerra as assinaturas vencidas do lote, marca os pedidos como expirados
+    (UM UPDATE ... RETURNING) e distribui os kicks por bot no ceifador_executor.
+    Admins do bot e quem ainda tem assinatura por outro pedido ficam de fora.
+    """
     db = SessionLocal()
     try:
-        # Pega todos os bots do sistema
-        bots = db.query(Bot).all()
-        
-        for bot_data in bots:
-            if not bot_data.token or not bot_data.id_canal_vip: continue
-            
+        # O heap pode estar desatualizado (renovou, virou vitalício): o banco decide
+        agora = datetime.utcnow()
+        db.query(Assinatura).filter(
+            Assinatura.source_pedido_id.in_(pedido_ids),
+            Assinatura.expires_at.isnot(None),
+            Assinatura.expires_at <= agora
+        ).delete(synchronize_session=False)
+
+        vencidos = db.query(Pedido.id, Pedido.bot_id, Pedido.telegram_id, Pedido.first_name).filter(
+            Pedido.id.in_(pedido_ids),
+            Pedido.status.in_(STATUS_EXPIRAVEIS),
+            Pedido.custom_expiration != None,
+            Pedido.custom_expiration <= agora
+        ).all()
+
+        # Renovou por outro pedido: este vira expired, mas o usuário fica no canal
+        pares = list({(u.bot_id, str(u.telegram_id)) for u in vencidos})
+        renovados = set(db.query(Assinatura.bot_id, Assinatura.telegram_id).filter(
+            tuple_(Assinatura.bot_id, Assinatura.telegram_id).in_(pares),
+            Assinatura.expires_at.is_(None) | (Assinatura.expires_at > agora)
+        ).all()) if pares else set()
+
+        por_bot, bots, admins = {}, {}, {}
+        for u in vencidos:
+            if u.bot_id not in bots:
+                bots[u.bot_id] = bot_registry.obter_por_id(u.bot_id, db)
+                admins[u.bot_id] = _admins_do_bot(bots[u.bot_id]) if bots[u.bot_id] else set()
+            # 🔥 Proteção: admin do bot não é removido
+            if str(u.telegram_id).strip() in admins[u.bot_id]:
+                logger.info(f"⏭️ Pulando admin: {u.telegram_id}")
+                continue
+            por_bot.setdefault(u.bot_id, []).append(u)
+
+        ids = [u.id for lista in por_bot.values() for u in lista]
+        if not ids:
+            db.commit()
+            return
+        # Claim em massa: só quem troca paid/approved -> expired faz o kick e manda o aviso
+        pedidos = Pedido.__table__
+        ganhos = set(db.execute(
+            pedidos.update()
+            .where(pedidos.c.id.in_(ids), pedidos.c.status.in_(STATUS_EXPIRAVEIS))
+            .values(status='expired')
+            .returning(pedidos.c.id)
+        ).scalars().all())
+        db.commit()
+    finally:
+        db.close()
+
+    for bot_id, lista in por_bot.items():
+        lista = [u for u in lista if u.id in ganhos and (bot_id, str(u.telegram_id)) not in renovados]
+        bot_data = bots[bot_id]
+        if not lista or not bot_data or not bot_data.token or not bot_data.id_canal_vip:
+            continue
+        for i in range(0, len(lista), CEIFADOR_KICKS_POR_TAREFA):
+            ceifador_executor.submit(_expulsar_vencidos, bot_data, lista[i:i + CEIFADOR_KICKS_POR_TAREFA])
+    logger.info(f"💀 [CEIFADOR] {len(ganhos)} vencidos em {len(por_bot)} bots")
+
+def _expulsar_vencidos(bot_data, vencidos):
+    # Cliente reaproveitado do registro (chamadas limitadas pelo dispatcher)
+    tb = bot_registry.cliente(bot_data.token)
+    canal_id = canal_vip_id(bot_data)
+    for u in vencidos:
+        try:
+            logger.info(f"💀 Ceifando usuário vencido: {u.first_name} (Bot: {bot_data.nome})")
+
+            # 1. Kick Suave (Ban + Unban)
+            tb.ban_chat_member(canal_id, int(u.telegram_id))
+            tb.unban_chat_member(canal_id, int(u.telegram_id))
+
+            # 2. Avisa o defunto
             try:
-                # Conecta no Telegram deste bot específico
-                tb = telebot.TeleBot(bot_data.token)
-                
-                # Tratamento do ID do canal
-                try: canal_id = int(str(bot_data.id_canal_vip).strip())
-                except: canal_id = bot_data.id_canal_vip
-                
-                agora = datetime.utcnow()
-                
-                # --- QUERY INTELIGENTE ---
-                # Busca usuários deste bot que:
-                # 1. Estão com status 'paid' (Ativos)
-                # 2. Têm uma data de expiração definida (NÃO SÃO VITALÍCIOS)
-                # 3. A data de expiração é MENOR que agora (Já venceu)
-                vencidos = db.query(Pedido).filter(
-                    Pedido.bot_id == bot_data.id,
-                    Pedido.status == 'paid',
-                    Pedido.custom_expiration != None, 
-                    Pedido.custom_expiration < agora
-                ).all()
-                
-                for u in vencidos:
-                    # 🔥 [CORRIGIDO] Proteção: Se for admin, não remove
-                    # Verificar se é admin através da tabela BotAdmin
-                    admin = db.query(BotAdmin).filter(
-                        BotAdmin.telegram_id == u.telegram_id,
-                        BotAdmin.bot_id == u.bot_id
-                    ).first()
-                    
-                    if admin:
-                        logger.info(f"⏭️ Pulando admin: {u.telegram_id}")
+                tb.send_message(int(u.telegram_id), "🚫 <b>Seu plano venceu!</b>\n\nSeu tempo acabou. Para renovar, digite /start", parse_mode="HTML")
+            except: pass
+
+        except Exception as e_kick:
+            # Se der erro (ex: user já saiu), fica como expired para não tentar eternamente
+            logger.error(f"Erro ao remover {u.telegram_id}: {e_kick}")
+
+# =========================================================
+# ⏰ LEMBRETES DE RENOVAÇÃO (ANTES DO CEIFADOR)
+# =========================================================
+# O cliente só ficava sabendo do vencimento depois do kick. Agora, a cada
+# LEMBRETES_INTERVALO_MINUTOS, um INSERT ... SELECT por janela reserva em
+# lembretes_renovacao os pedidos pagos que vencem em até 3 dias / 1 dia
+# (range em custom_expiration, mesmo índice parcial do Ceifador) e só quem
+# foi reservado recebe a mensagem com o botão checkout_ do plano. Nenhuma
+# consulta por linha: o banco devolve o lote devido já sem os repetidos.
+LEMBRETES_INTERVALO_MINUTOS = int(os.getenv("LEMBRETES_INTERVALO_MINUTOS", "15"))
+LEMBRETES_LOTE = int(os.getenv("LEMBRETES_LOTE", "500"))
+LEMBRETES_PARALELISMO = int(os.getenv("LEMBRETES_PARALELISMO", "8"))
+LEMBRETES_POR_TAREFA = 50
+# (tipo, antecedência): '3d' cobre de 3 dias até 1 dia antes; '1d' o último dia
+LEMBRETES_JANELAS = (("3d", timedelta(days=3)), ("1d", timedelta(days=1)))
+
+lembretes_executor = ThreadPoolExecutor(max_workers=LEMBRETES_PARALELISMO, thread_name_prefix="lembretes")
+
+def _reservar_lembretes(db: Session, tipo: str, inicio: datetime, fim: datetime, agora: datetime) -> list:
+    """
+    Reserva (INSERT ... SELECT ... ON CONFLICT DO NOTHING RETURNING) até
+    LEMBRETES_LOTE pedidos pagos com vencimento em (inicio, fim]. Pula quem
+    já tem lembrete desse tipo para esse vencimento, quem já renovou (outro
+    pedido ativo no mesmo bot vencendo depois, ou vitalício) e quem pagou já
+    dentro da janela (plano de 1/3 dias não recebe "renove" logo após pagar).
+    """
+    pedidos = Pedido.__table__
+    lembretes = LembreteRenovacao.__table__
+    outro = pedidos.alias("outro")
+
+    antecedencia = dict(LEMBRETES_JANELAS)[tipo]
+    if db.bind.dialect.name == "postgresql":
+        abertura_janela = pedidos.c.custom_expiration - antecedencia
+    else:
+        abertura_janela = func.datetime(pedidos.c.custom_expiration, f"-{int(antecedencia.total_seconds())} seconds")
+    pago_em = func.coalesce(pedidos.c.pagou_em, pedidos.c.data_aprovacao, pedidos.c.created_at)
+
+    ja_lembrado = exists().where(
+        lembretes.c.pedido_id == pedidos.c.id,
+        lembretes.c.tipo == tipo,
+        lembretes.c.vencimento == pedidos.c.custom_expiration,
+    )
+    ja_renovou = exists().where(
+        outro.c.bot_id == pedidos.c.bot_id,
+        outro.c.telegram_id == pedidos.c.telegram_id,
+        outro.c.status.in_(STATUS_EXPIRAVEIS),
+        outro.c.id != pedidos.c.id,
+        outro.c.custom_expiration.is_(None) | (outro.c.custom_expiration > pedidos.c.custom_expiration),
+    )
+    devidos = select(
+        pedidos.c.id, pedidos.c.bot_id, literal(tipo), pedidos.c.custom_expiration,
+        literal("reservado"), literal(agora, DateTime),
+    ).where(
+        pedidos.c.status.in_(STATUS_EXPIRAVEIS),
+        pedidos.c.custom_expiration.isnot(None),
+        pedidos.c.custom_expiration > inicio,
+        pedidos.c.custom_expiration <= fim,
+        pago_em < abertura_janela,
+        ~ja_lembrado,
+        ~ja_renovou,
+    ).order_by(pedidos.c.custom_expiration).limit(LEMBRETES_LOTE)
+
+    upsert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    reservados = db.execute(
+        upsert(lembretes).from_select(
+            ["pedido_id", "bot_id", "tipo", "vencimento", "status", "created_at"], devidos
+        ).on_conflict_do_nothing(
+            index_elements=["pedido_id", "tipo", "vencimento"]
+        ).returning(lembretes.c.id, lembretes.c.pedido_id)
+    ).all()
+    db.commit()
+    if not reservados:
+        return []
+
+    por_pedido = {pedido_id: lembrete_id for lembrete_id, pedido_id in reservados}
+    return [
+        (por_pedido[p.id], p) for p in db.query(
+            Pedido.id, Pedido.bot_id, Pedido.telegram_id, Pedido.first_name,
+            Pedido.plano_id, Pedido.plano_nome, Pedido.custom_expiration
+        ).filter(Pedido.id.in_(list(por_pedido))).all()
+    ]
+
+def _texto_lembrete(tipo: str, p, agora: datetime) -> str:
+    if tipo == "1d":
+        prazo = "expira em <b>1 dia</b>"
+    else:
+        dias = max(2, -(-(p.custom_expiration - agora) // timedelta(days=1)))
+        prazo = f"expira em <b>{dias} dias</b>"
+    plano = f" <b>{p.plano_nome}</b>" if p.plano_nome else ""
+    return (
+        f"⏰ <b>Olá {p.first_name or ''}!</b>\n\n"
+        f"Seu acesso{plano} {prazo} ({p.custom_expiration.strftime('%d/%m/%Y')}).\n\n"
+        f"Renove agora para não perder o acesso ao VIP 👇"
+    )
+
+def _enviar_lembretes(bot_data, tipo: str, lote: list):
+    # Cliente do registro: os envios passam pelo rate limiter do telegram_dispatcher
+    tb = bot_registry.cliente(bot_data.token)
+    planos = flow_cache.obter(bot_data.id)
+    agora = datetime.utcnow()
+    enviados, erros = [], []
+    for lembrete_id, p in lote:
+        try:
+            markup = None
+            plano = planos.plano(p.plano_id)
+            texto = _texto_lembrete(tipo, p, agora)
+            if plano:
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton("🔄 RENOVAR AGORA", callback_data=f"checkout_{plano.id}"))
+            else:
+                texto += "\n\nPara renovar, digite /start"
+            tb.send_message(int(p.telegram_id), texto, reply_markup=markup, parse_mode="HTML")
+            enviados.append(lembrete_id)
+        except Exception as e:
+            # Bloqueou o bot / apagou a conta: não tenta de novo (a reserva já impede)
+            logger.warning(f"⚠️ [LEMBRETES] Falha ao lembrar {p.telegram_id} (Bot {bot_data.id}): {e}")
+            erros.append(lembrete_id)
+
+    db = SessionLocal()
+    try:
+        for ids, status in ((enviados, "enviado"), (erros, "erro")):
+            if ids:
+                db.query(LembreteRenovacao).filter(LembreteRenovacao.id.in_(ids)).update(
+                    {LembreteRenovacao.status: status, LembreteRenovacao.enviado_em: datetime.utcnow()},
+                    synchronize_session=False
+                )
+        db.commit()
+    finally:
+        db.close()
+
+def processar_lembretes_renovacao() -> dict:
+    agora = datetime.utcnow()
+    contagem = {tipo: 0 for tipo, _ in LEMBRETES_JANELAS}
+    db = SessionLocal()
+    try:
+        # Janelas disjuntas: quem ficou sem o de 3 dias (servidor fora) recebe só o de 1 dia
+        fim_anterior = agora
+        janelas = []
+        for tipo, antecedencia in sorted(LEMBRETES_JANELAS, key=lambda j: j[1]):
+            janelas.append((tipo, fim_anterior, agora + antecedencia))
+            fim_anterior = agora + antecedencia
+
+        for tipo, inicio, fim in janelas:
+            while True:
+                lote = _reservar_lembretes(db, tipo, inicio, fim, agora)
+                if not lote:
+                    break
+                contagem[tipo] += len(lote)
+
+                por_bot, ignorados = {}, []
+                for lembrete_id, p in lote:
+                    por_bot.setdefault(p.bot_id, []).append((lembrete_id, p))
+                for bot_id, itens in por_bot.items():
+                    bot_data = bot_registry.obter_por_id(bot_id, db)
+                    if not bot_data or not bot_data.token:
+                        ignorados.extend(l_id for l_id, _ in itens)
                         continue
-                    
-                    try:
-                        logger.info(f"💀 Ceifando usuário vencido: {u.first_name} (Bot: {bot_data.nome})")
-                        
-                        # 1. Kick Suave (Ban + Unban)
-                        tb.ban_chat_member(canal_id, int(u.telegram_id))
-                        tb.unban_chat_member(canal_id, int(u.telegram_id))
-                        
-                        # 2. Atualiza Status no Banco
-                        u.status = 'expired'
-                        db.commit()
-                        
-                        # 3. Avisa o defunto
-                        try: 
-                            tb.send_message(int(u.telegram_id), "🚫 <b>Seu plano venceu!</b>\n\nSeu tempo acabou. Para renovar, digite /start", parse_mode="HTML")
-                        except: pass
-                        
-                    except Exception as e_kick:
-                        logger.error(f"Erro ao remover {u.telegram_id}: {e_kick}")
-                        # Se der erro (ex: user já saiu), marca como expired para não ficar tentando eternamente
-                        u.status = 'expired'
-                        db.commit()
-                        
-            except Exception as e_bot:
-                logger.error(f"Erro ao processar bot {bot_data.id}: {e_bot}")
-                
-    finally: 
+                    # Admin não vence de verdade (o Ceifador pula): não recebe lembrete
+                    admins = _admins_do_bot(bot_data)
+                    ignorados.extend(l_id for l_id, p in itens if str(p.telegram_id).strip() in admins)
+                    itens = [(l_id, p) for l_id, p in itens if str(p.telegram_id).strip() not in admins]
+                    for i in range(0, len(itens), LEMBRETES_POR_TAREFA):
+                        lembretes_executor.submit(_enviar_lembretes, bot_data, tipo, itens[i:i + LEMBRETES_POR_TAREFA])
+
+                if ignorados:
+                    db.query(LembreteRenovacao).filter(LembreteRenovacao.id.in_(ignorados)).update(
+                        {LembreteRenovacao.status: "ignorado"}, synchronize_session=False
+                    )
+                    db.commit()
+                if len(lote) < LEMBRETES_LOTE:
+                    break
+    finally:
         db.close()
+    if any(contagem.values()):
+        logger.info(f"⏰ [LEMBRETES] Reservados: {contagem}")
+    return contagem
+
+def _loop_lembretes_renovacao():
+    while True:
+        if coordenador_jobs.lider("lembretes-renovacao"):
+            try:
+                processar_lembretes_renovacao()
+            except Exception as e:
+                logger.error(f"❌ [LEMBRETES] Erro no ciclo de lembretes: {e}")
+        time.sleep(LEMBRETES_INTERVALO_MINUTOS * 60)
+
+def iniciar_lembretes_renovacao():
+    threading.Thread(target=_loop_lembretes_renovacao, name="lembretes-renovacao", daemon=True).start()
+    logger.info(f"⏰ Lembretes de renovação iniciados (a cada {LEMBRETES_INTERVALO_MINUTOS} min)")
+
+coordenador_jobs.registrar("lembretes-renovacao", iniciar_lembretes_renovacao)
 
 # =========================================================
-# 🔌 INTEGRAÇÃO PUSHIN PAY (DINÂMICA)
+# 🔌 INTEGRAÇÃO PUSHIN PAY (CLIENTE POOLED + CIRCUIT BREAKER)
 # =========================================================
+# Um único requests.Session (conexões keep-alive reaproveitadas) para todas
+# as cobranças, com timeout de conexão/leitura curto. Se o gateway começa a
+# falhar em sequência (timeout, 5xx, 429) o circuito ABRE: durante a pausa
+# as cobranças falham na hora, sem prender a thread do webhook esperando
+# um gateway fora do ar, e o cliente recebe um aviso para tentar de novo.
+# Depois da pausa UMA chamada de teste decide se o circuito fecha.
+PUSHINPAY_API_URL = os.getenv("PUSHINPAY_API_URL", "https://api.pushinpay.com.br").rstrip("/")
+PUSHINPAY_TIMEOUT = (
+    float(os.getenv("PUSHINPAY_TIMEOUT_CONEXAO", "3")),
+    float(os.getenv("PUSHINPAY_TIMEOUT_LEITURA", "8")),
+)
+PUSHINPAY_POOL = int(os.getenv("PUSHINPAY_POOL", "20"))
+PUSHINPAY_FALHAS_PARA_ABRIR = int(os.getenv("PUSHINPAY_FALHAS_PARA_ABRIR", "5"))
+PUSHINPAY_PAUSA_SEGUNDOS = int(os.getenv("PUSHINPAY_PAUSA_SEGUNDOS", "30"))
+PUSHIN_TOKEN_TTL = int(os.getenv("PUSHIN_TOKEN_TTL", "60"))
+
+MSG_PIX_INDISPONIVEL = "⚠️ O sistema de pagamento está instável no momento. Tente novamente em alguns instantes."
+
+def url_webhook_pix():
+    domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "zenyx-gbs-testes-production.up.railway.app")
+    if domain.startswith("https://"): domain = domain.replace("https://", "")
+    return f"https://{domain}/webhook/pix"
+
+class ClientePushinPay:
+    def __init__(self, url_base: str):
+        self.url_base = url_base
+        self.sessao = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=PUSHINPAY_POOL, max_retries=0)
+        self.sessao.mount("https://", adaptador)
+        self.sessao.mount("http://", adaptador)
+        self.sessao.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+        self._lock = threading.Lock()
+        self._falhas = 0
+        self._aberto_ate = 0.0
+        self._testando = False
+
+    def aberto(self) -> bool:
+        with self._lock:
+            return self._aberto_ate > time.monotonic() or self._testando
+
+    def _liberar_chamada(self) -> bool:
+        with self._lock:
+            if self._aberto_ate == 0.0:
+                return True
+            if self._aberto_ate > time.monotonic() or self._testando:
+                return False
+            self._testando = True  # meio-aberto: só esta chamada passa
+            return True
+
+    def _registrar(self, sucesso: bool):
+        with self._lock:
+            era_teste, self._testando = self._testando, False
+            if sucesso:
+                if self._aberto_ate:
+                    logger.info("✅ [PUSHINPAY] Gateway respondeu, circuito fechado.")
+                self._falhas = 0
+                self._aberto_ate = 0.0
+                return
+            self._falhas += 1
+            # Abre na N-ésima falha seguida ou quando a chamada de teste falha
+            # (falhas de chamadas que já estavam em voo não estendem a pausa)
+            if era_teste or (not self._aberto_ate and self._falhas >= PUSHINPAY_FALHAS_PARA_ABRIR):
+                self._aberto_ate = time.monotonic() + PUSHINPAY_PAUSA_SEGUNDOS
+                logger.error(f"🚨 [PUSHINPAY] {self._falhas} falhas seguidas, circuito aberto por {PUSHINPAY_PAUSA_SEGUNDOS}s.")
+
+    def criar_cobranca(self, token: str, valor_float: float, external_reference: str) -> Optional[dict]:
+        """POST /api/pix/cashIn. Devolve o JSON da cobrança ou None (erro / circuito aberto)."""
+        if not self._liberar_chamada():
+            logger.warning("⚡ [PUSHINPAY] Circuito aberto, cobrança recusada sem chamar o gateway.")
+            return None
+        payload = {
+            "value": int(round(valor_float * 100)),
+            "webhook_url": url_webhook_pix(),
+            "external_reference": external_reference,
+        }
+        try:
+            resposta = self.sessao.post(
+                f"{self.url_base}/api/pix/cashIn", json=payload,
+                headers={"Authorization": f"Bearer {token}"}, timeout=PUSHINPAY_TIMEOUT
+            )
+        except requests.RequestException as e:
+            logger.error(f"Exceção PushinPay: {e}")
+            self._registrar(False)
+            return None
+
+        if resposta.status_code in (200, 201):
+            self._registrar(True)
+            return resposta.json()
+        logger.error(f"Erro PushinPay ({resposta.status_code}): {resposta.text[:300]}")
+        # 4xx (token inválido, valor mínimo...) é problema do pedido, não do gateway
+        self._registrar(resposta.status_code < 500 and resposta.status_code != 429)
+        return None
+
+pushinpay = ClientePushinPay(PUSHINPAY_API_URL)
+
+_token_global = {"valor": None, "expira": 0.0}
+_token_global_lock = threading.Lock()
+
 def get_pushin_token():
-    """Busca o token no banco, se não achar, tenta variável de ambiente"""
+    """Token global: SystemConfig (Painel de Integrações) ou variável de ambiente, em cache pelo TTL."""
+    with _token_global_lock:
+        if _token_global["expira"] > time.monotonic():
+            return _token_global["valor"]
     db = SessionLocal()
     try:
-        # Tenta pegar do banco de dados (Painel de Integrações)
         config = db.query(SystemConfig).filter(SystemConfig.key == "pushin_pay_token").first()
-        if config and config.value:
-            return config.value
-        # Se não tiver no banco, pega do Railway Variables
-        return os.getenv("PUSHIN_PAY_TOKEN")
+        valor = config.value if (config and config.value) else os.getenv("PUSHIN_PAY_TOKEN")
     finally:
         db.close()
+    if valor:
+        # Sem token não entra no cache: o primeiro PIX depois de configurar já enxerga
+        with _token_global_lock:
+            _token_global["valor"] = valor
+            _token_global["expira"] = time.monotonic() + PUSHIN_TOKEN_TTL
+    return valor
+
+def invalidar_pushin_token():
+    """Chamar sempre que o token for salvo pelo painel."""
+    with _token_global_lock:
+        _token_global["valor"] = None
+        _token_global["expira"] = 0.0
+
+def resolver_token_pushin(bot_id: Optional[int] = None):
+    """Bot.pushin_token (snapshot do registro) → SystemConfig → env."""
+    if bot_id:
+        snap = bot_registry.obter_por_id(bot_id)
+        if snap and snap.pushin_token:
+            return snap.pushin_token
+    return get_pushin_token()
+
+def gerar_pix_pushinpay(valor_float: float, transaction_id: str, bot_id: Optional[int] = None):
+    token = resolver_token_pushin(bot_id)
 
-# =========================================================
-# 🔌 INTEGRAÇÃO PUSHIN PAY (CORRIGIDA)
-# =========================================================
-def gerar_pix_pushinpay(valor_float: float, transaction_id: str):
-    token = get_pushin_token()
-    
     if not token:
         logger.error("❌ Token Pushin Pay não configurado!")
         return None
-    
-    url = "https://api.pushinpay.com.br/api/pix/cashIn"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    # URL DO RAILWAY FIXA (Garante que o Webhook chegue)
-    seus_dominio = "zenyx-gbs-testes-production.up.railway.app" 
-    
-    payload = {
-        "value": int(valor_float * 100), 
-        "webhook_url": f"https://{seus_dominio}/webhook/pix",
-        "external_reference": transaction_id
-    }
 
-    try:
-        logger.info(f"📤 Gerando PIX. Webhook definido para: https://{seus_dominio}/webhook/pix")
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        
-        if response.status_code in [200, 201]:
-            return response.json()
-        else:
-            logger.error(f"Erro PushinPay: {response.text}")
-            return None
-    except Exception as e:
-        logger.error(f"Exceção PushinPay: {e}")
-        return None
+    return pushinpay.criar_cobranca(token, valor_float, transaction_id)
+
+def aviso_falha_pix() -> str:
+    return MSG_PIX_INDISPONIVEL if pushinpay.aberto() else "❌ Erro ao gerar PIX."
+
+# =========================================================
+# 🧾 PIX DO CHECKOUT IDEMPOTENTE (ABSORVE CLIQUE DUPLO)
+# =========================================================
+# Cliente tocando várias vezes em checkout_/bump_/promo_ gerava uma cobrança
+# na PushinPay e um pedido pendente NOVO por toque. Dentro da janela, o mesmo
+# pedido (bot, chat, plano, bump, preço) ainda pendente é reaproveitado e o
+# QR existente é reenviado. O cache em memória resolve o caso comum sem
+# consultar o banco; a busca no índice (bot, telegram_id, status, created_at)
+# cobre toques que caem em outro worker ou depois de um restart.
+# O lock só cobre a reserva: o pedido pendente (ainda sem QR, chave única
+# em payment_ref) é gravado e a cobrança na PushinPay roda fora do lock.
+# Toques que encontram a reserva esperam o QR dela no banco.
+PIX_REAPROVEITAR_SEGUNDOS = int(os.getenv("PIX_REAPROVEITAR_SEGUNDOS", "180"))
+# Tempo máximo de uma cobrança em andamento (timeouts do cliente + folga)
+PIX_AGUARDAR_SEGUNDOS = sum(PUSHINPAY_TIMEOUT) + 2
+
+_pix_recentes = {}  # chave -> (pedido_id, expira_em)
+_pix_recentes_lock = threading.Lock()
+# Locks por chave (listrados), segurados só durante a reserva do pedido
+_pix_locks = [threading.Lock() for _ in range(64)]
+
+def _pix_recente(chave):
+    with _pix_recentes_lock:
+        item = _pix_recentes.get(chave)
+    return item[0] if item and item[1] > time.monotonic() else None
+
+def _guardar_pix_recente(chave, pedido_id):
+    agora = time.monotonic()
+    with _pix_recentes_lock:
+        if len(_pix_recentes) > 5000:
+            for k in [k for k, (_, expira) in _pix_recentes.items() if expira <= agora]:
+                _pix_recentes.pop(k, None)
+        _pix_recentes[chave] = (pedido_id, agora + PIX_REAPROVEITAR_SEGUNDOS)
+
+def _pix_utilizavel(pedido: Optional[Pedido]) -> bool:
+    # Com QR: reaproveita. Sem QR: cobrança em andamento (reserva recente)
+    if not pedido or pedido.status != "pending":
+        return False
+    if pedido.qr_code:
+        return True
+    return bool(pedido.created_at and pedido.created_at > datetime.utcnow() - timedelta(seconds=PIX_AGUARDAR_SEGUNDOS))
+
+def _pix_pendente(db: Session, chave) -> Optional[Pedido]:
+    """Pedido pendente da chave: com QR (pronto) ou reservado e ainda sem QR."""
+    bot_id, chat_id, plano_id, com_bump, centavos = chave
+    pedido_id = _pix_recente(chave)
+    if pedido_id:
+        pedido = db.get(Pedido, pedido_id)
+        if _pix_utilizavel(pedido):
+            return pedido
+    limite = datetime.utcnow() - timedelta(seconds=PIX_REAPROVEITAR_SEGUNDOS)
+    candidatos = db.query(Pedido).filter(
+        Pedido.bot_id == bot_id, Pedido.telegram_id == chat_id, Pedido.status == "pending",
+        Pedido.created_at >= limite, Pedido.plano_id == plano_id,
+        Pedido.txid.is_(None),  # só pedidos do bot (os da loja guardam a imagem do QR, não o copia e cola)
+    ).order_by(Pedido.created_at.desc()).limit(5).all()
+    for pedido in candidatos:
+        if bool(pedido.tem_order_bump) == com_bump and int(round((pedido.valor or 0) * 100)) == centavos and _pix_utilizavel(pedido):
+            return pedido
+    return None
+
+def _aguardar_qr(db: Session, pedido: Pedido) -> Optional[Pedido]:
+    # Outro toque (ou worker) está cobrando este pedido: espera o QR aparecer
+    ate = time.monotonic() + PIX_AGUARDAR_SEGUNDOS
+    while time.monotonic() < ate:
+        db.expire(pedido)
+        atual = db.get(Pedido, pedido.id)
+        if not atual or atual.status != "pending":
+            return None  # gateway falhou (reserva apagada)
+        if atual.qr_code:
+            return atual
+        time.sleep(0.25)
+    return None
+
+def gerar_pix_checkout(db: Session, bot_temp, bot_db, chat_id, first_name, username,
+                       plano_id, plano_nome, valor, com_bump=False, tracking_id=None, texto_espera="⏳ Gerando <b>PIX</b>..."):
+    """
+    Devolve (pedido, reaproveitado). pedido = None se o gateway falhou.
+    """
+    chave = (bot_db.id, str(chat_id), plano_id, bool(com_bump), int(round(valor * 100)))
+    mytx = str(uuid.uuid4())
+    with _pix_locks[hash(chave) % len(_pix_locks)]:
+        existente = _pix_pendente(db, chave)
+        if not existente:
+            # Reserva: pedido pendente sem QR, com a referência local (única) no payment_ref
+            pedido = Pedido(
+                bot_id=bot_db.id, telegram_id=str(chat_id), first_name=first_name, username=username,
+                plano_nome=plano_nome, plano_id=plano_id, valor=valor,
+                transaction_id=mytx, payment_ref=normalizar_ref_pagamento(mytx), status="pending",
+                tem_order_bump=bool(com_bump), created_at=datetime.utcnow(), tracking_id=tracking_id
+            )
+            db.add(pedido)
+            db.commit()
+            _guardar_pix_recente(chave, pedido.id)
+
+    if existente:
+        pedido = existente if existente.qr_code else _aguardar_qr(db, existente)
+        if not pedido:
+            return None, False
+        logger.info(f"♻️ PIX reaproveitado para {chat_id} (pedido {pedido.id}), sem nova cobrança.")
+        return pedido, True
+
+    msg_wait = bot_temp.send_message(chat_id, texto_espera, parse_mode="HTML")
+    pix = gerar_pix_pushinpay(valor, mytx, bot_db.id)
+    try: bot_temp.delete_message(chat_id, msg_wait.message_id)
+    except: pass
+    if not pix:
+        # Libera a chave: o próximo toque tenta uma cobrança nova
+        db.delete(pedido)
+        db.commit()
+        with _pix_recentes_lock:
+            _pix_recentes.pop(chave, None)
+        return None, False
+
+    txid = str(pix.get('id') or mytx).lower()
+    pedido.qr_code = pix.get('qr_code_text') or pix.get('qr_code')
+    pedido.transaction_id = txid
+    pedido.payment_ref = normalizar_ref_pagamento(txid)
+    db.commit()
+    return pedido, False
+
+def enviar_mensagem_pix(bot_temp, chat_id, pedido: Pedido, nome_plano: str, rotulo_valor: str = "Valor"):
+    markup_pix = types.InlineKeyboardMarkup()
+    markup_pix.add(types.InlineKeyboardButton("🔄 VERIFICAR STATUS DO PAGAMENTO", callback_data=f"check_payment_{pedido.transaction_id}"))
+
+    msg_pix = f"🌟 Seu pagamento foi gerado com sucesso:\n🎁 Plano: <b>{nome_plano}</b>\n💰 {rotulo_valor}: <b>R$ {pedido.valor:.2f}</b>\n🔐 Pague via Pix Copia e Cola:\n\n<pre>{pedido.qr_code}</pre>\n\n👆 Toque na chave PIX acima para copiá-la\n‼️ Após o pagamento, o acesso será liberado automaticamente!"
+
+    bot_temp.send_message(chat_id, msg_pix, parse_mode="HTML", reply_markup=markup_pix)
 
 # --- HELPER: Notificar Admin Principal ---
 # --- HELPER: Notificar TODOS os Admins (Principal + Extras) ---
 # --- HELPER: Notificar TODOS os Admins (Principal + Extras) ---
-def notificar_admin_principal(bot_db: Bot, mensagem: str):
+def notificar_admin_principal(bot_db, mensagem: str):
     """
     Envia notificação para o Admin Principal E para os Admins Extras configurados.
     """
     ids_unicos = set()
 
+    # Usa o snapshot do registro (já traz os admins extras, sem lazy-load)
+    snap = bot_registry.obter_por_id(bot_db.id)
+    if not snap:
+        return
+
     # 1. Adiciona Admin Principal (se houver)
-    if bot_db.admin_principal_id:
-        ids_unicos.add(str(bot_db.admin_principal_id).strip())
+    if snap.admin_principal_id:
+        ids_unicos.add(str(snap.admin_principal_id).strip())
 
     # 2. Adiciona Admins Extras (da tabela BotAdmin)
-    if bot_db.admins:
-        for admin in bot_db.admins:
-            if admin.telegram_id:
-                ids_unicos.add(str(admin.telegram_id).strip())
+    ids_unicos.update(snap.admin_ids)
 
     if not ids_unicos:
         return
 
     try:
-        sender = telebot.TeleBot(bot_db.token)
+        sender = bot_registry.cliente(snap.token)
         for chat_id in ids_unicos:
             try:
                 # 🔥 ALTERADO PARA HTML
@@ -626,6 +1875,8 @@ def save_pushin_token(bot_id: int, data: IntegrationUpdate, db: Session = Depend
 
     bot.pushin_token = token_limpo
     db.commit()
+    bot_registry.invalidar(bot_id=bot.id)
+    invalidar_pushin_token()
     
     logger.info(f"🔑 Token PushinPay atualizado para o BOT {bot.nome}: {token_limpo[:5]}...")
     
@@ -917,19 +2168,79 @@ def send_remarketing(bot_id: int, data: RemarketingSend, background_tasks: Backg
         logger.error(f"Erro no remarketing: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# =========================================================
+# 🔖 PAGINAÇÃO POR CURSOR (KEYSET)
+# =========================================================
+# As listas do painel (contatos, leads, histórico de remarketing) são
+# ordenadas do mais novo para o mais antigo por (data, id). Em vez de
+# OFFSET (que obriga o banco a ler e descartar todas as páginas anteriores),
+# a próxima página começa logo depois da última linha entregue:
+#   WHERE (data, id) < (:data_ultima, :id_ultima) ORDER BY data DESC, id DESC
+# O cursor é essa tupla em JSON + base64 (opaco para o frontend).
+# Sem cursor, "page" continua funcionando como antes (OFFSET).
+
+def codificar_cursor(*valores):
+    bruto = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in valores])
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor, quantidade):
+    """Devolve a tupla do cursor (o 1º valor volta como datetime). Cursor inválido = 400."""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(valores, list) or len(valores) != quantidade:
+            raise ValueError("tamanho")
+        valores[0] = datetime.fromisoformat(valores[0])
+        return tuple(valores)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginação inválido")
+
+def paginar_keyset(consulta, colunas, cursor, page, per_page):
+    """
+    Aplica ordem DESC + keyset sobre `colunas` (select() ou db.query()).
+    Busca per_page + 1 linhas só para saber se existe próxima página.
+    Retorna a consulta pronta; use `fatiar_pagina` no resultado.
+    """
+    if cursor:
+        consulta = consulta.filter(tuple_(*colunas) < tuple_(*decodificar_cursor(cursor, len(colunas))))
+    # db.query() não aceita order_by depois de offset/limit
+    consulta = consulta.order_by(*[c.desc() for c in colunas])
+    if not cursor and page > 1:
+        consulta = consulta.offset((page - 1) * per_page)
+    return consulta.limit(per_page + 1)
+
+# Campanhas antigas podem ter data_envio NULL: (NULL, id) < cursor nunca é
+# verdadeiro e o cursor não codifica NULL, então essas linhas sumiam da
+# paginação. O histórico ordena por COALESCE(data_envio, 1970) — a mesma
+# expressão no ORDER BY, no filtro do cursor e na chave do próximo cursor.
+DATA_NULA_CURSOR = datetime(1970, 1, 1)
+ORDEM_HISTORICO_REMARKETING = (
+    func.coalesce(RemarketingCampaign.data_envio, DATA_NULA_CURSOR),
+    RemarketingCampaign.id,
+)
+
+def chave_historico_remarketing(campanha):
+    return (campanha.data_envio or DATA_NULA_CURSOR, campanha.id)
+
+def fatiar_pagina(linhas, per_page, chave_cursor):
+    """Corta a linha extra e monta o next_cursor a partir da última linha entregue."""
+    tem_mais = len(linhas) > per_page
+    linhas = linhas[:per_page]
+    proximo = codificar_cursor(*chave_cursor(linhas[-1])) if (tem_mais and linhas) else None
+    return linhas, proximo
+
 @app.get("/api/admin/bots/{bot_id}/remarketing/history")
-def get_remarketing_history(bot_id: int, page: int = 1, limit: int = 10, db: Session = Depends(get_db)):
+def get_remarketing_history(bot_id: int, page: int = 1, limit: int = 10, cursor: Optional[str] = None, db: Session = Depends(get_db)):
     try:
         # Garante limites seguros
         limit = min(limit, 50)
-        skip = (page - 1) * limit
-        
+
         # Query
         query = db.query(RemarketingCampaign).filter(RemarketingCampaign.bot_id == bot_id)
-        
+
         total = query.count()
-        campanhas = query.order_by(desc(RemarketingCampaign.data_envio)).offset(skip).limit(limit).all()
-            
+        campanhas = paginar_keyset(query, ORDEM_HISTORICO_REMARKETING, cursor, page, limit).all()
+        campanhas, next_cursor = fatiar_pagina(campanhas, limit, chave_historico_remarketing)
+
         # Formata Resposta
         data = []
         for c in campanhas:
@@ -947,8 +2258,11 @@ def get_remarketing_history(bot_id: int, page: int = 1, limit: int = 10, db: Ses
             "data": data,
             "total": total,
             "page": page,
-            "total_pages": (total // limit) + (1 if total % limit > 0 else 0)
+            "total_pages": (total // limit) + (1 if total % limit > 0 else 0),
+            "next_cursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao buscar histórico: {e}")
         return {"data": [], "total": 0, "page": 1, "total_pages": 0}
@@ -992,12 +2306,7 @@ class PixCreateRequest(BaseModel):
 def gerar_pix(data: PixCreateRequest, db: Session = Depends(get_db)):
     try:
         logger.info(f"💰 Iniciando pagamento para: {data.first_name} (R$ {data.valor})")
-        bot_atual = db.query(Bot).filter(Bot.id == data.bot_id).first()
-        pushin_token = bot_atual.pushin_token if bot_atual else None
-        
-        if not pushin_token:
-            config_sys = db.query(SystemConfig).filter(SystemConfig.key == "pushin_pay_token").first()
-            pushin_token = config_sys.value if (config_sys and config_sys.value) else os.getenv("PUSHIN_PAY_TOKEN")
+        pushin_token = resolver_token_pushin(data.bot_id)
 
         user_clean = str(data.username).strip().lower().replace("@", "") if data.username else "anonimo"
         tid_clean = str(data.telegram_id).strip()
@@ -1008,26 +2317,15 @@ def gerar_pix(data: PixCreateRequest, db: Session = Depends(get_db)):
             novo_pedido = Pedido(
                 bot_id=data.bot_id, telegram_id=tid_clean, first_name=data.first_name, username=user_clean,   
                 valor=data.valor, status='pending', plano_id=data.plano_id, plano_nome=data.plano_nome,
-                txid=fake_txid, qr_code="pix-fake-copia-cola", transaction_id=fake_txid, tem_order_bump=data.tem_order_bump
+                txid=fake_txid, qr_code="pix-fake-copia-cola", transaction_id=fake_txid, payment_ref=normalizar_ref_pagamento(fake_txid),
+                tem_order_bump=data.tem_order_bump
             )
             db.add(novo_pedido)
             db.commit()
             return {"txid": fake_txid, "copia_cola": "pix-fake", "qr_code": "https://fake.com/qr.png"}
 
-        url = "https://api.pushinpay.com.br/api/pix/cashIn"
-        headers = { "Authorization": f"Bearer {pushin_token}", "Content-Type": "application/json", "Accept": "application/json" }
-        domain = os.getenv("RAILWAY_PUBLIC_DOMAIN", "zenyx-gbs-testes-production.up.railway.app")
-        if domain.startswith("https://"): domain = domain.replace("https://", "")
-        
-        payload = {
-            "value": int(data.valor * 100),
-            "webhook_url": f"https://{domain}/webhook/pix",
-            "external_reference": f"bot_{data.bot_id}_{user_clean}_{int(time.time())}"
-        }
-
-        req = requests.post(url, json=payload, headers=headers)
-        if req.status_code in [200, 201]:
-            resp = req.json()
+        resp = pushinpay.criar_cobranca(pushin_token, data.valor, f"bot_{data.bot_id}_{user_clean}_{int(time.time())}")
+        if resp:
             txid = str(resp.get('id') or resp.get('txid'))
             copia_cola = resp.get('qr_code_text') or resp.get('pixCopiaEcola')
             qr_image = resp.get('qr_code_image_url') or resp.get('qr_code')
@@ -1035,21 +2333,24 @@ def gerar_pix(data: PixCreateRequest, db: Session = Depends(get_db)):
             novo_pedido = Pedido(
                 bot_id=data.bot_id, telegram_id=tid_clean, first_name=data.first_name, username=user_clean,
                 valor=data.valor, status='pending', plano_id=data.plano_id, plano_nome=data.plano_nome,
-                txid=txid, qr_code=qr_image, transaction_id=txid, tem_order_bump=data.tem_order_bump
+                txid=txid, qr_code=qr_image, transaction_id=txid, payment_ref=normalizar_ref_pagamento(txid),
+                tem_order_bump=data.tem_order_bump
             )
             db.add(novo_pedido)
             db.commit()
             return {"txid": txid, "copia_cola": copia_cola, "qr_code": qr_image}
-        else:
-            logger.error(f"Erro PushinPay: {req.text}")
-            raise HTTPException(status_code=400, detail="Erro Gateway")
+        if pushinpay.aberto():
+            raise HTTPException(status_code=503, detail="Gateway de pagamento indisponível, tente novamente em instantes")
+        raise HTTPException(status_code=400, detail="Erro Gateway")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro fatal PIX: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/pagamento/status/{txid}")
 def check_status(txid: str, db: Session = Depends(get_db)):
-    pedido = db.query(Pedido).filter((Pedido.txid == txid) | (Pedido.transaction_id == txid)).first()
+    pedido = buscar_pedido_por_ref(db, normalizar_ref_pagamento(txid))
     if not pedido: return {"status": "not_found"}
     return {"status": pedido.status}
 
@@ -1108,6 +2409,7 @@ def criar_bot(bot_data: BotCreate, db: Session = Depends(get_db)):
     db.add(novo_bot)
     db.commit()
     db.refresh(novo_bot)
+    bot_registry.invalidar(bot_id=novo_bot.id, token=novo_bot.token)
     
     return {
         "id": novo_bot.id,
@@ -1169,6 +2471,8 @@ def update_bot(bot_id: int, dados: BotUpdate, db: Session = Depends(get_db)):
     
     db.commit()
     db.refresh(bot_db)
+    bot_registry.invalidar(bot_id=bot_id, token=old_token)
+    bot_registry.invalidar(token=bot_db.token)
     return {"status": "ok", "msg": "Bot atualizado com sucesso"}
 
 # --- NOVA ROTA: LIGAR/DESLIGAR BOT (TOGGLE) ---
@@ -1182,6 +2486,7 @@ def toggle_bot(bot_id: int, db: Session = Depends(get_db)):
     novo_status = "ativo" if bot.status != "ativo" else "pausado"
     bot.status = novo_status
     db.commit()
+    bot_registry.invalidar(bot_id=bot_id)
     
     # 🔔 Notifica Admin (EM HTML)
     try:
@@ -1205,24 +2510,37 @@ def deletar_bot(bot_id: int, db: Session = Depends(get_db)):
     try:
         # 1. Tenta remover o Webhook do Telegram para limpar no servidor deles
         try:
-            tb = telebot.TeleBot(bot_db.token)
+            tb = bot_registry.cliente(bot_db.token)
             tb.delete_webhook()
         except:
             pass # Se der erro (ex: token inválido), continua e apaga do banco
         
         # 2. LIMPEZA PESADA (Exclui manualmente os dependentes para evitar erro de integridade)
         # Apaga PEDIDOS vinculados
+        db.query(Entrega).filter(Entrega.bot_id == bot_id).delete(synchronize_session=False)
+        db.query(ConviteVip).filter(ConviteVip.bot_id == bot_id).delete(synchronize_session=False)
+        db.query(LembreteRenovacao).filter(LembreteRenovacao.bot_id == bot_id).delete(synchronize_session=False)
+        db.query(Assinatura).filter(Assinatura.bot_id == bot_id).delete(synchronize_session=False)
         db.query(Pedido).filter(Pedido.bot_id == bot_id).delete(synchronize_session=False)
         
         # Apaga LEADS vinculados
         db.query(Lead).filter(Lead.bot_id == bot_id).delete(synchronize_session=False)
+
+        # Apaga o rollup diário do bot
+        db.query(DailyStat).filter(DailyStat.bot_id == bot_id).delete(synchronize_session=False)
         
-        # Apaga CAMPANHAS de Remarketing vinculadas
+        # Apaga CAMPANHAS de Remarketing vinculadas (e seus envios)
+        campanhas_do_bot = db.query(RemarketingCampaign.id).filter(RemarketingCampaign.bot_id == bot_id).scalar_subquery()
+        db.query(RemarketingEnvio).filter(RemarketingEnvio.campaign_id.in_(campanhas_do_bot)).delete(synchronize_session=False)
         db.query(RemarketingCampaign).filter(RemarketingCampaign.bot_id == bot_id).delete(synchronize_session=False)
         
         # 3. Apaga o Bot (Planos, Fluxos e Admins já caem por cascade)
+        token_removido = bot_db.token
         db.delete(bot_db)
         db.commit()
+        bot_registry.invalidar(bot_id=bot_id, token=token_removido)
+        flow_cache.invalidar(bot_id)
+        media_registry.esquecer_bot(bot_id)
         
         logger.info(f"🗑️ Bot {bot_id} e todos os seus dados foram excluídos com sucesso.")
         return {"status": "deleted", "msg": "Bot e todos os dados vinculados removidos com sucesso"}
@@ -1267,6 +2585,7 @@ def adicionar_admin(bot_id: int, dados: BotAdminCreate, db: Session = Depends(ge
     db.add(novo_admin)
     db.commit()
     db.refresh(novo_admin)
+    bot_registry.invalidar(bot_id=bot_id)
     return novo_admin
 
 # 🔥 [NOVO] Rota para Editar Admin Existente
@@ -1296,6 +2615,7 @@ def atualizar_admin(bot_id: int, admin_id: int, dados: BotAdminCreate, db: Sessi
     
     db.commit()
     db.refresh(admin_db)
+    bot_registry.invalidar(bot_id=bot_id)
     return admin_db
 
 @app.delete("/api/admin/bots/{bot_id}/admins/{telegram_id}")
@@ -1311,10 +2631,50 @@ def remover_admin(bot_id: int, telegram_id: str, db: Session = Depends(get_db)):
     
     db.delete(admin_db)
     db.commit()
+    bot_registry.invalidar(bot_id=bot_id)
     return {"status": "deleted", "msg": "Administrador removido com sucesso"}
 
 # --- NOVA ROTA: LISTAR BOTS ---
 
+# =========================================================
+# 🤖 MÉTRICAS DA LISTA DE BOTS (CONTATOS ÚNICOS + FATURAMENTO)
+# =========================================================
+# Duas consultas agrupadas para TODOS os bots de uma vez, guardadas por alguns
+# segundos: a lista de bots não depende do tamanho de pedidos/leads.
+# Os dados do bot em si (nome, status...) são lidos sempre frescos.
+LISTA_BOTS_CACHE_TTL = int(os.getenv("LISTA_BOTS_CACHE_TTL", "15"))
+_metricas_bots = {"dados": None, "expira_em": 0.0}
+_metricas_bots_lock = threading.Lock()
+
+def metricas_por_bot(db: Session) -> dict:
+    """bot_id -> (contatos únicos em leads+pedidos, faturamento pagos+expirados)"""
+    with _metricas_bots_lock:
+        if _metricas_bots["dados"] is not None and _metricas_bots["expira_em"] > time.monotonic():
+            return _metricas_bots["dados"]
+
+    # 1. CONTAGEM DE LEADS ÚNICOS (UNION tira quem está nas duas tabelas)
+    contatos = union(
+        select(Lead.bot_id.label("bot_id"), Lead.user_id.label("telegram_id")),
+        select(Pedido.bot_id.label("bot_id"), Pedido.telegram_id.label("telegram_id"))
+    ).subquery("contatos")
+    contatos_por_bot = dict(db.execute(
+        select(contatos.c.bot_id, func.count(contatos.c.telegram_id)).group_by(contatos.c.bot_id)
+    ).all())
+
+    # 2. REVENUE (PAGOS + EXPIRADOS) pelo rollup diário
+    revenue_por_bot = dict(
+        db.query(DailyStat.bot_id, func.sum(DailyStat.revenue)).group_by(DailyStat.bot_id).all()
+    )
+
+    dados = {
+        bot_id: (int(contatos_por_bot.get(bot_id) or 0), float(revenue_por_bot.get(bot_id) or 0.0))
+        for bot_id in set(contatos_por_bot) | set(revenue_por_bot)
+    }
+    with _metricas_bots_lock:
+        _metricas_bots["dados"] = dados
+        _metricas_bots["expira_em"] = time.monotonic() + LISTA_BOTS_CACHE_TTL
+    return dados
+
 # =========================================================
 # 🤖 LISTAR BOTS (COM KPI TOTAIS E USERNAME CORRIGIDO)
 # =========================================================
@@ -1330,31 +2690,11 @@ def listar_bots(db: Session = Depends(get_db)):
     🔥 [CORRIGIDO] Lista bots + Revenue (Pagos/Expirados) + Suporte Username
     """
     bots = db.query(Bot).all()
+    metricas = metricas_por_bot(db)
     
     result = []
     for bot in bots:
-        # 1. CONTAGEM DE LEADS ÚNICOS
-        leads_ids = set()
-        leads_query = db.query(Lead.user_id).filter(Lead.bot_id == bot.id).all()
-        for lead in leads_query:
-            leads_ids.add(str(lead.user_id))
-        
-        pedidos_ids = set()
-        pedidos_query = db.query(Pedido.telegram_id).filter(Pedido.bot_id == bot.id).all()
-        for pedido in pedidos_query:
-            pedidos_ids.add(str(pedido.telegram_id))
-        
-        contatos_unicos = leads_ids.union(pedidos_ids)
-        leads_count = len(contatos_unicos)
-        
-        # 2. REVENUE (PAGOS + EXPIRADOS)
-        status_financeiro = ["approved", "paid", "active", "completed", "succeeded", "expired"]
-        vendas_aprovadas = db.query(Pedido).filter(
-            Pedido.bot_id == bot.id,
-            Pedido.status.in_(status_financeiro)
-        ).all()
-        
-        revenue = sum([v.valor for v in vendas_aprovadas]) if vendas_aprovadas else 0.0
+        leads_count, revenue = metricas.get(bot.id, (0, 0.0))
         
         result.append({
             "id": bot.id,
@@ -1418,6 +2758,7 @@ async def create_plan(bot_id: int, req: Request, db: Session = Depends(get_db)):
         db.add(novo_plano)
         db.commit()
         db.refresh(novo_plano)
+        flow_cache.invalidar(bot_id)
         return novo_plano
 
     except TypeError as te:
@@ -1436,6 +2777,7 @@ async def create_plan(bot_id: int, req: Request, db: Session = Depends(get_db)):
             db.add(novo_plano_fallback)
             db.commit()
             db.refresh(novo_plano_fallback)
+            flow_cache.invalidar(bot_id)
             return novo_plano_fallback
         except Exception as e2:
             logger.error(f"Erro fatal ao criar plano: {e2}")
@@ -1469,6 +2811,7 @@ async def update_plan(bot_id: int, plano_id: int, req: Request, db: Session = De
         
         db.commit()
         db.refresh(plano)
+        flow_cache.invalidar(bot_id)
         return plano
     except HTTPException as he:
         raise he
@@ -1494,6 +2837,7 @@ def delete_plan(bot_id: int, plano_id: int, db: Session = Depends(get_db)):
         
         db.delete(plano)
         db.commit()
+        flow_cache.invalidar(bot_id)
         return {"status": "deleted"}
     except Exception as e:
         logger.error(f"Erro ao deletar plano: {e}")
@@ -1522,6 +2866,7 @@ def save_order_bump(bot_id: int, dados: OrderBumpCreate, db: Session = Depends(g
         bump = OrderBumpConfig(bot_id=bot_id)
         db.add(bump)
     
+    midia_antiga = bump.msg_media
     bump.ativo = dados.ativo
     bump.nome_produto = dados.nome_produto
     bump.preco = dados.preco
@@ -1534,6 +2879,8 @@ def save_order_bump(bot_id: int, dados: OrderBumpCreate, db: Session = Depends(g
     
     db.commit()
     db.refresh(bump)
+    flow_cache.invalidar(bot_id)
+    media_registry.substituida(bot_id, midia_antiga, bump.msg_media)
     return {"status": "ok", "msg": "Order Bump salvo com sucesso"}
 
 # =========================================================
@@ -1560,8 +2907,10 @@ def del_plano(pid: int, db: Session = Depends(get_db)):
         )
 
         # 4. Deleta o plano
+        bot_id_plano = p.bot_id
         db.delete(p)
         db.commit()
+        flow_cache.invalidar(bot_id_plano)
         
         return {"status": "deleted"}
         
@@ -1593,6 +2942,7 @@ def atualizar_plano(plan_id: int, dados: PlanoUpdate, db: Session = Depends(get_
 
     db.commit()
     db.refresh(plano)
+    flow_cache.invalidar(plano.bot_id)
     return {"status": "success", "msg": "Plano atualizado"}
 
 # =========================================================
@@ -1639,6 +2989,8 @@ def salvar_fluxo(bot_id: int, flow: FlowUpdate, db: Session = Depends(get_db)):
         fluxo_db = BotFlow(bot_id=bot_id)
         db.add(fluxo_db)
     
+    midias_antigas = (fluxo_db.media_url, fluxo_db.msg_2_media)
+
     # Atualiza campos básicos
     if flow.msg_boas_vindas is not None: fluxo_db.msg_boas_vindas = flow.msg_boas_vindas
     if flow.media_url is not None: fluxo_db.media_url = flow.media_url
@@ -1655,6 +3007,9 @@ def salvar_fluxo(bot_id: int, flow: FlowUpdate, db: Session = Depends(get_db)):
     if flow.miniapp_btn_text: fluxo_db.miniapp_btn_text = flow.miniapp_btn_text
     
     db.commit()
+    flow_cache.invalidar(bot_id)
+    media_registry.substituida(bot_id, midias_antigas[0], fluxo_db.media_url)
+    media_registry.substituida(bot_id, midias_antigas[1], fluxo_db.msg_2_media)
     logger.info(f"💾 Fluxo do Bot {bot_id} salvo com sucesso.")
     return {"status": "saved"}
 
@@ -1768,6 +3123,7 @@ def adicionar_passo_flow(bot_id: int, payload: FlowStepCreate, db: Session = Dep
     )
     db.add(novo_passo)
     db.commit()
+    flow_cache.invalidar(bot_id)
     return {"status": "success"}
 
 @app.put("/api/admin/bots/{bot_id}/flow/steps/{step_id}")
@@ -1784,6 +3140,7 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
     # Atualiza apenas os campos enviados
     if dados.msg_texto is not None:
         passo.msg_texto = dados.msg_texto
+    midia_antiga = passo.msg_media
     if dados.msg_media is not None:
         passo.msg_media = dados.msg_media
     if dados.btn_texto is not None:
@@ -1797,6 +3154,8 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
     
     db.commit()
     db.refresh(passo)
+    flow_cache.invalidar(bot_id)
+    media_registry.substituida(bot_id, midia_antiga, passo.msg_media)
     return {"status": "success", "passo": passo}
 
 
@@ -1804,8 +3163,11 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
 def remover_passo_flow(bot_id: int, sid: int, db: Session = Depends(get_db)):
     passo = db.query(BotFlowStep).filter(BotFlowStep.id == sid, BotFlowStep.bot_id == bot_id).first()
     if passo:
+        midia_antiga = passo.msg_media
         db.delete(passo)
         db.commit()
+        flow_cache.invalidar(bot_id)
+        media_registry.invalidar(bot_id, midia_antiga)
     return {"status": "deleted"}
 
 @app.post("/api/admin/tracking/folders")
@@ -1882,6 +3244,7 @@ def adicionar_passo_flow(bot_id: int, payload: FlowStepCreate, db: Session = Dep
     )
     db.add(novo_passo)
     db.commit()
+    flow_cache.invalidar(bot_id)
     return {"status": "success"}
 
 @app.put("/api/admin/bots/{bot_id}/flow/steps/{step_id}")
@@ -1898,6 +3261,7 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
     # Atualiza apenas os campos enviados
     if dados.msg_texto is not None:
         passo.msg_texto = dados.msg_texto
+    midia_antiga = passo.msg_media
     if dados.msg_media is not None:
         passo.msg_media = dados.msg_media
     if dados.btn_texto is not None:
@@ -1911,6 +3275,8 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
     
     db.commit()
     db.refresh(passo)
+    flow_cache.invalidar(bot_id)
+    media_registry.substituida(bot_id, midia_antiga, passo.msg_media)
     return {"status": "success", "passo": passo}
 
 
@@ -1918,8 +3284,11 @@ def atualizar_passo_flow(bot_id: int, step_id: int, dados: FlowStepUpdate, db: S
 def remover_passo_flow(bot_id: int, sid: int, db: Session = Depends(get_db)):
     passo = db.query(BotFlowStep).filter(BotFlowStep.id == sid, BotFlowStep.bot_id == bot_id).first()
     if passo:
+        midia_antiga = passo.msg_media
         db.delete(passo)
         db.commit()
+        flow_cache.invalidar(bot_id)
+        media_registry.invalidar(bot_id, midia_antiga)
     return {"status": "deleted"}
 
 # =========================================================
@@ -1961,6 +3330,8 @@ def save_miniapp_config(bot_id: int, dados: MiniAppConfigUpdate, db: Session = D
         config = MiniAppConfig(bot_id=bot_id)
         db.add(config)
     
+    midias_antigas = {"logo_url": config.logo_url, "hero_video_url": config.hero_video_url, "popup_video_url": config.popup_video_url}
+
     # Atualiza campos se enviados
     if dados.logo_url is not None: config.logo_url = dados.logo_url
     if dados.background_type is not None: config.background_type = dados.background_type
@@ -1978,6 +3349,8 @@ def save_miniapp_config(bot_id: int, dados: MiniAppConfigUpdate, db: Session = D
     if dados.footer_text is not None: config.footer_text = dados.footer_text
     
     db.commit()
+    for campo, antiga in midias_antigas.items():
+        media_registry.substituida(bot_id, antiga, getattr(config, campo))
     return {"status": "ok", "msg": "Configuração da loja salva!"}
 
 # 3. Criar Categoria
@@ -2074,278 +3447,716 @@ def delete_miniapp_category(cat_id: int, db: Session = Depends(get_db)):
         db.commit()
     return {"status": "deleted"}
 
-# 🔔 WEBHOOK PIX (INTELIGENTE: RESOLVE IDS + ENTREGA BUMP)
 # =========================================================
-@app.post("/webhook/pix")
-async def webhook_pix(request: Request, db: Session = Depends(get_db)):
-    print("🔔 WEBHOOK PIX CHEGOU!") 
+# 💸 LIQUIDAÇÃO DE PAGAMENTOS (WEBHOOK -> FILA -> ENTREGA)
+# =========================================================
+# O webhook do gateway só faz o que é banco: marca o pedido como pago
+# (UPDATE condicional, então retry do gateway não liquida duas vezes),
+# soma tracking/rollup e cria a linha em `entregas`. Responde na hora.
+# A parte do Telegram (desbanir, gerar convite, mensagem, bônus, admins)
+# roda no pool de entregas, em etapas com status próprio. Etapa que falha
+# volta para a fila com backoff; `mensagem_enviada` só vira True depois
+# que a mensagem com o acesso realmente saiu.
+ENTREGA_WORKERS = int(os.getenv("ENTREGA_WORKERS", "8"))
+ENTREGA_MAX_TENTATIVAS = int(os.getenv("ENTREGA_MAX_TENTATIVAS", "8"))
+ENTREGA_BACKOFF_SEGUNDOS = (15, 60, 300, 900, 1800, 3600)
+ENTREGA_VARREDURA_SEGUNDOS = 60
+ENTREGA_TRAVADA_MINUTOS = 10
+STATUS_GATEWAY_PAGO = ("paid", "approved", "completed", "succeeded")
+
+entrega_executor = ThreadPoolExecutor(max_workers=ENTREGA_WORKERS, thread_name_prefix="entrega")
+
+def _despachar_entregas(entrega_ids):
+    for entrega_id in entrega_ids:
+        entrega_executor.submit(processar_entrega, entrega_id)
+
+fila_entregas = FilaDeTempo("fila-entregas", _despachar_entregas)
+
+async def corpo_da_requisicao(request: Request) -> str:
+    # Só a leitura do corpo fica no event loop: os webhooks de pagamento são
+    # `def` e o FastAPI roda o resto (SQLAlchemy síncrono) no threadpool
+    return (await request.body()).decode("utf-8", errors="replace")
+
+def ler_corpo_webhook(body_str: str) -> Optional[dict]:
+    """JSON (objeto ou lista) ou x-www-form-urlencoded. None = ilegível."""
     try:
-        body_bytes = await request.body()
-        body_str = body_bytes.decode("utf-8")
-        try: data = json.loads(body_str)
-        except: 
-            try: data = {k: v[0] for k, v in urllib.parse.parse_qs(body_str).items()}
-            except: return {"status": "ignored"}
+        data = json.loads(body_str)
+        if isinstance(data, list):
+            data = data[0] if data else {}
+        return data if isinstance(data, dict) else None
+    except Exception:
+        try:
+            return {k: v[0] for k, v in urllib.parse.parse_qs(body_str).items()}
+        except Exception:
+            return None
 
-        raw_tx_id = data.get("id") or data.get("external_reference") or data.get("uuid")
-        tx_id = str(raw_tx_id).lower() if raw_tx_id else None
-        status_pix = str(data.get("status", "")).lower()
-        
-        if status_pix not in ["paid", "approved", "completed", "succeeded"]: return {"status": "ignored"}
+def calcular_validade(db: Session, pedido: Pedido, agora: datetime) -> Optional[datetime]:
+    """Data de expiração do acesso (None = vitalício)."""
+    # A) Pelo ID do plano
+    if pedido.plano_id:
+        pid = int(pedido.plano_id) if str(pedido.plano_id).isdigit() else None
+        if pid:
+            plano_db = db.query(PlanoConfig).filter(PlanoConfig.id == pid).first()
+            if plano_db and plano_db.dias_duracao:
+                return agora + timedelta(days=plano_db.dias_duracao) if plano_db.dias_duracao < 90000 else None
+
+    # B) Fallback pelo nome
+    if pedido.plano_nome:
+        nm = pedido.plano_nome.lower()
+        if "vital" not in nm and "mega" not in nm and "eterno" not in nm:
+            dias = 30 # Padrão
+            if "24" in nm or "diario" in nm or "1 dia" in nm: dias = 1
+            elif "semanal" in nm: dias = 7
+            elif "trimestral" in nm: dias = 90
+            elif "anual" in nm: dias = 365
+            return agora + timedelta(days=dias)
+    return None
 
-        pedido = db.query(Pedido).filter((Pedido.txid == tx_id) | (Pedido.transaction_id == tx_id)).first()
-        if not pedido or pedido.status in ["approved", "paid"]: return {"status": "ok"}
+# =========================================================
+# 🎫 ASSINATURAS (DIREITO DE ACESSO)
+# =========================================================
+# Quem tem acesso ao VIP fica em subscriptions, uma linha por (bot, usuário).
+# Porteiro, /status e reenvio fazem uma busca pela PK; o Ceifador recarrega
+# os vencimentos por faixa em expires_at.
+def assinatura_ativa(db: Session, bot_id: int, telegram_id, agora: Optional[datetime] = None) -> Optional[Assinatura]:
+    assinatura = db.get(Assinatura, (bot_id, str(telegram_id)))
+    if not assinatura:
+        return None
+    if assinatura.expires_at and assinatura.expires_at <= (agora or datetime.utcnow()):
+        return None
+    return assinatura
 
-        now = datetime.utcnow()
-        pedido.status = "approved" 
-        pedido.data_aprovacao = now
-        pedido.pagou_em = now
-        pedido.status_funil = 'fundo'
-        
-        if pedido.plano_id:
-            pid = int(pedido.plano_id) if str(pedido.plano_id).isdigit() else None
-            if pid:
-                plano_db = db.query(PlanoConfig).filter(PlanoConfig.id == pid).first()
-                if plano_db and plano_db.dias_duracao and plano_db.dias_duracao < 90000:
-                    pedido.data_expiracao = now + timedelta(days=plano_db.dias_duracao)
-                    pedido.custom_expiration = pedido.data_expiracao
-
-        pedido.mensagem_enviada = False 
+def conceder_assinatura(db: Session, pedido: Pedido, validade: Optional[datetime], forcar: bool = False):
+    """
+    Upsert da assinatura do usuário a partir do pedido. Não faz commit.
+    Sem forcar, um pagamento novo não encurta acesso maior já garantido
+    (vitalício, renovação antecipada); com forcar (edição no painel) o pedido manda.
+    """
+    telegram_id = str(pedido.telegram_id or "").strip()
+    # @username (checkout web) não é chave de busca: a assinatura nasce quando
+    # o id numérico é resolvido (trocar_telegram_id_pedido)
+    if not pedido.bot_id or not telegram_id.isdigit():
+        return
+    upsert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = upsert(Assinatura).values(
+        bot_id=pedido.bot_id, telegram_id=telegram_id, expires_at=validade,
+        source_pedido_id=pedido.id, updated_at=datetime.utcnow(),
+    )
+    atual, novo = Assinatura.__table__.c, stmt.excluded
+    onde = None
+    if not forcar:
+        onde = (atual.source_pedido_id == novo.source_pedido_id) | (
+            atual.expires_at.isnot(None) & (novo.expires_at.is_(None) | (novo.expires_at > atual.expires_at))
+        )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["bot_id", "telegram_id"],
+        set_={"expires_at": novo.expires_at, "source_pedido_id": novo.source_pedido_id, "updated_at": novo.updated_at},
+        where=onde,
+    ))
+
+def revogar_assinatura(db: Session, pedido: Pedido):
+    # Só remove se o acesso vem deste pedido (outro pedido ativo continua valendo). Não faz commit.
+    db.query(Assinatura).filter(
+        Assinatura.bot_id == pedido.bot_id,
+        Assinatura.telegram_id == str(pedido.telegram_id),
+        Assinatura.source_pedido_id == pedido.id,
+    ).delete(synchronize_session=False)
+
+def trocar_telegram_id_pedido(db: Session, pedido: Pedido, telegram_id: str):
+    """
+    Grava o id numérico resolvido no pedido (antes @username) e leva a
+    assinatura junto: sai a chave antiga, o acesso vale na nova. Não faz commit.
+    """
+    antigo = str(pedido.telegram_id or "")
+    if antigo == telegram_id:
+        return
+    db.query(Assinatura).filter(
+        Assinatura.bot_id == pedido.bot_id,
+        Assinatura.telegram_id == antigo,
+        Assinatura.source_pedido_id == pedido.id,
+    ).delete(synchronize_session=False)
+    pedido.telegram_id = telegram_id
+    if pedido.status in ("paid", "approved", "active"):
+        conceder_assinatura(db, pedido, pedido.custom_expiration)
+
+def abrir_entrega(db: Session, pedido: Pedido, origem: str) -> Optional[Entrega]:
+    """
+    Cria (ou reabre) a entrega do pedido. Não faz commit.
+    Retorna None se já está sendo processada ou não há nada a reenviar.
+    """
+    entrega = db.query(Entrega).filter(Entrega.pedido_id == pedido.id).first()
+    etapa_bump = "pendente" if pedido.tem_order_bump else "nao_aplica"
+    if not entrega:
+        entrega = Entrega(
+            pedido_id=pedido.id, bot_id=pedido.bot_id, origem=origem,
+            etapa_bump=etapa_bump,
+            # Na recuperação o admin já foi avisado quando o pagamento caiu
+            etapa_admin="nao_aplica" if origem == "recuperacao" else "pendente",
+        )
+        db.add(entrega)
+        db.flush()
+        return entrega
+
+    if entrega.status == "processando":
+        return None
+    if origem == "recuperacao":
+        if entrega.etapa_acesso == "ok" and entrega.etapa_bump in ("ok", "nao_aplica"):
+            return None
+    else:
+        # Novo pagamento do mesmo pedido (ex.: pedido reaproveitado): entrega do zero
+        entrega.etapa_admin = "pendente"
+        entrega.etapa_acesso = "pendente"
+        entrega.link_convite = None
+        entrega.etapa_bump = etapa_bump
+
+    if entrega.etapa_acesso != "ok":
+        entrega.etapa_acesso = "pendente"
+    if entrega.etapa_bump == "erro":
+        entrega.etapa_bump = "pendente"
+    entrega.origem = origem
+    entrega.status = "pendente"
+    entrega.tentativas = 0
+    entrega.proxima_tentativa = datetime.utcnow()
+    entrega.concluida_em = None
+    return entrega
+
+def normalizar_ref_pagamento(valor) -> Optional[str]:
+    """ID de transação do gateway em forma canônica (minúsculo, sem espaços)."""
+    ref = str(valor).strip().lower() if valor is not None else ""
+    return ref if ref and ref not in ("none", "null") else None
+
+def buscar_pedido_por_ref(db: Session, ref: Optional[str]) -> Optional[Pedido]:
+    # payment_ref é gravado já normalizado em todos os caminhos de criação
+    # (e preenchido no histórico pela versão 10 do migrate.py): sonda única no índice.
+    if not ref:
+        return None
+    return db.query(Pedido).filter(Pedido.payment_ref == ref).first()
+
+def registrar_evento_pagamento(db: Session, ref: str, origem: str, status_gateway: str, payload: Optional[dict]):
+    """
+    INSERT ... ON CONFLICT DO NOTHING no ledger (sonda única no índice de gateway_ref).
+    Retorna (evento, novo). Não faz commit.
+    """
+    upsert = pg_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    stmt = upsert(PagamentoEvento).values(
+        gateway_ref=ref, origem=origem, status_gateway=status_gateway,
+        payload=json.dumps(payload, default=str)[:10000] if payload is not None else None,
+        resultado="recebido", recebido_em=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["gateway_ref"])
+    novo = db.execute(stmt).rowcount == 1
+    evento = db.query(PagamentoEvento).filter(PagamentoEvento.gateway_ref == ref).first()
+    return evento, novo
+
+def liquidar_pedido(db: Session, pedido: Pedido, status_final: str, origem: str, quando: datetime,
+                    abrir_entrega_pedido: bool = True):
+    """
+    Marca o pedido como pago (validade, rollup, tracking) e abre a entrega.
+    Não faz commit. Retorna (ganhou, entrega).
+    """
+    validade = calcular_validade(db, pedido, quando)
+    status_anterior = pedido.status
+
+    # Só UM webhook ganha a troca de status (retries simultâneos do gateway caem no rowcount 0)
+    ganhou = db.query(Pedido).filter(
+        Pedido.id == pedido.id,
+        (Pedido.status.is_(None)) | (Pedido.status.notin_(["approved", "paid"]))
+    ).update({
+        Pedido.status: status_final,
+        Pedido.data_aprovacao: quando,
+        Pedido.pagou_em: quando,
+        Pedido.status_funil: "fundo",
+        Pedido.data_expiracao: validade,
+        Pedido.custom_expiration: validade,
+        Pedido.mensagem_enviada: False,
+    }, synchronize_session=False)
+    if not ganhou:
+        return False, None
+
+    db.refresh(pedido)
+    contabilizar_status_pedido(db, pedido, status_anterior)
+    conceder_assinatura(db, pedido, validade)
+    agendar_vencimento(pedido.id, validade)
+
+    # 🔥 ATUALIZA ESTATÍSTICAS DE TRACKING (VENDAS/FATURAMENTO)
+    if pedido.tracking_id:
+        db.query(TrackingLink).filter(TrackingLink.id == pedido.tracking_id).update({
+            TrackingLink.vendas: func.coalesce(TrackingLink.vendas, 0) + 1,
+            TrackingLink.faturamento: func.coalesce(TrackingLink.faturamento, 0.0) + (pedido.valor or 0.0),
+        }, synchronize_session=False)
+
+    entrega = abrir_entrega(db, pedido, origem) if abrir_entrega_pedido else None
+    return True, entrega
+
+def registrar_pagamento(db: Session, tx_id: Optional[str], status_final: str, origem: str,
+                        status_gateway: str = "", payload: Optional[dict] = None) -> str:
+    """
+    Porta de entrada de TODO pagamento aprovado: grava no ledger, liquida o
+    pedido e enfileira a entrega, numa transação só.
+    Retorna 'liquidado', 'ja_pago' ou 'nao_encontrado'.
+    """
+    ref = normalizar_ref_pagamento(tx_id)
+    if not ref:
+        return "nao_encontrado"
+
+    evento, novo = registrar_evento_pagamento(db, ref, origem, status_gateway, payload)
+    # Retry do gateway: já está no ledger. Só reprocessa se da outra vez o pedido não existia.
+    if not novo and evento.resultado != "nao_encontrado":
+        db.rollback()
+        logger.info(f"🔁 Evento de pagamento {ref} repetido ({evento.resultado}), ignorado.")
+        return "ja_pago"
+
+    pedido = buscar_pedido_por_ref(db, ref)
+    if not pedido:
+        evento.resultado = "nao_encontrado"
         db.commit()
-        
-        sucesso_entrega = False
+        return "nao_encontrado"
+
+    ganhou, entrega = liquidar_pedido(db, pedido, status_final, origem, datetime.utcnow())
+    evento.pedido_id = pedido.id
+    evento.resultado = "liquidado" if ganhou else "ja_pago"
+    db.commit()
+    if not ganhou:
+        return "ja_pago"
+
+    texto_validade = pedido.data_expiracao.strftime("%d/%m/%Y") if pedido.data_expiracao else "VITALÍCIO ♾️"
+    logger.info(f"✅ Pedido {ref} APROVADO ({origem})! Validade: {texto_validade}")
+    if entrega:
+        entrega_executor.submit(processar_entrega, entrega.id)
+    return "liquidado"
+
+def reprocessar_eventos_pagamento(db: Session, desde: Optional[datetime] = None,
+                                  entregar: bool = False, simular: bool = False) -> dict:
+    """
+    Replay do ledger: reaplica, em ordem de chegada, os eventos cujo pedido
+    não está pago (ex.: banco restaurado de backup, bug na liquidação).
+    A validade conta a partir de quando o evento chegou, não de agora.
+    Com entregar=False o cliente recebe o acesso no próximo /start (recuperação).
+    """
+    contagem = {"eventos": 0, "reaplicados": 0, "ja_pagos": 0, "sem_pedido": 0}
+    consulta = db.query(PagamentoEvento)
+    if desde:
+        consulta = consulta.filter(PagamentoEvento.recebido_em >= desde)
+
+    ids = [e_id for (e_id,) in consulta.with_entities(PagamentoEvento.id)
+           .order_by(PagamentoEvento.recebido_em, PagamentoEvento.id).all()]
+    entregas = []
+    for evento_id in ids:
+        evento = db.query(PagamentoEvento).filter(PagamentoEvento.id == evento_id).first()
+        contagem["eventos"] += 1
+        pedido = buscar_pedido_por_ref(db, evento.gateway_ref)
+        if not pedido:
+            contagem["sem_pedido"] += 1
+            continue
+        # Expirado/pago = o pagamento já foi contado um dia
+        if str(pedido.status or "").lower() in STATUS_RECEITA:
+            contagem["ja_pagos"] += 1
+            continue
+        contagem["reaplicados"] += 1
+        if simular:
+            continue
+
+        status_final = "paid" if evento.origem == "site" else "approved"
+        ganhou, entrega = liquidar_pedido(db, pedido, status_final, evento.origem or "pix",
+                                          evento.recebido_em or datetime.utcnow(), abrir_entrega_pedido=entregar)
+        evento.pedido_id = pedido.id
+        evento.resultado = "liquidado" if ganhou else "ja_pago"
+        db.commit()
+        if entrega:
+            entregas.append(entrega.id)
+
+    for entrega_id in entregas:
+        entrega_executor.submit(processar_entrega, entrega_id)
+    return contagem
+
+def _resolver_chat_destino(db: Session, pedido: Pedido) -> Optional[str]:
+    target_id = str(pedido.telegram_id or "").strip()
+    if target_id.isdigit():
+        return target_id
+
+    # 🔥 AUTO-CORREÇÃO DE ID (pedido gravado com @username)
+    logger.info(f"⚠️ ID '{target_id}' não é numérico. Buscando Lead correspondente...")
+    clean_user = str(pedido.username or target_id).lower().replace("@", "").strip()
+    lead = db.query(Lead).filter(
+        Lead.bot_id == pedido.bot_id,
+        (func.lower(Lead.username) == clean_user) | (func.lower(Lead.username) == f"@{clean_user}")
+    ).order_by(desc(Lead.created_at)).first()
+    if lead and lead.user_id and lead.user_id.isdigit():
+        logger.info(f"✅ ID Resolvido via Lead: {lead.user_id}")
+        trocar_telegram_id_pedido(db, pedido, lead.user_id)
+        db.commit()
+        return lead.user_id
+    return None
+
+def _mensagem_acesso(entrega: Entrega, pedido: Pedido, bot_data, link: str) -> str:
+    if entrega.origem == "recuperacao":
+        return f"🎉 <b>Pagamento Encontrado!</b>\n\nAqui está seu link:\n👉 {link}"
+    if entrega.origem == "site":
+        return (
+            f"✅ <b>Pagamento Confirmado!</b>\n\n"
+            f"Seu acesso ao <b>{bot_data.nome}</b> foi liberado.\n"
+            f"Toque no link abaixo para entrar no Canal VIP:\n\n"
+            f"👉 {link}\n\n"
+            f"⚠️ <i>Este link é único e válido apenas para você.</i>"
+        )
+    val_txt = pedido.data_expiracao.strftime("%d/%m/%Y") if pedido.data_expiracao else "VITALÍCIO"
+    return f"✅ <b>Pagamento Confirmado!</b>\n📅 Validade: <b>{val_txt}</b>\n\nSeu acesso:\n👉 {link}"
+
+def _etapa_acesso(db: Session, tb, bot_data, pedido: Pedido, entrega: Entrega):
+    target_id = _resolver_chat_destino(db, pedido)
+    if not target_id:
+        # Sem chat numérico não dá para enviar: tenta de novo (ou o /start do cliente recupera)
+        raise ValueError(f"telegram_id '{pedido.telegram_id}' não numérico e sem lead correspondente")
+
+    canal_id = canal_vip_id(bot_data)
+    try: tb.unban_chat_member(canal_id, int(target_id))
+    except: pass
+
+    if not entrega.link_convite:
         try:
-            bot_data = db.query(Bot).filter(Bot.id == pedido.bot_id).first()
-            if bot_data:
-                tb = telebot.TeleBot(bot_data.token)
-                target_id = str(pedido.telegram_id).strip()
-                
-                # 🔥 AUTO-CORREÇÃO DE ID
-                if not target_id.isdigit():
-                    logger.info(f"⚠️ ID '{target_id}' não é numérico. Buscando Lead correspondente...")
-                    clean_user = str(pedido.username).lower().replace("@", "").strip()
-                    lead = db.query(Lead).filter(
-                        Lead.bot_id == pedido.bot_id,
-                        (func.lower(Lead.username) == clean_user) | (func.lower(Lead.username) == f"@{clean_user}")
-                    ).order_by(desc(Lead.created_at)).first()
-                    if lead and lead.user_id and lead.user_id.isdigit():
-                        logger.info(f"✅ ID Resolvido via Lead: {lead.user_id}")
-                        target_id = lead.user_id
-                        pedido.telegram_id = target_id
-                        db.commit()
+            entrega.link_convite = obter_convite(db, tb, bot_data, canal_id, pedido, f"Venda {pedido.first_name}")
+        except Exception as e_link:
+            if not pedido.link_acesso:
+                raise
+            logger.warning(f"Erro ao gerar link: {e_link}. Usando link salvo.")
+            entrega.link_convite = pedido.link_acesso
+        db.commit()  # Próxima tentativa reaproveita o mesmo convite
+
+    tb.send_message(int(target_id), _mensagem_acesso(entrega, pedido, bot_data, entrega.link_convite), parse_mode="HTML")
+
+def _etapa_bump(db: Session, tb, pedido: Pedido):
+    bump_conf = flow_cache.obter(pedido.bot_id, db).bump
+    if not (bump_conf and bump_conf.link_acesso):
+        return "nao_aplica"
+    msg_bump = f"🎁 <b>BÔNUS: {bump_conf.nome_produto}</b>\n\nAqui está seu acesso extra:\n👉 {bump_conf.link_acesso}"
+    tb.send_message(int(pedido.telegram_id), msg_bump, parse_mode="HTML")
+    logger.info("✅ Order Bump entregue!")
+    return "ok"
+
+def _etapa_admin(bot_data, pedido: Pedido, entrega: Entrega):
+    texto_validade = pedido.data_expiracao.strftime("%d/%m/%Y") if pedido.data_expiracao else "VITALÍCIO ♾️"
+    titulo = "VENDA APROVADA (SITE)!" if entrega.origem == "site" else "VENDA REALIZADA!"
+    msg_admin = (
+        f"💰 <b>{titulo}</b>\n\n"
+        f"🤖 Bot: <b>{bot_data.nome}</b>\n"
+        f"👤 Cliente: {pedido.first_name} (@{pedido.username})\n"
+        f"📦 Plano: {pedido.plano_nome}\n"
+        f"💵 Valor: <b>R$ {(pedido.valor or 0.0):.2f}</b>\n"
+        f"📅 Vence em: {texto_validade}"
+    )
+    notificar_admin_principal(bot_data, msg_admin)
 
-                if target_id.isdigit():
-                    try:
-                        # 1. ENTREGA PRINCIPAL
-                        canal_str = str(bot_data.id_canal_vip).strip()
-                        canal_id = int(canal_str) if canal_str.lstrip('-').isdigit() else canal_str
-                        try: tb.unban_chat_member(canal_id, int(target_id))
-                        except: pass
-                        
-                        convite = tb.create_chat_invite_link(chat_id=canal_id, member_limit=1, name=f"Venda {pedido.first_name}")
-                        val_txt = pedido.data_expiracao.strftime("%d/%m/%Y") if pedido.data_expiracao else "VITALÍCIO"
-                        
-                        msg = f"✅ <b>Pagamento Confirmado!</b>\n📅 Validade: <b>{val_txt}</b>\n\nSeu acesso:\n👉 {convite.invite_link}"
-                        tb.send_message(int(target_id), msg, parse_mode="HTML")
-                        
-                        # 🔥 2. ENTREGA DO ORDER BUMP (NOVO)
-                        if pedido.tem_order_bump:
-                            bump_conf = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == pedido.bot_id).first()
-                            if bump_conf and bump_conf.link_acesso:
-                                msg_bump = f"🎁 <b>BÔNUS: {bump_conf.nome_produto}</b>\n\nAqui está seu acesso extra:\n👉 {bump_conf.link_acesso}"
-                                tb.send_message(int(target_id), msg_bump, parse_mode="HTML")
-                                logger.info("✅ Order Bump entregue!")
-
-                        sucesso_entrega = True
-                        logger.info(f"✅ Entrega realizada para ID: {target_id}")
-                    except Exception as e_send:
-                        logger.error(f"Erro envio Telegram: {e_send}")
-        except Exception as e_bot:
-            logger.error(f"Erro lógica bot: {e_bot}")
-
-        if sucesso_entrega:
-            pedido.mensagem_enviada = True
+def processar_entrega(entrega_id: int):
+    db = SessionLocal()
+    try:
+        # Claim atômico: se outro worker/processo já pegou, rowcount = 0
+        agora = datetime.utcnow()
+        pegou = db.query(Entrega).filter(
+            Entrega.id == entrega_id,
+            Entrega.status.in_(["pendente", "erro"])
+        ).update({
+            Entrega.status: "processando",
+            Entrega.reservada_em: agora,
+            Entrega.tentativas: Entrega.tentativas + 1,
+        }, synchronize_session=False)
+        db.commit()
+        if not pegou:
+            return
+
+        entrega = db.query(Entrega).filter(Entrega.id == entrega_id).first()
+        pedido = db.query(Pedido).filter(Pedido.id == entrega.pedido_id).first()
+        bot_data = bot_registry.obter_por_id(entrega.bot_id, db) if pedido else None
+        if not bot_data:
+            entrega.status = "falhou"
+            entrega.ultimo_erro = "Pedido ou bot não existe mais"
             db.commit()
+            return
+        tb = bot_registry.cliente(bot_data.token)
+        erros = []
+
+        # 1. ENTREGA PRINCIPAL
+        if entrega.etapa_acesso != "ok":
+            try:
+                _etapa_acesso(db, tb, bot_data, pedido, entrega)
+                entrega.etapa_acesso = "ok"
+                pedido.mensagem_enviada = True
+                logger.info(f"✅ Entrega realizada para ID: {pedido.telegram_id}")
+            except Exception as e:
+                entrega.etapa_acesso = "erro"
+                erros.append(f"acesso: {e}")
+            db.commit()
+
+        # 2. ORDER BUMP (só depois do acesso principal)
+        if entrega.etapa_bump in ("pendente", "erro") and entrega.etapa_acesso == "ok":
+            try:
+                entrega.etapa_bump = _etapa_bump(db, tb, pedido)
+            except Exception as e:
+                entrega.etapa_bump = "erro"
+                erros.append(f"bump: {e}")
+            db.commit()
+
+        # 3. AVISO AOS ADMINS (independe do cliente ter recebido)
+        if entrega.etapa_admin in ("pendente", "erro"):
+            try:
+                _etapa_admin(bot_data, pedido, entrega)
+                entrega.etapa_admin = "ok"
+            except Exception as e:
+                entrega.etapa_admin = "erro"
+                erros.append(f"admin: {e}")
+            db.commit()
+
+        if not erros:
+            entrega.status = "concluida"
+            entrega.concluida_em = datetime.utcnow()
+            entrega.ultimo_erro = None
+            db.commit()
+            return
+
+        entrega.ultimo_erro = " | ".join(erros)[:1000]
+        if entrega.tentativas >= ENTREGA_MAX_TENTATIVAS:
+            entrega.status = "falhou"
+            db.commit()
+            logger.error(f"❌ [ENTREGA {entrega_id}] Desistindo após {entrega.tentativas} tentativas: {entrega.ultimo_erro}")
+            notificar_admin_principal(bot_data, (
+                f"⚠️ <b>Entrega não concluída</b>\n\n"
+                f"👤 Cliente: {pedido.first_name} (@{pedido.username})\n"
+                f"🆔 {pedido.telegram_id}\n"
+                f"Motivo: {entrega.ultimo_erro}"
+            ))
+            return
+
+        espera = ENTREGA_BACKOFF_SEGUNDOS[min(entrega.tentativas, len(ENTREGA_BACKOFF_SEGUNDOS)) - 1]
+        entrega.status = "erro"
+        entrega.proxima_tentativa = datetime.utcnow() + timedelta(seconds=espera)
+        db.commit()
+        fila_entregas.agendar(entrega.proxima_tentativa, entrega_id)
+        logger.warning(f"⚠️ [ENTREGA {entrega_id}] Tentativa {entrega.tentativas} falhou ({entrega.ultimo_erro}). Nova tentativa em {espera}s")
 
-        return {"status": "received"}
     except Exception as e:
-        logger.error(f"Erro webhook: {e}")
-        return {"status": "error"}
+        logger.error(f"❌ [ENTREGA {entrega_id}] Erro inesperado: {e}")
+        try:
+            db.rollback()
+            db.query(Entrega).filter(Entrega.id == entrega_id, Entrega.status == "processando").update(
+                {Entrega.status: "erro", Entrega.proxima_tentativa: datetime.utcnow() + timedelta(seconds=ENTREGA_BACKOFF_SEGUNDOS[0])},
+                synchronize_session=False
+            )
+            db.commit()
+        except: db.rollback()
+    finally:
+        db.close()
 
-# =========================================================
-# 💳 WEBHOOK PIX (PUSHIN PAY) - VERSÃO HTML BLINDADA
-# =========================================================
-@app.post("/webhook/pix")
-async def webhook_pix(request: Request, db: Session = Depends(get_db)):
-    print("🔔 WEBHOOK PIX CHEGOU!") 
+def carregar_entregas_pendentes():
+    """Recoloca na fila o que não terminou (startup e varredura)."""
+    db = SessionLocal()
     try:
-        # 1. PEGA O CORPO BRUTO (Mais seguro contra erros de parsing)
-        body_bytes = await request.body()
-        body_str = body_bytes.decode("utf-8")
-        
-        # Tratamento de JSON ou Form Data
-        try:
-            data = json.loads(body_str)
-            if isinstance(data, list):
-                data = data[0]
-        except:
-            try:
-                parsed = urllib.parse.parse_qs(body_str)
-                data = {k: v[0] for k, v in parsed.items()}
-            except:
-                logger.error(f"❌ Não foi possível ler o corpo do webhook: {body_str}")
-                return {"status": "ignored"}
+        # 'processando' há muito tempo = processo morreu no meio da entrega
+        limite = datetime.utcnow() - timedelta(minutes=ENTREGA_TRAVADA_MINUTOS)
+        db.query(Entrega).filter(
+            Entrega.status == "processando",
+            Entrega.reservada_em < limite
+        ).update({Entrega.status: "erro"}, synchronize_session=False)
+        db.commit()
 
-        # 2. EXTRAÇÃO E NORMALIZAÇÃO DO ID
-        raw_tx_id = data.get("id") or data.get("external_reference") or data.get("uuid")
-        tx_id = str(raw_tx_id).lower() if raw_tx_id else None
-        
-        # Status
-        status_pix = str(data.get("status", "")).lower()
-        
-        # 🔥 AQUI ESTÁ O FILTRO: SÓ PASSA SE FOR PAGO
-        if status_pix not in ["paid", "approved", "completed", "succeeded"]:
-            return {"status": "ignored"}
+        pendentes = db.query(Entrega.id, Entrega.proxima_tentativa).filter(
+            Entrega.status.in_(["pendente", "erro"])
+        ).all()
+        for entrega_id, quando in pendentes:
+            fila_entregas.agendar(quando or datetime.utcnow(), entrega_id)
+        return len(pendentes)
+    finally:
+        db.close()
 
-        # 3. BUSCA O PEDIDO
-        pedido = db.query(Pedido).filter((Pedido.txid == tx_id) | (Pedido.transaction_id == tx_id)).first()
+def _varredura_entregas():
+    # Pega entregas de outros processos (ou que perderam o heap num restart)
+    while True:
+        time.sleep(ENTREGA_VARREDURA_SEGUNDOS)
+        db = SessionLocal()
+        try:
+            atrasadas = db.query(Entrega.id).filter(
+                Entrega.status.in_(["pendente", "erro"]),
+                Entrega.proxima_tentativa <= datetime.utcnow() - timedelta(seconds=ENTREGA_VARREDURA_SEGUNDOS)
+            ).all()
+            if atrasadas:
+                _despachar_entregas([e[0] for e in atrasadas])
+        except Exception as e:
+            logger.error(f"❌ [ENTREGAS] Erro na varredura: {e}")
+        finally:
+            db.close()
 
-        if not pedido:
-            print(f"❌ Pedido {tx_id} não encontrado no banco.")
-            return {"status": "ok", "msg": "Order not found"}
+def iniciar_fila_entregas():
+    total = carregar_entregas_pendentes()
+    fila_entregas.iniciar()
+    threading.Thread(target=_varredura_entregas, name="entregas-varredura", daemon=True).start()
+    logger.info(f"📦 Fila de entregas iniciada ({total} entregas pendentes recuperadas)")
 
-        if pedido.status == "approved" or pedido.status == "paid":
-            return {"status": "ok", "msg": "Already paid"}
+# =========================================================
+# 🎟️ POOL DE CONVITES DO CANAL VIP
+# =========================================================
+# Cada venda chamava create_chat_invite_link na hora da entrega (mais uma ida
+# ao Telegram e risco de 429 no pico). Agora um worker mantém uma pilha de
+# links de uso único por canal e a entrega só faz um UPDATE ... RETURNING.
+# Pilha vazia (canal novo, pico muito grande) = cria na hora, como antes.
+# Links usados são revogados em lote depois de CONVITES_REVOGAR_APOS_HORAS.
+CONVITES_POOL_ALVO = int(os.getenv("CONVITES_POOL_ALVO", "15"))
+CONVITES_POOL_MINIMO = int(os.getenv("CONVITES_POOL_MINIMO", "5"))
+CONVITES_REPOSICAO_SEGUNDOS = int(os.getenv("CONVITES_REPOSICAO_SEGUNDOS", "60"))
+CONVITES_REVOGAR_APOS_HORAS = int(os.getenv("CONVITES_REVOGAR_APOS_HORAS", "72"))
+CONVITES_REVOGAR_LOTE = 200
+
+# Acorda o worker antes do intervalo quando uma pilha fica abaixo do mínimo
+_repor_convites = threading.Event()
+
+def canal_vip_id(bot_data):
+    canal_str = str(bot_data.id_canal_vip).strip()
+    return int(canal_str) if canal_str.lstrip('-').isdigit() else canal_str
+
+def consumir_convite(db: Session, bot_id: int, canal, pedido_id: Optional[int] = None) -> Optional[str]:
+    """
+    Tira o convite mais antigo da pilha do canal (sem commit: o chamador grava
+    o link junto com a entrega). None = pilha vazia.
+    """
+    convites = ConviteVip.__table__
+    pilha = (ConviteVip.bot_id == bot_id, ConviteVip.canal_id == str(canal), ConviteVip.status == "disponivel")
+    proximo = select(ConviteVip.id).where(*pilha).order_by(ConviteVip.id).limit(1)
+    if db.bind.dialect.name == "postgresql":
+        # Entregas simultâneas pegam linhas diferentes em vez de esperar a mesma
+        proximo = proximo.with_for_update(skip_locked=True)
+    link = db.execute(
+        convites.update()
+        .where(convites.c.id == proximo.scalar_subquery(), convites.c.status == "disponivel")
+        .values(status="usado", pedido_id=pedido_id, usado_em=datetime.utcnow())
+        .returning(convites.c.invite_link)
+    ).scalar()
+
+    restantes = db.query(func.count(ConviteVip.id)).filter(*pilha).scalar() if link else 0
+    if restantes < CONVITES_POOL_MINIMO:
+        _repor_convites.set()
+    return link
+
+def obter_convite(db: Session, tb, bot_data, canal, pedido: Pedido, nome: str) -> str:
+    """Convite da pilha; se ela estiver vazia, cria um na hora (levanta erro do Telegram)."""
+    link = consumir_convite(db, bot_data.id, canal, pedido.id)
+    if link:
+        return link
+    logger.warning(f"🎟️ Pilha de convites do bot {bot_data.id} vazia, criando link na hora.")
+    return tb.create_chat_invite_link(chat_id=canal, member_limit=1, name=nome).invite_link
+
+def _repor_pilhas(db: Session):
+    disponiveis = dict(
+        ((bot_id, canal), total) for bot_id, canal, total in
+        db.query(ConviteVip.bot_id, ConviteVip.canal_id, func.count(ConviteVip.id))
+        .filter(ConviteVip.status == "disponivel")
+        .group_by(ConviteVip.bot_id, ConviteVip.canal_id).all()
+    )
+    bot_ids = [b[0] for b in db.query(Bot.id).filter(Bot.status == "ativo", Bot.id_canal_vip.isnot(None)).all()]
+    for bot_id in bot_ids:
+        bot_data = bot_registry.obter_por_id(bot_id, db)
+        if not bot_data or not str(bot_data.id_canal_vip or "").strip():
+            continue
+        canal = canal_vip_id(bot_data)
+        falta = CONVITES_POOL_ALVO - disponiveis.get((bot_id, str(canal)), 0)
+        if falta <= 0:
+            continue
+        tb = bot_registry.cliente(bot_data.token)
+        novos = []
+        try:
+            for _ in range(falta):
+                convite = tb.create_chat_invite_link(chat_id=canal, member_limit=1, name="VIP")
+                novos.append({"bot_id": bot_id, "canal_id": str(canal), "invite_link": convite.invite_link,
+                              "status": "disponivel", "created_at": datetime.utcnow()})
+        except Exception as e:
+            # Bot sem permissão no canal, canal apagado...: tenta de novo no próximo ciclo
+            logger.warning(f"⚠️ [CONVITES] Bot {bot_id}: parou após {len(novos)} links ({e})")
+        if novos:
+            db.execute(insert(ConviteVip), novos)
+            db.commit()
+            logger.info(f"🎟️ [CONVITES] Bot {bot_id}: +{len(novos)} convites na pilha")
+
+def _revogar_convites(db: Session):
+    # Usados há mais de N horas + disponíveis de um canal que o bot não usa mais
+    limite = datetime.utcnow() - timedelta(hours=CONVITES_REVOGAR_APOS_HORAS)
+    canal_trocado = Bot.id.is_(None) | Bot.id_canal_vip.is_(None) | (func.trim(Bot.id_canal_vip) != ConviteVip.canal_id)
+    candidatos = db.query(ConviteVip.id, ConviteVip.bot_id, ConviteVip.canal_id, ConviteVip.invite_link).outerjoin(
+        Bot, Bot.id == ConviteVip.bot_id
+    ).filter(
+        ((ConviteVip.status == "usado") & (ConviteVip.usado_em < limite))
+        | ((ConviteVip.status == "disponivel") & canal_trocado)
+    ).order_by(ConviteVip.id).limit(CONVITES_REVOGAR_LOTE).all()
+
+    revogados = []
+    for c in candidatos:
+        bot_data = bot_registry.obter_por_id(c.bot_id, db)
+        if not bot_data:
+            revogados.append(c.id)  # bot excluído: o link morreu junto
+            continue
+        canal = int(c.canal_id) if c.canal_id.lstrip('-').isdigit() else c.canal_id
+        try:
+            bot_registry.cliente(bot_data.token).revoke_chat_invite_link(canal, c.invite_link)
+            revogados.append(c.id)
+        except telebot.apihelper.ApiTelegramException:
+            revogados.append(c.id)  # link inexistente / canal sem o bot: nada a revogar
+        except Exception as e:
+            logger.warning(f"⚠️ [CONVITES] Falha ao revogar convite {c.id}: {e}")
 
-        # --- 4. CÁLCULO DA DATA DE EXPIRAÇÃO ---
-        now = datetime.utcnow()
-        data_validade = None 
-        
-        # A) Pelo ID do plano
-        if pedido.plano_id:
-            pid = int(pedido.plano_id) if str(pedido.plano_id).isdigit() else None
-            if pid:
-                plano_db = db.query(PlanoConfig).filter(PlanoConfig.id == pid).first()
-                if plano_db and plano_db.dias_duracao and plano_db.dias_duracao < 90000:
-                    data_validade = now + timedelta(days=plano_db.dias_duracao)
-
-        # B) Fallback pelo nome
-        if not data_validade and pedido.plano_nome:
-            nm = pedido.plano_nome.lower()
-            if "vital" not in nm and "mega" not in nm and "eterno" not in nm:
-                dias = 30 # Padrão
-                if "24" in nm or "diario" in nm or "1 dia" in nm: dias = 1
-                elif "semanal" in nm: dias = 7
-                elif "trimestral" in nm: dias = 90
-                elif "anual" in nm: dias = 365
-                data_validade = now + timedelta(days=dias)
-
-        # 5. ATUALIZA O PEDIDO
-        pedido.status = "approved" 
-        pedido.data_aprovacao = now
-        pedido.data_expiracao = data_validade     
-        pedido.custom_expiration = data_validade
-        pedido.mensagem_enviada = True
-        
-        # 🔥 Atualiza Funil (Para os gráficos funcionarem)
-        pedido.status_funil = 'fundo'
-        pedido.pagou_em = now
-        
+    if revogados:
+        db.query(ConviteVip).filter(ConviteVip.id.in_(revogados)).update(
+            {ConviteVip.status: "revogado", ConviteVip.revogado_em: datetime.utcnow()}, synchronize_session=False
+        )
         db.commit()
-        
-        # 🔥 ATUALIZA ESTATÍSTICAS DE TRACKING (VENDAS/FATURAMENTO)
-        if pedido.tracking_id:
-            try:
-                t_link = db.query(TrackingLink).filter(TrackingLink.id == pedido.tracking_id).first()
-                if t_link:
-                    t_link.vendas += 1
-                    t_link.faturamento += pedido.valor
-                    db.commit()
-                    logger.info(f"📈 Tracking atualizado: {t_link.nome} (+R$ {pedido.valor})")
-            except Exception as e_track:
-                logger.error(f"Erro ao atualizar tracking: {e_track}")
+        logger.info(f"🧹 [CONVITES] {len(revogados)} convites revogados")
 
-        texto_validade = data_validade.strftime("%d/%m/%Y") if data_validade else "VITALÍCIO ♾️"
-        print(f"✅ Pedido {tx_id} APROVADO! Validade: {texto_validade}")
-        
-        # 6. ENTREGA E NOTIFICAÇÕES (EM HTML)
+def _loop_convites_vip():
+    while True:
+        if not coordenador_jobs.lider("convites-vip"):
+            time.sleep(COORDENADOR_INTERVALO_SEGUNDOS)
+            continue
+        db = SessionLocal()
         try:
-            bot_data = db.query(Bot).filter(Bot.id == pedido.bot_id).first()
-            if bot_data:
-                tb = telebot.TeleBot(bot_data.token)
-                
-                # --- A) ENTREGA PRODUTO PRINCIPAL ---
-                try: 
-                    # Limpeza e Desbanimento
-                    canal_id = bot_data.id_canal_vip
-                    if str(canal_id).replace("-","").isdigit():
-                         canal_id = int(str(canal_id).strip())
-
-                    try: tb.unban_chat_member(canal_id, int(pedido.telegram_id))
-                    except: pass
+            _repor_pilhas(db)
+            _revogar_convites(db)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"❌ [CONVITES] Erro no ciclo do pool: {e}")
+        finally:
+            db.close()
+        _repor_convites.wait(CONVITES_REPOSICAO_SEGUNDOS)
+        _repor_convites.clear()
 
-                    # Gera Link Único
-                    link_acesso = None
-                    try:
-                        convite = tb.create_chat_invite_link(
-                            chat_id=canal_id, 
-                            member_limit=1, 
-                            name=f"Venda {pedido.first_name}"
-                        )
-                        link_acesso = convite.invite_link
-                    except Exception as e_link:
-                        logger.warning(f"Erro ao gerar link: {e_link}. Usando link salvo.")
-                        link_acesso = pedido.link_acesso 
-
-                    if link_acesso:
-                        msg_cliente = (
-                            f"✅ <b>Pagamento Confirmado!</b>\n"
-                            f"📅 Validade: <b>{texto_validade}</b>\n\n"
-                            f"Seu acesso exclusivo:\n👉 {link_acesso}"
-                        )
-                        tb.send_message(int(pedido.telegram_id), msg_cliente, parse_mode="HTML")
-                    else:
-                        tb.send_message(int(pedido.telegram_id), f"✅ <b>Pagamento Confirmado!</b>\nVocê já pode acessar o canal VIP.", parse_mode="HTML")
+def iniciar_pool_convites():
+    threading.Thread(target=_loop_convites_vip, name="convites-vip", daemon=True).start()
+    logger.info(f"🎟️ Pool de convites VIP iniciado (alvo {CONVITES_POOL_ALVO} por canal)")
 
-                except Exception as e_main:
-                    logger.error(f"Erro na entrega principal: {e_main}")
+coordenador_jobs.registrar("convites-vip", iniciar_pool_convites)
 
-                # --- B) ENTREGA DO ORDER BUMP (HTML) ---
-                if pedido.tem_order_bump:
-                    logger.info(f"🎁 [PIX] Entregando Order Bump...")
-                    try:
-                        bump_config = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == bot_data.id).first()
-                        if bump_config and bump_config.link_acesso:
-                            msg_bump = f"""🎁 <b>BÔNUS LIBERADO!</b>
-
-Você também garantiu acesso ao: 
-👉 <b>{bump_config.nome_produto}</b>
-
-🔗 <b>Acesse seu conteúdo extra abaixo:</b>
-{bump_config.link_acesso}"""
-                            tb.send_message(int(pedido.telegram_id), msg_bump, parse_mode="HTML")
-                    except Exception as e_bump:
-                        logger.error(f"Erro ao entregar Bump: {e_bump}")
-
-                # --- C) NOTIFICAÇÃO AO ADMIN (CORRIGIDO: USA FUNÇÃO GLOBAL) ---
-                # 🔥 Agora avisa o admin principal E os admins extras
-                msg_admin = (
-                    f"💰 <b>VENDA REALIZADA!</b>\n\n"
-                    f"🤖 Bot: <b>{bot_data.nome}</b>\n"
-                    f"👤 Cliente: {pedido.first_name} (@{pedido.username})\n"
-                    f"📦 Plano: {pedido.plano_nome}\n"
-                    f"💵 Valor: <b>R$ {pedido.valor:.2f}</b>\n"
-                    f"📅 Vence em: {texto_validade}"
-                )
-                notificar_admin_principal(bot_data, msg_admin)
+# =========================================================
+# 💳 WEBHOOK PIX (PUSHIN PAY)
+# =========================================================
+@app.post("/webhook/pix")
+def webhook_pix(body_str: str = Depends(corpo_da_requisicao), db: Session = Depends(get_db)):
+    logger.info("🔔 Webhook PIX recebido")
+    try:
+        data = ler_corpo_webhook(body_str)
+        if data is None:
+            logger.error(f"❌ Não foi possível ler o corpo do webhook: {body_str}")
+            return {"status": "ignored"}
 
-        except Exception as e_tg:
-            print(f"❌ Erro Telegram/Entrega: {e_tg}")
+        raw_tx_id = data.get("id") or data.get("external_reference") or data.get("uuid")
+        tx_id = str(raw_tx_id).lower() if raw_tx_id else None
+        status_pix = str(data.get("status", "")).lower()
+
+        # 🔥 SÓ PASSA SE FOR PAGO
+        if status_pix not in STATUS_GATEWAY_PAGO:
+            return {"status": "ignored"}
 
+        resultado = registrar_pagamento(db, tx_id, "approved", "pix", status_pix, data)
+        if resultado == "nao_encontrado":
+            logger.warning(f"❌ Pedido {tx_id} não encontrado no banco.")
+            return {"status": "ok", "msg": "Order not found"}
+        if resultado == "ja_pago":
+            return {"status": "ok", "msg": "Already paid"}
         return {"status": "received"}
 
     except Exception as e:
-        print(f"❌ ERRO CRÍTICO NO WEBHOOK: {e}")
+        logger.error(f"❌ ERRO CRÍTICO NO WEBHOOK: {e}")
         return {"status": "error"}
 
 # =========================================================
@@ -2356,7 +4167,7 @@ def enviar_oferta_final(bot_temp, chat_id, fluxo, bot_id, db):
     """Envia a oferta final (Planos) com HTML"""
     mk = types.InlineKeyboardMarkup()
     if fluxo and fluxo.mostrar_planos_2:
-        planos = db.query(PlanoConfig).filter(PlanoConfig.bot_id == bot_id).all()
+        planos = flow_cache.obter(bot_id, db).planos
         for p in planos:
             mk.add(types.InlineKeyboardButton(
                 f"💎 {p.nome_exibicao} - R$ {p.preco_atual:.2f}", 
@@ -2368,12 +4179,8 @@ def enviar_oferta_final(bot_temp, chat_id, fluxo, bot_id, db):
     
     try:
         if media:
-            if media.lower().endswith(('.mp4', '.mov', '.avi')): 
-                # 🔥 parse_mode="HTML"
-                bot_temp.send_video(chat_id, media, caption=texto, reply_markup=mk, parse_mode="HTML")
-            else: 
-                # 🔥 parse_mode="HTML"
-                bot_temp.send_photo(chat_id, media, caption=texto, reply_markup=mk, parse_mode="HTML")
+            # 🔥 parse_mode="HTML"
+            enviar_midia(bot_temp, bot_id, chat_id, media, caption=texto, reply_markup=mk, parse_mode="HTML")
         else:
             # 🔥 parse_mode="HTML"
             bot_temp.send_message(chat_id, texto, reply_markup=mk, parse_mode="HTML")
@@ -2383,62 +4190,7 @@ def enviar_oferta_final(bot_temp, chat_id, fluxo, bot_id, db):
         # Fallback sem HTML
         bot_temp.send_message(chat_id, texto, reply_markup=mk)
 
-def enviar_passo_automatico(bot_temp, chat_id, passo_atual, bot_db, db):
-    """
-    Envia um passo e, se não tiver botão e tiver delay, 
-    agenda e envia o PRÓXIMO (ou a oferta) automaticamente.
-    """
-    try:
-        # 1. Configura botão se houver
-        markup_step = types.InlineKeyboardMarkup()
-        if passo_atual.mostrar_botao:
-            # Verifica se existe um PRÓXIMO passo depois deste
-            prox = db.query(BotFlowStep).filter(
-                BotFlowStep.bot_id == bot_db.id, 
-                BotFlowStep.step_order == passo_atual.step_order + 1
-            ).first()
-            
-            callback = f"next_step_{passo_atual.step_order}" if prox else "go_checkout"
-            markup_step.add(types.InlineKeyboardButton(text=passo_atual.btn_texto, callback_data=callback))
-
-        # 2. Envia a mensagem deste passo
-        sent_msg = None
-        if passo_atual.msg_media:
-            try:
-                if passo_atual.msg_media.lower().endswith(('.mp4', '.mov')):
-                    sent_msg = bot_temp.send_video(chat_id, passo_atual.msg_media, caption=passo_atual.msg_texto, reply_markup=markup_step if passo_atual.mostrar_botao else None)
-                else:
-                    sent_msg = bot_temp.send_photo(chat_id, passo_atual.msg_media, caption=passo_atual.msg_texto, reply_markup=markup_step if passo_atual.mostrar_botao else None)
-            except:
-                sent_msg = bot_temp.send_message(chat_id, passo_atual.msg_texto, reply_markup=markup_step if passo_atual.mostrar_botao else None)
-        else:
-            sent_msg = bot_temp.send_message(chat_id, passo_atual.msg_texto, reply_markup=markup_step if passo_atual.mostrar_botao else None)
-
-        # 3. Lógica Automática (Sem botão + Delay)
-        if not passo_atual.mostrar_botao and passo_atual.delay_seconds > 0:
-            logger.info(f"⏳ [BOT {bot_db.id}] Passo {passo_atual.step_order}: Aguardando {passo_atual.delay_seconds}s...")
-            time.sleep(passo_atual.delay_seconds)
-            
-            # Auto-destruir este passo (se configurado)
-            if passo_atual.autodestruir and sent_msg:
-                try:
-                    bot_temp.delete_message(chat_id, sent_msg.message_id)
-                except: pass
-            
-            # 🔥 DECISÃO: Chama o próximo passo OU a Oferta Final
-            proximo_passo = db.query(BotFlowStep).filter(
-                BotFlowStep.bot_id == bot_db.id, 
-                BotFlowStep.step_order == passo_atual.step_order + 1
-            ).first()
-            
-            if proximo_passo:
-                enviar_passo_automatico(bot_temp, chat_id, proximo_passo, bot_db, db)
-            else:
-                # FIM DA LINHA -> Manda Oferta
-                enviar_oferta_final(bot_temp, chat_id, bot_db.fluxo, bot_db.id, db)
-
-    except Exception as e:
-        logger.error(f"Erro no passo automático {passo_atual.step_order}: {e}")
+# enviar_passo_automatico: definida mais abaixo (TRECHO 3)
 
 # =========================================================
 # 3. WEBHOOK TELEGRAM (START + GATEKEEPER + COMANDOS)
@@ -2447,16 +4199,39 @@ def enviar_passo_automatico(bot_temp, chat_id, passo_atual, bot_db, db):
 # 3. WEBHOOK TELEGRAM (START + GATEKEEPER + COMANDOS)
 # =========================================================
 @app.post("/webhook/{token}")
-async def receber_update_telegram(token: str, req: Request, db: Session = Depends(get_db)):
+async def receber_update_telegram(token: str, req: Request):
+    """
+    Só confirma o recebimento para o Telegram.
+    Todo o trabalho bloqueante (banco, API do Telegram, PIX) roda no pool de workers.
+    """
     if token == "pix": return {"status": "ignored"}
-    
-    bot_db = db.query(Bot).filter(Bot.token == token).first()
-    if not bot_db or bot_db.status == "pausado": return {"status": "ignored"}
 
     try:
         body = await req.json()
+    except Exception:
+        return {"status": "ignored"}
+
+    if not despachar_update_telegram(token, body):
+        # Fila cheia: devolve 503 para o Telegram reenviar o update mais tarde
+        raise HTTPException(status_code=503, detail="Fila de processamento cheia")
+
+    return {"status": "ok"}
+
+def processar_update_telegram(token: str, body: dict):
+    """Processa um update do Telegram dentro do pool (sessão de banco própria)."""
+    db = SessionLocal()
+    try:
+        _processar_update_telegram(token, body, db)
+    finally:
+        db.close()
+
+def _processar_update_telegram(token: str, body: dict, db: Session):
+    bot_db = bot_registry.obter_por_token(token, db)
+    if not bot_db or bot_db.status == "pausado": return
+
+    try:
         update = telebot.types.Update.de_json(body)
-        bot_temp = telebot.TeleBot(token)
+        bot_temp = bot_registry.cliente(token)
         message = update.message if update.message else None
         
         # ----------------------------------------
@@ -2470,27 +4245,8 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                 for member in message.new_chat_members:
                     if member.is_bot: continue
                     
-                    # Verifica pagamento
-                    pedido = db.query(Pedido).filter(
-                        Pedido.bot_id == bot_db.id,
-                        Pedido.telegram_id == str(member.id),
-                        Pedido.status.in_(['paid', 'approved'])
-                    ).order_by(desc(Pedido.created_at)).first()
-                    
-                    allowed = False
-                    if pedido:
-                        if pedido.data_expiracao:
-                            if datetime.utcnow() < pedido.data_expiracao: allowed = True
-                        elif pedido.plano_nome:
-                            nm = pedido.plano_nome.lower()
-                            if "vital" in nm or "mega" in nm or "eterno" in nm: allowed = True
-                            else:
-                                d = 30
-                                if "diario" in nm or "24" in nm: d = 1
-                                elif "semanal" in nm: d = 7
-                                elif "trimestral" in nm: d = 90
-                                elif "anual" in nm: d = 365
-                                if pedido.created_at and datetime.utcnow() < (pedido.created_at + timedelta(days=d)): allowed = True
+                    # Verifica a assinatura (busca pela PK)
+                    allowed = assinatura_ativa(db, bot_db.id, member.id) is not None
                     
                     if not allowed:
                         try:
@@ -2499,7 +4255,7 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                             try: bot_temp.send_message(member.id, "🚫 <b>Acesso Negado.</b>\nPor favor, realize o pagamento.", parse_mode="HTML")
                             except: pass
                         except: pass
-            return {"status": "checked"}
+            return
 
         # ----------------------------------------
         # 👋 2. COMANDOS (/start, /suporte, /status)
@@ -2514,26 +4270,24 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                     sup = bot_db.suporte_username.replace("@", "")
                     bot_temp.send_message(chat_id, f"💬 <b>Falar com Suporte:</b>\n\n👉 @{sup}", parse_mode="HTML")
                 else: bot_temp.send_message(chat_id, "⚠️ Nenhum suporte definido.")
-                return {"status": "ok"}
+                return
 
             # --- /STATUS ---
             if txt == "/status":
-                pedido = db.query(Pedido).filter(
-                    Pedido.bot_id == bot_db.id,
-                    Pedido.telegram_id == str(chat_id),
-                    Pedido.status.in_(['paid', 'approved'])
-                ).order_by(desc(Pedido.created_at)).first()
+                assinatura = db.get(Assinatura, (bot_db.id, str(chat_id)))
                 
-                if pedido:
+                if assinatura:
                     validade = "VITALÍCIO ♾️"
-                    if pedido.data_expiracao:
-                        if datetime.utcnow() > pedido.data_expiracao:
+                    if assinatura.expires_at:
+                        if datetime.utcnow() > assinatura.expires_at:
                             bot_temp.send_message(chat_id, "❌ <b>Assinatura expirada!</b>", parse_mode="HTML")
-                            return {"status": "ok"}
-                        validade = pedido.data_expiracao.strftime("%d/%m/%Y")
-                    bot_temp.send_message(chat_id, f"✅ <b>Assinatura Ativa!</b>\n\n💎 Plano: {pedido.plano_nome}\n📅 Vence em: {validade}", parse_mode="HTML")
+                            return
+                        validade = assinatura.expires_at.strftime("%d/%m/%Y")
+                    pedido = db.get(Pedido, assinatura.source_pedido_id) if assinatura.source_pedido_id else None
+                    plano_nome = pedido.plano_nome if pedido else "-"
+                    bot_temp.send_message(chat_id, f"✅ <b>Assinatura Ativa!</b>\n\n💎 Plano: {plano_nome}\n📅 Vence em: {validade}", parse_mode="HTML")
                 else: bot_temp.send_message(chat_id, "❌ <b>Nenhuma assinatura ativa.</b>", parse_mode="HTML")
-                return {"status": "ok"}
+                return
 
             # --- /START ---
             if txt == "/start" or txt.startswith("/start "):
@@ -2563,31 +4317,16 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
 
                 if pedidos_resgate:
                     logger.info(f"🚑 RECUPERANDO {len(pedidos_resgate)} vendas para {first_name}")
+                    # A entrega (convite + bônus) vai para o pipeline de liquidação,
+                    # que só marca mensagem_enviada depois de enviar de verdade
+                    reabertas = []
                     for p in pedidos_resgate:
-                        p.telegram_id = user_id_str
-                        p.mensagem_enviada = True
-                        db.commit()
-                        try:
-                            # 1. ENTREGA PRINCIPAL
-                            canal_str = str(bot_db.id_canal_vip).strip()
-                            canal_id = int(canal_str) if canal_str.lstrip('-').isdigit() else canal_str
-                            try: bot_temp.unban_chat_member(canal_id, chat_id)
-                            except: pass
-                            convite = bot_temp.create_chat_invite_link(chat_id=canal_id, member_limit=1, name=f"Recup {first_name}")
-                            msg_rec = f"🎉 <b>Pagamento Encontrado!</b>\n\nAqui está seu link:\n👉 {convite.invite_link}"
-                            bot_temp.send_message(chat_id, msg_rec, parse_mode="HTML")
-
-                            # 🔥 2. ENTREGA DO BUMP NA RECUPERAÇÃO (CORRIGIDO)
-                            if p.tem_order_bump:
-                                bump_conf = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == bot_db.id).first()
-                                if bump_conf and bump_conf.link_acesso:
-                                    msg_bump = f"🎁 <b>BÔNUS: {bump_conf.nome_produto}</b>\n\nAqui está seu acesso extra:\n👉 {bump_conf.link_acesso}"
-                                    bot_temp.send_message(chat_id, msg_bump, parse_mode="HTML")
-                                    logger.info("✅ Order Bump recuperado/entregue!")
-
-                        except Exception as e_rec:
-                            logger.error(f"Erro rec: {e_rec}")
-                            bot_temp.send_message(chat_id, "✅ Pagamento confirmado! Tente entrar no canal.")
+                        trocar_telegram_id_pedido(db, p, user_id_str)
+                        entrega = abrir_entrega(db, p, "recuperacao")
+                        if entrega: reabertas.append(entrega.id)
+                    db.commit()
+                    for entrega_id in reabertas:
+                        entrega_executor.submit(processar_entrega, entrega_id)
 
                 # Tracking
                 track_id = None
@@ -2606,11 +4345,13 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                     if not lead:
                         lead = Lead(user_id=user_id_str, nome=first_name, username=username_raw, bot_id=bot_db.id, tracking_id=track_id)
                         db.add(lead)
+                        contabilizar_novo_lead(db, lead)
                     db.commit()
-                except: pass
+                except: db.rollback()
 
                 # Envio Menu
-                flow = db.query(BotFlow).filter(BotFlow.bot_id == bot_db.id).first()
+                snap = flow_cache.obter(bot_db.id, db)
+                flow = snap.fluxo
                 modo = getattr(flow, 'start_mode', 'padrao') if flow else 'padrao'
                 msg_txt = flow.msg_boas_vindas if flow else "Olá!"
                 media = flow.media_url if flow else None
@@ -2625,8 +4366,7 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                 # SE FOR PADRÃO (AQUI ESTÁ A CORREÇÃO DOS PREÇOS ✅)
                 else:
                     if flow and flow.mostrar_planos_1:
-                        planos = db.query(PlanoConfig).filter(PlanoConfig.bot_id == bot_db.id).all()
-                        for pl in planos: 
+                        for pl in snap.planos: 
                             # Formata preço igual ao seu outro projeto
                             preco_txt = f"R$ {pl.preco_atual:.2f}".replace('.', ',')
                             mk.add(types.InlineKeyboardButton(f"💎 {pl.nome_exibicao} - {preco_txt}", callback_data=f"checkout_{pl.id}"))
@@ -2634,13 +4374,11 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                         mk.add(types.InlineKeyboardButton(flow.btn_text_1 if flow else "Ver Conteúdo", callback_data="step_1"))
 
                 try:
-                    if media:
-                        if media.endswith(('.mp4', '.mov')): bot_temp.send_video(chat_id, media, caption=msg_txt, reply_markup=mk, parse_mode="HTML")
-                        else: bot_temp.send_photo(chat_id, media, caption=msg_txt, reply_markup=mk, parse_mode="HTML")
+                    if media: enviar_midia(bot_temp, bot_db.id, chat_id, media, caption=msg_txt, reply_markup=mk, parse_mode="HTML")
                     else: bot_temp.send_message(chat_id, msg_txt, reply_markup=mk, parse_mode="HTML")
                 except: bot_temp.send_message(chat_id, msg_txt, reply_markup=mk)
 
-                return {"status": "ok"}
+                return
 
         # ----------------------------------------
         # 🎮 3. CALLBACKS (BOTÕES)
@@ -2661,7 +4399,8 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                 try: current_step = int(data.split("_")[1])
                 except: current_step = 1
                 
-                steps = db.query(BotFlowStep).filter(BotFlowStep.bot_id == bot_db.id).order_by(BotFlowStep.step_order).all()
+                snap = flow_cache.obter(bot_db.id, db)
+                steps = snap.passos
                 target_step = None
                 is_last = False
                 
@@ -2676,37 +4415,28 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                     sent_msg = None
                     try:
                         if target_step.msg_media:
-                            if target_step.msg_media.lower().endswith(('.mp4', '.mov')):
-                                sent_msg = bot_temp.send_video(chat_id, target_step.msg_media, caption=target_step.msg_texto, reply_markup=mk, parse_mode="HTML")
-                            else:
-                                sent_msg = bot_temp.send_photo(chat_id, target_step.msg_media, caption=target_step.msg_texto, reply_markup=mk, parse_mode="HTML")
+                            sent_msg = enviar_midia(bot_temp, bot_db.id, chat_id, target_step.msg_media, caption=target_step.msg_texto, reply_markup=mk, parse_mode="HTML")
                         else:
                             sent_msg = bot_temp.send_message(chat_id, target_step.msg_texto, reply_markup=mk, parse_mode="HTML")
                     except:
                         sent_msg = bot_temp.send_message(chat_id, target_step.msg_texto or "...", reply_markup=mk)
 
-                    if not target_step.mostrar_botao and target_step.delay_seconds > 0:
-                        time.sleep(target_step.delay_seconds)
-                        if target_step.autodestruir and sent_msg:
-                            try: bot_temp.delete_message(chat_id, sent_msg.message_id)
-                            except: pass
-                        
-                        prox = db.query(BotFlowStep).filter(BotFlowStep.bot_id == bot_db.id, BotFlowStep.step_order == target_step.step_order + 1).first()
-                        if prox: enviar_passo_automatico(bot_temp, chat_id, prox, bot_db, db)
-                        else: enviar_oferta_final(bot_temp, chat_id, bot_db.fluxo, bot_db.id, db)
+                    # Sem botão: agenda a continuação (sem prender a thread do webhook)
+                    agendar_continuacao_fluxo(db, bot_temp, chat_id, target_step, bot_db, sent_msg)
                 else:
-                    enviar_oferta_final(bot_temp, chat_id, bot_db.fluxo, bot_db.id, db)
+                    enviar_oferta_final(bot_temp, chat_id, snap.fluxo, bot_db.id, db)
 
             # --- B) CHECKOUT ---
             elif data.startswith("checkout_"):
                 plano_id = data.split("_")[1]
-                plano = db.query(PlanoConfig).filter(PlanoConfig.id == plano_id).first()
-                if not plano: return {"status": "error"}
+                snap = flow_cache.obter(bot_db.id, db)
+                plano = snap.plano(plano_id)
+                if not plano: return
 
                 lead_origem = db.query(Lead).filter(Lead.user_id == str(chat_id), Lead.bot_id == bot_db.id).first()
                 track_id_pedido = lead_origem.tracking_id if lead_origem else None
 
-                bump = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == bot_db.id, OrderBumpConfig.ativo == True).first()
+                bump = snap.bump_ativo
                 
                 if bump:
                     mk = types.InlineKeyboardMarkup()
@@ -2717,55 +4447,33 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                     txt_bump = bump.msg_texto or f"Levar {bump.nome_produto} junto?"
                     try:
                         if bump.msg_media:
-                            if bump.msg_media.lower().endswith(('.mp4','.mov')):
-                                bot_temp.send_video(chat_id, bump.msg_media, caption=txt_bump, reply_markup=mk, parse_mode="HTML")
-                            else:
-                                bot_temp.send_photo(chat_id, bump.msg_media, caption=txt_bump, reply_markup=mk, parse_mode="HTML")
+                            enviar_midia(bot_temp, bot_db.id, chat_id, bump.msg_media, caption=txt_bump, reply_markup=mk, parse_mode="HTML")
                         else:
                             bot_temp.send_message(chat_id, txt_bump, reply_markup=mk, parse_mode="HTML")
                     except:
                         bot_temp.send_message(chat_id, txt_bump, reply_markup=mk, parse_mode="HTML")
                 else:
                     # PIX DIRETO
-                    msg_wait = bot_temp.send_message(chat_id, "⏳ Gerando <b>PIX</b>...", parse_mode="HTML")
-                    mytx = str(uuid.uuid4())
-                    pix = gerar_pix_pushinpay(plano.preco_atual, mytx)
-                    
-                    if pix:
-                        qr = pix.get('qr_code_text') or pix.get('qr_code')
-                        txid = str(pix.get('id') or mytx).lower()
-                        
-                        novo_pedido = Pedido(
-                            bot_id=bot_db.id, telegram_id=str(chat_id), first_name=first_name, username=username,
-                            plano_nome=plano.nome_exibicao, plano_id=plano.id, valor=plano.preco_atual,
-                            transaction_id=txid, qr_code=qr, status="pending", tem_order_bump=False, created_at=datetime.utcnow(),
-                            tracking_id=track_id_pedido
-                        )
-                        db.add(novo_pedido)
-                        db.commit()
-                        
-                        try: bot_temp.delete_message(chat_id, msg_wait.message_id)
-                        except: pass
-                        
-                        markup_pix = types.InlineKeyboardMarkup()
-                        markup_pix.add(types.InlineKeyboardButton("🔄 VERIFICAR STATUS DO PAGAMENTO", callback_data=f"check_payment_{txid}"))
-
-                        msg_pix = f"🌟 Seu pagamento foi gerado com sucesso:\n🎁 Plano: <b>{plano.nome_exibicao}</b>\n💰 Valor: <b>R$ {plano.preco_atual:.2f}</b>\n🔐 Pague via Pix Copia e Cola:\n\n<pre>{qr}</pre>\n\n👆 Toque na chave PIX acima para copiá-la\n‼️ Após o pagamento, o acesso será liberado automaticamente!"
-                        
-                        bot_temp.send_message(chat_id, msg_pix, parse_mode="HTML", reply_markup=markup_pix)
+                    pedido, _ = gerar_pix_checkout(
+                        db, bot_temp, bot_db, chat_id, first_name, username,
+                        plano.id, plano.nome_exibicao, plano.preco_atual, tracking_id=track_id_pedido
+                    )
+                    if pedido:
+                        enviar_mensagem_pix(bot_temp, chat_id, pedido, plano.nome_exibicao)
                     else:
-                        bot_temp.send_message(chat_id, "❌ Erro ao gerar PIX.")
+                        bot_temp.send_message(chat_id, aviso_falha_pix())
 
             # --- C) BUMP YES/NO ---
             elif data.startswith("bump_yes_") or data.startswith("bump_no_"):
                 aceitou = "yes" in data
                 pid = data.split("_")[2]
-                plano = db.query(PlanoConfig).filter(PlanoConfig.id == pid).first()
+                snap = flow_cache.obter(bot_db.id, db)
+                plano = snap.plano(pid)
                 
                 lead_origem = db.query(Lead).filter(Lead.user_id == str(chat_id), Lead.bot_id == bot_db.id).first()
                 track_id_pedido = lead_origem.tracking_id if lead_origem else None
 
-                bump = db.query(OrderBumpConfig).filter(OrderBumpConfig.bot_id == bot_db.id).first()
+                bump = snap.bump
                 
                 if bump and bump.autodestruir:
                     try: bot_temp.delete_message(chat_id, update.callback_query.message.message_id)
@@ -2777,32 +4485,15 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                     valor_final += bump.preco
                     nome_final += f" + {bump.nome_produto}"
                 
-                msg_wait = bot_temp.send_message(chat_id, f"⏳ Gerando PIX: <b>{nome_final}</b>...", parse_mode="HTML")
-                mytx = str(uuid.uuid4())
-                pix = gerar_pix_pushinpay(valor_final, mytx)
-                
-                if pix:
-                    qr = pix.get('qr_code_text') or pix.get('qr_code')
-                    txid = str(pix.get('id') or mytx).lower()
-                    
-                    novo_pedido = Pedido(
-                        bot_id=bot_db.id, telegram_id=str(chat_id), first_name=first_name, username=username,
-                        plano_nome=nome_final, plano_id=plano.id, valor=valor_final,
-                        transaction_id=txid, qr_code=qr, status="pending", tem_order_bump=aceitou, created_at=datetime.utcnow(),
-                        tracking_id=track_id_pedido
-                    )
-                    db.add(novo_pedido)
-                    db.commit()
-                    
-                    try: bot_temp.delete_message(chat_id, msg_wait.message_id)
-                    except: pass
-                    
-                    markup_pix = types.InlineKeyboardMarkup()
-                    markup_pix.add(types.InlineKeyboardButton("🔄 VERIFICAR STATUS DO PAGAMENTO", callback_data=f"check_payment_{txid}"))
-
-                    msg_pix = f"🌟 Seu pagamento foi gerado com sucesso:\n🎁 Plano: <b>{nome_final}</b>\n💰 Valor: <b>R$ {valor_final:.2f}</b>\n🔐 Pague via Pix Copia e Cola:\n\n<pre>{qr}</pre>\n\n👆 Toque na chave PIX acima para copiá-la\n‼️ Após o pagamento, o acesso será liberado automaticamente!"
-
-                    bot_temp.send_message(chat_id, msg_pix, parse_mode="HTML", reply_markup=markup_pix)
+                pedido, _ = gerar_pix_checkout(
+                    db, bot_temp, bot_db, chat_id, first_name, username,
+                    plano.id, nome_final, valor_final, com_bump=aceitou, tracking_id=track_id_pedido,
+                    texto_espera=f"⏳ Gerando PIX: <b>{nome_final}</b>..."
+                )
+                if pedido:
+                    enviar_mensagem_pix(bot_temp, chat_id, pedido, nome_final)
+                else:
+                    bot_temp.send_message(chat_id, aviso_falha_pix())
 
             # --- D) PROMO ---
             elif data.startswith("promo_"):
@@ -2816,44 +4507,25 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
                 elif campanha.expiration_at and datetime.utcnow() > campanha.expiration_at:
                     bot_temp.send_message(chat_id, "🚫 <b>OFERTA ENCERRADA!</b>\n\nO tempo desta oferta acabou.", parse_mode="HTML")
                 else:
-                    plano = db.query(PlanoConfig).filter(PlanoConfig.id == campanha.plano_id).first()
+                    plano = flow_cache.obter(bot_db.id, db).plano(campanha.plano_id)
                     if plano:
                         preco_final = campanha.promo_price if campanha.promo_price else plano.preco_atual
-                        msg_wait = bot_temp.send_message(chat_id, "⏳ Gerando <b>OFERTA ESPECIAL</b>...", parse_mode="HTML")
-                        mytx = str(uuid.uuid4())
-                        pix = gerar_pix_pushinpay(preco_final, mytx)
-                        
-                        if pix:
-                            qr = pix.get('qr_code_text') or pix.get('qr_code')
-                            txid = str(pix.get('id') or mytx).lower()
-                            
-                            novo_pedido = Pedido(
-                                bot_id=bot_db.id, telegram_id=str(chat_id), first_name=first_name, username=username,
-                                plano_nome=f"{plano.nome_exibicao} (OFERTA)", plano_id=plano.id, valor=preco_final,
-                                transaction_id=txid, qr_code=qr, status="pending", tem_order_bump=False, created_at=datetime.utcnow(),
-                                tracking_id=None 
-                            )
-                            db.add(novo_pedido)
-                            db.commit()
-                            
-                            try: bot_temp.delete_message(chat_id, msg_wait.message_id)
-                            except: pass
-                            
-                            markup_pix = types.InlineKeyboardMarkup()
-                            markup_pix.add(types.InlineKeyboardButton("🔄 VERIFICAR STATUS DO PAGAMENTO", callback_data=f"check_payment_{txid}"))
-
-                            msg_pix = f"🌟 Seu pagamento foi gerado com sucesso:\n🎁 Plano: <b>{plano.nome_exibicao}</b>\n💰 Valor Promocional: <b>R$ {preco_final:.2f}</b>\n🔐 Pague via Pix Copia e Cola:\n\n<pre>{qr}</pre>\n\n👆 Toque na chave PIX acima para copiá-la\n‼️ Após o pagamento, o acesso será liberado automaticamente!"
-
-                            bot_temp.send_message(chat_id, msg_pix, parse_mode="HTML", reply_markup=markup_pix)
+                        pedido, _ = gerar_pix_checkout(
+                            db, bot_temp, bot_db, chat_id, first_name, username,
+                            plano.id, f"{plano.nome_exibicao} (OFERTA)", preco_final,
+                            texto_espera="⏳ Gerando <b>OFERTA ESPECIAL</b>..."
+                        )
+                        if pedido:
+                            enviar_mensagem_pix(bot_temp, chat_id, pedido, plano.nome_exibicao, rotulo_valor="Valor Promocional")
                         else:
-                            bot_temp.send_message(chat_id, "❌ Erro ao gerar PIX.")
+                            bot_temp.send_message(chat_id, aviso_falha_pix())
                     else:
                         bot_temp.send_message(chat_id, "❌ Plano não encontrado.")
 
             # --- E) VERIFICAR STATUS ---
             elif data.startswith("check_payment_"):
                 tx_id = data.split("_")[2]
-                pedido = db.query(Pedido).filter(Pedido.transaction_id == tx_id).first()
+                pedido = buscar_pedido_por_ref(db, normalizar_ref_pagamento(tx_id))
                 
                 if not pedido:
                     bot_temp.answer_callback_query(update.callback_query.id, "❌ Pedido não encontrado.", show_alert=True)
@@ -2866,8 +4538,6 @@ async def receber_update_telegram(token: str, req: Request, db: Session = Depend
     except Exception as e:
         logger.error(f"Erro no webhook: {e}")
 
-    return {"status": "ok"}
-
 # ============================================================
 # ROTA 1: LISTAR LEADS (TOPO DO FUNIL)
 # ============================================================
@@ -2876,6 +4546,7 @@ def listar_leads(
     bot_id: Optional[int] = None,
     page: int = 1,
     per_page: int = 50,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     """
@@ -2884,18 +4555,18 @@ def listar_leads(
     try:
         # Query base
         query = db.query(Lead)
-        
+
         # Filtro por bot
         if bot_id:
             query = query.filter(Lead.bot_id == bot_id)
-        
+
         # Contagem total
         total = query.count()
-        
-        # Paginação
-        offset = (page - 1) * per_page
-        leads = query.order_by(Lead.created_at.desc()).offset(offset).limit(per_page).all()
-        
+
+        # Paginação (cursor keyset; sem cursor cai no page/OFFSET antigo)
+        leads = paginar_keyset(query, (Lead.created_at, Lead.id), cursor, page, per_page).all()
+        leads, next_cursor = fatiar_pagina(leads, per_page, lambda l: (l.created_at, l.id))
+
         # Formata resposta
         leads_data = []
         for lead in leads:
@@ -2919,9 +4590,12 @@ def listar_leads(
             "total": total,
             "page": page,
             "per_page": per_page,
-            "total_pages": (total + per_page - 1) // per_page
+            "total_pages": (total + per_page - 1) // per_page,
+            "next_cursor": next_cursor
         }
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao listar leads: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -3020,88 +4694,147 @@ def obter_estatisticas_funil(
 # ============================================================
 # 🔥 ROTA ATUALIZADA: /api/admin/contacts
 # ============================================================
+def consulta_contatos_mesclados(bot_id, dialeto):
+    """
+    Leads + Pedidos numa consulta só, 1 linha por telegram_id.
+    Pedido ganha do Lead (prioridade 1 x 0) e, entre vários pedidos,
+    fica o mais recente (maior id) - mesma regra da mescla antiga em Python.
+    """
+    q_pedidos = select(
+        Pedido.telegram_id.label("telegram_id"),
+        literal(1).label("prioridade"),
+        Pedido.id.label("id"),
+        Pedido.created_at.label("created_at"),
+        Pedido.first_name.label("first_name"),
+        Pedido.username.label("username"),
+        Pedido.plano_nome.label("plano_nome"),
+        Pedido.valor.label("valor"),
+        Pedido.status.label("status"),
+        Pedido.custom_expiration.label("custom_expiration"),
+    )
+    q_leads = select(
+        Lead.user_id.label("telegram_id"),
+        literal(0).label("prioridade"),
+        Lead.id.label("id"),
+        # leads.created_at é timestamptz no Postgres; pedidos é timestamp sem fuso
+        (cast(Lead.created_at, DateTime) if dialeto == "postgresql" else Lead.created_at).label("created_at"),
+        Lead.nome.label("first_name"),
+        Lead.username.label("username"),
+        literal("-").label("plano_nome"),
+        literal(0.0).label("valor"),
+        literal("pending").label("status"),
+        cast(null(), DateTime).label("custom_expiration"),
+    )
+    if bot_id:
+        q_pedidos = q_pedidos.where(Pedido.bot_id == bot_id)
+        q_leads = q_leads.where(Lead.bot_id == bot_id)
+
+    todos = union_all(q_pedidos, q_leads).subquery("candidatos")
+
+    if dialeto == "postgresql":
+        escolhidos = select(todos).distinct(todos.c.telegram_id).order_by(
+            todos.c.telegram_id, todos.c.prioridade.desc(), todos.c.id.desc()
+        ).subquery("contatos")
+    else:
+        # SQLite não tem DISTINCT ON: ROW_NUMBER() faz o mesmo papel
+        posicao = func.row_number().over(
+            partition_by=todos.c.telegram_id,
+            order_by=(todos.c.prioridade.desc(), todos.c.id.desc())
+        ).label("posicao")
+        numerados = select(todos, posicao).subquery("numerados")
+        escolhidos = select(*[c for c in numerados.c if c.name != "posicao"]).where(
+            numerados.c.posicao == 1
+        ).subquery("contatos")
+
+    return escolhidos
+
 @app.get("/api/admin/contacts")
 async def get_contacts(
     status: str = "todos",
     bot_id: Optional[int] = None,
     page: int = 1,
     per_page: int = 50,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
+    """
+    Contatos do CRM. Pagina por cursor keyset (next_cursor na resposta);
+    sem cursor, "page" continua funcionando como antes.
+    """
     try:
-        offset = (page - 1) * per_page
-        all_contacts = []
-        
         # Helper para garantir data sem timezone
         def clean_date(dt):
             if not dt: return datetime.utcnow()
             return dt.replace(tzinfo=None)
 
-        # 1. Filtro TODOS (Mescla Leads + Pedidos)
+        # 1. Filtro TODOS (Mescla Leads + Pedidos no próprio banco)
         if status == "todos":
-            contatos_unicos = {}
-            
-            # Busca Leads
-            q_leads = db.query(Lead)
-            if bot_id: q_leads = q_leads.filter(Lead.bot_id == bot_id)
-            leads = q_leads.all()
-            
-            for l in leads:
-                tid = str(l.user_id)
-                contatos_unicos[tid] = {
-                    "id": l.id,
-                    "telegram_id": tid,
-                    "user_id": tid,
-                    "first_name": l.nome or "Sem nome",
-                    "username": l.username,
-                    "plano_nome": "-",
-                    "valor": 0.0,
-                    "status": "pending",
-                    "role": "user",
-                    "created_at": clean_date(l.created_at),
-                    "status_funil": "topo",
-                    "origem": "lead"
-                }
-            
-            # Busca Pedidos (Sobrescreve)
-            q_pedidos = db.query(Pedido)
-            if bot_id: q_pedidos = q_pedidos.filter(Pedido.bot_id == bot_id)
-            pedidos = q_pedidos.all()
-            
-            for p in pedidos:
-                tid = str(p.telegram_id)
+            contatos = consulta_contatos_mesclados(bot_id, db.bind.dialect.name)
+
+            # Total = telegram_ids distintos entre leads e pedidos
+            ids_pedidos = select(Pedido.telegram_id.label("telegram_id"))
+            ids_leads = select(Lead.user_id.label("telegram_id"))
+            if bot_id:
+                ids_pedidos = ids_pedidos.where(Pedido.bot_id == bot_id)
+                ids_leads = ids_leads.where(Lead.bot_id == bot_id)
+            total = db.execute(
+                select(func.count()).select_from(union(ids_pedidos, ids_leads).subquery())
+            ).scalar() or 0
+
+            # (created_at, prioridade, id): ids de leads e pedidos podem coincidir
+            colunas = (contatos.c.created_at, contatos.c.prioridade, contatos.c.id)
+            linhas = db.execute(paginar_keyset(select(contatos), colunas, cursor, page, per_page)).all()
+            linhas, next_cursor = fatiar_pagina(
+                linhas, per_page, lambda r: (r.created_at, r.prioridade, r.id)
+            )
+
+            paginated = []
+            for r in linhas:
+                tid = str(r.telegram_id)
+                if r.prioridade == 0:
+                    paginated.append({
+                        "id": r.id,
+                        "telegram_id": tid,
+                        "user_id": tid,
+                        "first_name": r.first_name or "Sem nome",
+                        "username": r.username,
+                        "plano_nome": "-",
+                        "valor": 0.0,
+                        "status": "pending",
+                        "role": "user",
+                        "created_at": clean_date(r.created_at),
+                        "status_funil": "topo",
+                        "origem": "lead"
+                    })
+                    continue
+
                 st_funil = "meio"
-                if p.status in ["paid", "approved", "active"]: st_funil = "fundo"
-                elif p.status == "expired": st_funil = "expirado"
-                
-                contatos_unicos[tid] = {
-                    "id": p.id,
+                if r.status in ["paid", "approved", "active"]: st_funil = "fundo"
+                elif r.status == "expired": st_funil = "expirado"
+
+                paginated.append({
+                    "id": r.id,
                     "telegram_id": tid,
                     "user_id": tid,
-                    "first_name": p.first_name or "Sem nome",
-                    "username": p.username,
-                    "plano_nome": p.plano_nome,
-                    "valor": p.valor,
-                    "status": p.status,
+                    "first_name": r.first_name or "Sem nome",
+                    "username": r.username,
+                    "plano_nome": r.plano_nome,
+                    "valor": r.valor,
+                    "status": r.status,
                     "role": "user",
-                    "created_at": clean_date(p.created_at),
+                    "created_at": clean_date(r.created_at),
                     "status_funil": st_funil,
                     "origem": "pedido",
-                    "custom_expiration": p.custom_expiration
-                }
-            
-            all_contacts = list(contatos_unicos.values())
-            all_contacts.sort(key=lambda x: x["created_at"], reverse=True)
-            
-            total = len(all_contacts)
-            paginated = all_contacts[offset:offset + per_page]
-            
+                    "custom_expiration": r.custom_expiration
+                })
+
             return {
                 "data": paginated,
                 "total": total,
                 "page": page,
                 "per_page": per_page,
-                "total_pages": (total + per_page - 1) // per_page
+                "total_pages": (total + per_page - 1) // per_page,
+                "next_cursor": next_cursor
             }
 
         # 2. Outros Filtros (Consultam direto Pedido)
@@ -3117,7 +4850,8 @@ async def get_contacts(
                 query = query.filter(Pedido.status == "expired")
                 
             total = query.count()
-            pedidos = query.offset(offset).limit(per_page).all()
+            pedidos = paginar_keyset(query, (Pedido.created_at, Pedido.id), cursor, page, per_page).all()
+            pedidos, next_cursor = fatiar_pagina(pedidos, per_page, lambda p: (p.created_at, p.id))
             
             contacts = []
             for p in pedidos:
@@ -3140,9 +4874,12 @@ async def get_contacts(
                 "total": total,
                 "page": page,
                 "per_page": per_page,
-                "total_pages": (total + per_page - 1) // per_page
+                "total_pages": (total + per_page - 1) // per_page,
+                "next_cursor": next_cursor
             }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro contatos: {e}")
         raise HTTPException(500, str(e))
@@ -3170,7 +4907,9 @@ async def update_user(user_id: int, data: dict, db: Session = Depends(get_db)):
         
         # 2. Atualizar campos
         if "status" in data:
+            status_anterior = pedido.status
             pedido.status = data["status"]
+            contabilizar_status_pedido(db, pedido, status_anterior)
             logger.info(f"✅ Status atualizado para: {data['status']}")
         
         if "role" in data:
@@ -3190,10 +4929,21 @@ async def update_user(user_id: int, data: dict, db: Session = Depends(get_db)):
                     # Se já for datetime, usa direto
                     pedido.custom_expiration = data["custom_expiration"]
         
+        # Assinatura acompanha a edição (status ativo/inativo, nova data)
+        if pedido.status in ("paid", "approved", "active"):
+            if "status" in data or "custom_expiration" in data:
+                conceder_assinatura(db, pedido, pedido.custom_expiration, forcar=True)
+        else:
+            revogar_assinatura(db, pedido)
+
         # 3. Salvar no banco
         db.commit()
         db.refresh(pedido)
         
+        # Data nova (ou pedido reativado) entra no motor de vencimentos na hora
+        if pedido.status in STATUS_EXPIRAVEIS:
+            agendar_vencimento(pedido.id, pedido.custom_expiration)
+        
         logger.info(f"✅ Usuário {user_id} atualizado com sucesso!")
         
         return {
@@ -3232,16 +4982,17 @@ async def resend_user_access(user_id: int, db: Session = Depends(get_db)):
             logger.error(f"❌ Pedido {user_id} não encontrado")
             raise HTTPException(status_code=404, detail="Pedido não encontrado")
         
-        # 2. Verificar se está pago
-        if pedido.status not in ["paid", "active", "approved"]:
-            logger.error(f"❌ Pedido {user_id} não está pago (status: {pedido.status})")
+        # 2. Verificar se o usuário tem assinatura ativa (busca pela PK)
+        assinatura = assinatura_ativa(db, pedido.bot_id, pedido.telegram_id)
+        if not assinatura:
+            logger.error(f"❌ Usuário do pedido {user_id} sem assinatura ativa (status: {pedido.status})")
             raise HTTPException(
                 status_code=400, 
-                detail="Pedido não está pago. Altere o status para 'Ativo/Pago' primeiro."
+                detail="Usuário sem assinatura ativa. Altere o status para 'Ativo/Pago' primeiro."
             )
         
         # 3. Buscar bot
-        bot_data = db.query(Bot).filter(Bot.id == pedido.bot_id).first()
+        bot_data = bot_registry.obter_por_id(pedido.bot_id, db)
         
         if not bot_data:
             logger.error(f"❌ Bot {pedido.bot_id} não encontrado")
@@ -3254,7 +5005,7 @@ async def resend_user_access(user_id: int, db: Session = Depends(get_db)):
         
         # 5. Gerar novo link e enviar
         try:
-            tb = telebot.TeleBot(bot_data.token)
+            tb = bot_registry.cliente(bot_data.token)
             
             # Tratamento do ID do Canal
             try: 
@@ -3269,23 +5020,20 @@ async def resend_user_access(user_id: int, db: Session = Depends(get_db)):
             except Exception as e:
                 logger.warning(f"⚠️ Não foi possível desbanir usuário: {e}")
             
-            # Gera Link Único
-            convite = tb.create_chat_invite_link(
-                chat_id=canal_id,
-                member_limit=1,
-                name=f"Reenvio {pedido.first_name}"
-            )
+            # Link Único (pilha de convites do canal ou criado na hora)
+            link_convite = obter_convite(db, tb, bot_data, canal_id, pedido, f"Reenvio {pedido.first_name}")
+            db.commit()
             
             # Formata data de validade
             texto_validade = "VITALÍCIO ♾️"
-            if pedido.custom_expiration:
-                texto_validade = pedido.custom_expiration.strftime("%d/%m/%Y")
+            if assinatura.expires_at:
+                texto_validade = assinatura.expires_at.strftime("%d/%m/%Y")
             
             # Envia mensagem
             msg_cliente = (
                 f"✅ <b>Acesso Reenviado!</b>\n"
                 f"📅 Validade: <b>{texto_validade}</b>\n\n"
-                f"Seu acesso exclusivo:\n👉 {convite.invite_link}\n\n"
+                f"Seu acesso exclusivo:\n👉 {link_convite}\n\n"
                 f"<i>Use este link para entrar no grupo VIP.</i>"
             )
             
@@ -3326,6 +5074,7 @@ def save_flow(bot_id: int, flow: FlowUpdate, db: Session = Depends(get_db)):
     f = db.query(BotFlow).filter(BotFlow.bot_id == bot_id).first()
     if not f: f = BotFlow(bot_id=bot_id)
     db.add(f)
+    midias_antigas = (f.media_url, f.msg_2_media)
     f.msg_boas_vindas = flow.msg_boas_vindas
     f.media_url = flow.media_url
     f.btn_text_1 = flow.btn_text_1
@@ -3334,6 +5083,9 @@ def save_flow(bot_id: int, flow: FlowUpdate, db: Session = Depends(get_db)):
     f.msg_2_media = flow.msg_2_media
     f.mostrar_planos_2 = flow.mostrar_planos_2
     db.commit()
+    flow_cache.invalidar(bot_id)
+    media_registry.substituida(bot_id, midias_antigas[0], f.media_url)
+    media_registry.substituida(bot_id, midias_antigas[1], f.msg_2_media)
     return {"status": "saved"}
 
 @app.get("/api/admin/bots/{bot_id}/flow/steps")
@@ -3345,181 +5097,335 @@ def add_step(bot_id: int, p: FlowStepCreate, db: Session = Depends(get_db)):
     ns = BotFlowStep(bot_id=bot_id, step_order=p.step_order, msg_texto=p.msg_texto, msg_media=p.msg_media, btn_texto=p.btn_texto)
     db.add(ns)
     db.commit()
+    flow_cache.invalidar(bot_id)
     return {"status": "ok"}
 
 @app.delete("/api/admin/bots/{bot_id}/flow/steps/{sid}")
 def del_step(bot_id: int, sid: int, db: Session = Depends(get_db)):
     s = db.query(BotFlowStep).filter(BotFlowStep.id == sid).first()
     if s:
+        midia_antiga = s.msg_media
         db.delete(s)
         db.commit()
+        flow_cache.invalidar(bot_id)
+        media_registry.invalidar(bot_id, midia_antiga)
     return {"status": "deleted"}
 
 # =========================================================
-# FUNÇÃO DE BACKGROUND (CORRIGIDA: SESSÃO INDEPENDENTE)
+# 📢 MOTOR DE DISPARO DE REMARKETING (CONCORRENTE + RETOMÁVEL)
 # =========================================================
-def processar_envio_remarketing(campaign_db_id: int, bot_id: int, payload: RemarketingRequest):
+# Cada campanha grava seus destinatários em remarketing_envios e roda numa
+# thread própria com REMARKETING_ENVIADORES envios simultâneos (o ritmo real
+# é controlado pelo telegram_dispatcher). O progresso é gravado a cada lote:
+# status por destinatário + sent_success/blocked_count na campanha.
+# Um lote 'processando' há mais de REMARKETING_RESERVA_MINUTOS (contados do
+# claim) é de um worker que morreu: qualquer disparo da campanha o pega de
+# volta. O processo líder do job "remarketing-retomada" continua as campanhas
+# que ficaram 'enviando' (deploy/crash no meio do disparo).
+REMARKETING_ENVIADORES = int(os.getenv("REMARKETING_ENVIADORES", "8"))
+REMARKETING_LOTE = int(os.getenv("REMARKETING_LOTE", "100"))
+REMARKETING_RESERVA_MINUTOS = 10  # 'processando' há mais que isso = worker morreu no meio do lote
+REMARKETING_ESPERA_SEGUNDOS = 5   # Intervalo para conferir lotes reservados por outro processo
+MOTOR_REMARKETING_VERSAO = 2      # Só campanhas criadas por este motor são retomadas
+
+# Progresso ao vivo das campanhas rodando neste processo (GET /api/admin/remarketing/status)
+CAMPAIGN_STATUS = {}
+_campanhas_rodando = set()
+_campanhas_lock = threading.Lock()
+
+def montar_config_campanha(db: Session, payload: RemarketingRequest):
+    """Resolve plano, preço e validade da oferta e monta o config persistido da campanha."""
+    plano_db = None
+    preco_final = 0.0
+    data_expiracao = None
+
+    if payload.incluir_oferta and payload.plano_oferta_id:
+        # Busca Flexível (String ou Int)
+        plano_db = db.query(PlanoConfig).filter(
+            (PlanoConfig.key_id == str(payload.plano_oferta_id)) | 
+            (PlanoConfig.id == int(payload.plano_oferta_id) if str(payload.plano_oferta_id).isdigit() else False)
+        ).first()
+
+        if plano_db:
+            # Lógica de Preço
+            if payload.price_mode == 'custom' and payload.custom_price and payload.custom_price > 0:
+                preco_final = payload.custom_price
+            else:
+                preco_final = plano_db.preco_atual
+            
+            # Lógica de Expiração
+            if payload.expiration_mode != "none" and payload.expiration_value:
+                val = int(payload.expiration_value)
+                agora = datetime.utcnow()
+                if payload.expiration_mode == "minutes": data_expiracao = agora + timedelta(minutes=val)
+                elif payload.expiration_mode == "hours": data_expiracao = agora + timedelta(hours=val)
+                elif payload.expiration_mode == "days": data_expiracao = agora + timedelta(days=val)
+
+    config_completa = {
+        "msg": payload.mensagem,          # Chave curta (Legado)
+        "mensagem": payload.mensagem,     # Chave longa (Frontend)
+        "media": payload.media_url,       # Chave curta
+        "media_url": payload.media_url,   # Chave longa
+        "offer": payload.incluir_oferta,  # Chave curta
+        "incluir_oferta": payload.incluir_oferta, # Chave longa
+        "plano_id": payload.plano_oferta_id,
+        "plano_oferta_id": payload.plano_oferta_id,
+        "custom_price": preco_final,
+        "price_mode": payload.price_mode,
+        "expiration_mode": payload.expiration_mode,
+        "expiration_value": payload.expiration_value,
+        "motor": MOTOR_REMARKETING_VERSAO,
+        "payload": payload.dict()         # Tudo que o motor precisa para retomar após restart
+    }
+    return config_completa, plano_db, preco_final, data_expiracao
+
+STATUS_PAGOS = ['paid', 'active', 'approved', 'completed', 'succeeded']
+
+def consulta_publico_remarketing(bot_id: int, target: str):
     """
-    Executa o envio em background usando uma NOVA sessão de banco (SessionLocal).
-    Isso impede que os dados fiquem zerados por queda de conexão.
+    SELECT dos telegram_ids do público. A segmentação roda inteira no banco:
+    'todos' = UNION de Pedido + Lead (leads que nunca geraram PIX também recebem)
+    e as exclusões são anti-joins (NOT IN) sobre os pedidos pagos/expirados.
+    Os ids passam por TRIM dos dois lados (há ids gravados com espaço).
     """
-    # 🔥 CRIA NOVA SESSÃO DEDICADA (O SEGREDO PARA SALVAR OS DADOS)
-    db = SessionLocal() 
-    
+    target = str(target).lower()
+    eh_pago = lambda p: func.lower(p.status).in_(STATUS_PAGOS)
+    eh_expirado = lambda p: func.lower(p.status) == 'expired'
+    tid_pedido = func.trim(Pedido.telegram_id)
+
+    def ids_com_pedido(condicao):
+        # Sem NULL na lista: um NULL faria o NOT IN descartar todo mundo
+        return select(tid_pedido).where(Pedido.bot_id == bot_id, Pedido.telegram_id.isnot(None), condicao(Pedido))
+
+    if target in ['pagantes', 'ativos']:
+        return select(tid_pedido.label("telegram_id")).where(Pedido.bot_id == bot_id, eh_pago(Pedido)).distinct()
+
+    if target in ['expirados', 'ex_assinantes']:
+        return select(tid_pedido.label("telegram_id")).where(
+            Pedido.bot_id == bot_id, eh_expirado(Pedido),
+            tid_pedido.notin_(ids_com_pedido(eh_pago))
+        ).distinct()
+
+    todos = union(
+        select(tid_pedido.label("telegram_id")).where(Pedido.bot_id == bot_id),
+        select(func.trim(Lead.user_id).label("telegram_id")).where(Lead.bot_id == bot_id)
+    ).subquery("publico")
+
+    consulta = select(todos.c.telegram_id)
+    if target in ['pendentes', 'leads', 'nao_pagantes']:
+        consulta = consulta.where(
+            todos.c.telegram_id.notin_(ids_com_pedido(eh_pago)),
+            todos.c.telegram_id.notin_(ids_com_pedido(eh_expirado))
+        )
+    return consulta
+
+def preparar_destinatarios_campanha(db: Session, campanha: RemarketingCampaign, payload: RemarketingRequest):
+    """Grava os destinatários (uma vez só; na retomada eles já existem)."""
+    ja_montada = db.query(RemarketingEnvio.id).filter(RemarketingEnvio.campaign_id == campanha.id).first()
+    if ja_montada:
+        return
+
+    if payload.is_test:
+        uid = str(payload.specific_user_id).strip() if payload.specific_user_id else None
+        if not uid:
+            adm = db.query(BotAdmin).filter(BotAdmin.bot_id == campanha.bot_id).first()
+            uid = str(adm.telegram_id).strip() if adm else None
+        if uid:
+            db.add(RemarketingEnvio(campaign_id=campanha.id, telegram_id=uid, status="pendente"))
+    else:
+        # INSERT ... SELECT: o público vai direto do banco para remarketing_envios,
+        # sem passar pela memória do processo (50 mil ou 5 milhões, tanto faz)
+        publico = consulta_publico_remarketing(campanha.bot_id, payload.target).subquery("alvo")
+        db.execute(
+            insert(RemarketingEnvio).from_select(
+                ["campaign_id", "telegram_id", "status"],
+                select(literal(campanha.id), publico.c.telegram_id, literal("pendente")).where(
+                    publico.c.telegram_id.isnot(None),
+                    func.length(publico.c.telegram_id) >= 5
+                )
+            )
+        )
+
+    total = db.query(func.count(RemarketingEnvio.id)).filter(RemarketingEnvio.campaign_id == campanha.id).scalar()
+    db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campanha.id).update({"total_leads": total})
+    db.commit()  # Destinatários + total na mesma transação
+
+def _reservaveis(agora: datetime):
+    # Pendentes + reservas abandonadas (worker morreu depois do claim)
+    limite = agora - timedelta(minutes=REMARKETING_RESERVA_MINUTOS)
+    return (RemarketingEnvio.status == "pendente") | (
+        (RemarketingEnvio.status == "processando") & (RemarketingEnvio.reservado_em < limite)
+    )
+
+def _reservar_lote(db: Session, campaign_db_id: int):
+    """Marca até REMARKETING_LOTE destinatários como 'processando' para este worker (seguro entre processos)."""
+    lote = uuid.uuid4().hex
+    agora = datetime.utcnow()
+    ids_pendentes = db.query(RemarketingEnvio.id).filter(
+        RemarketingEnvio.campaign_id == campaign_db_id,
+        _reservaveis(agora)
+    ).order_by(RemarketingEnvio.id).limit(REMARKETING_LOTE).scalar_subquery()
+    db.query(RemarketingEnvio).filter(
+        RemarketingEnvio.id.in_(ids_pendentes),
+        _reservaveis(agora)
+    ).update({"status": "processando", "lote": lote, "reservado_em": agora}, synchronize_session=False)
+    db.commit()
+    return db.query(RemarketingEnvio.id, RemarketingEnvio.telegram_id).filter(RemarketingEnvio.lote == lote).all()
+
+def _enviar_para_destinatario(bot_sender, bot_id: int, uid: str, mensagem: str, media_url: Optional[str], markup):
     try:
-        # 1. Recupera a Campanha criada na rota e o Bot
-        campanha = db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campaign_db_id).first()
-        bot_db = db.query(Bot).filter(Bot.id == bot_id).first()
+        midia_ok = False
+        if media_url and len(media_url) > 5:
+            try:
+                enviar_midia(bot_sender, bot_id, uid, media_url, caption=mensagem, reply_markup=markup, parse_mode="HTML")
+                midia_ok = True
+            except: pass 
         
-        if not campanha or not bot_db:
+        if not midia_ok:
+            bot_sender.send_message(uid, mensagem, reply_markup=markup, parse_mode="HTML")
+        return "enviado", None
+    except Exception as e:
+        err = str(e).lower()
+        if "blocked" in err or "kicked" in err or "deactivated" in err or "not found" in err:
+            return "bloqueado", str(e)[:250]
+        return "erro", str(e)[:250]
+
+def _gravar_lote(db: Session, campaign_db_id: int, resultados):
+    """Checkpoint do lote: status de cada destinatário + contadores da campanha."""
+    agora = datetime.utcnow()
+    por_status = {}
+    for envio_id, (status, erro) in resultados:
+        por_status.setdefault((status, erro), []).append(envio_id)
+    for (status, erro), ids in por_status.items():
+        db.query(RemarketingEnvio).filter(RemarketingEnvio.id.in_(ids)).update(
+            {"status": status, "erro": erro, "enviado_em": agora, "lote": None}, synchronize_session=False
+        )
+
+    enviados = sum(1 for _, (s, _e) in resultados if s == "enviado")
+    bloqueados = sum(1 for _, (s, _e) in resultados if s == "bloqueado")
+    db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campaign_db_id).update({
+        RemarketingCampaign.sent_success: RemarketingCampaign.sent_success + enviados,
+        RemarketingCampaign.blocked_count: RemarketingCampaign.blocked_count + bloqueados
+    }, synchronize_session=False)
+    db.commit()
+    return enviados, bloqueados, len(resultados) - enviados - bloqueados
+
+def executar_campanha_remarketing(campaign_db_id: int):
+    db = SessionLocal()
+    try:
+        campanha = db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campaign_db_id).first()
+        if not campanha or campanha.status != "enviando":
+            return
+        bot_db = bot_registry.obter_por_id(campanha.bot_id, db)
+        if not bot_db:
             return
 
-        logger.info(f"🚀 INICIANDO DISPARO BACKGROUND | Bot: {bot_db.nome}")
-
-        # 2. Configura Oferta (se houver)
-        uuid_campanha = campanha.campaign_id
-        plano_db = None
-        preco_final = 0.0
-        data_expiracao = None
-
-        if payload.incluir_oferta and payload.plano_oferta_id:
-            # Busca Flexível (String ou Int)
-            plano_db = db.query(PlanoConfig).filter(
-                (PlanoConfig.key_id == str(payload.plano_oferta_id)) | 
-                (PlanoConfig.id == int(payload.plano_oferta_id) if str(payload.plano_oferta_id).isdigit() else False)
-            ).first()
-
-            if plano_db:
-                # Lógica de Preço
-                if payload.price_mode == 'custom' and payload.custom_price and payload.custom_price > 0:
-                    preco_final = payload.custom_price
-                else:
-                    preco_final = plano_db.preco_atual
-                
-                # Lógica de Expiração
-                if payload.expiration_mode != "none" and payload.expiration_value:
-                    val = int(payload.expiration_value)
-                    agora = datetime.utcnow()
-                    if payload.expiration_mode == "minutes": data_expiracao = agora + timedelta(minutes=val)
-                    elif payload.expiration_mode == "hours": data_expiracao = agora + timedelta(hours=val)
-                    elif payload.expiration_mode == "days": data_expiracao = agora + timedelta(days=val)
-
-        # 3. Define Lista de IDs
-        bot_sender = telebot.TeleBot(bot_db.token)
-        target = str(payload.target).lower()
-        lista_final_ids = []
-
-        if payload.is_test:
-            if payload.specific_user_id: 
-                lista_final_ids = [str(payload.specific_user_id).strip()]
-            else:
-                adm = db.query(BotAdmin).filter(BotAdmin.bot_id == bot_id).first()
-                if adm: lista_final_ids = [str(adm.telegram_id).strip()]
-        else:
-            q_todos = db.query(Pedido.telegram_id).filter(Pedido.bot_id == bot_id).distinct()
-            ids_todos = {str(r[0]).strip() for r in q_todos.all() if r[0]}
-            
-            q_pagos = db.query(Pedido.telegram_id).filter(Pedido.bot_id == bot_id, func.lower(Pedido.status).in_(['paid', 'active', 'approved', 'completed', 'succeeded'])).distinct()
-            ids_pagantes = {str(r[0]).strip() for r in q_pagos.all() if r[0]}
-            
-            q_expirados = db.query(Pedido.telegram_id).filter(Pedido.bot_id == bot_id, func.lower(Pedido.status) == 'expired').distinct()
-            ids_expirados = {str(r[0]).strip() for r in q_expirados.all() if r[0]}
-
-            if target in ['pendentes', 'leads', 'nao_pagantes']:
-                lista_final_ids = list(ids_todos - ids_pagantes - ids_expirados)
-            elif target in ['pagantes', 'ativos']:
-                lista_final_ids = list(ids_pagantes)
-            elif target in ['expirados', 'ex_assinantes']:
-                lista_final_ids = list(ids_expirados - ids_pagantes)
-            else:
-                lista_final_ids = list(ids_todos)
+        config = json.loads(campanha.config) if campanha.config else {}
+        payload = RemarketingRequest(**config["payload"])
+        preparar_destinatarios_campanha(db, campanha, payload)
+        db.refresh(campanha)
 
-        # Atualiza Total Previsto no Banco
-        # USAMOS UPDATE DIRETO PARA GARANTIR GRAVAÇÃO
-        db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campaign_db_id).update({"total_leads": len(lista_final_ids)})
-        db.commit()
+        logger.info(f"🚀 INICIANDO DISPARO | Bot: {bot_db.nome} | Campanha {campaign_db_id} | {campanha.total_leads} destinatários")
 
-        # 4. Markup (Botão)
+        # Markup (Botão)
         markup = None
-        if plano_db:
+        plano = flow_cache.obter(bot_db.id, db).plano(campanha.plano_id) if campanha.plano_id else None
+        if plano:
             markup = types.InlineKeyboardMarkup()
+            preco_final = campanha.promo_price if campanha.promo_price else plano.preco_atual
             preco_txt = f"{preco_final:.2f}".replace('.', ',')
-            btn_text = f"🔥 {plano_db.nome_exibicao} - R$ {preco_txt}"
-            cb_data = f"checkout_{plano_db.id}" if payload.is_test else f"promo_{uuid_campanha}"
+            btn_text = f"🔥 {plano.nome_exibicao} - R$ {preco_txt}"
+            cb_data = f"checkout_{plano.id}" if payload.is_test else f"promo_{campanha.campaign_id}"
             markup.add(types.InlineKeyboardButton(btn_text, callback_data=cb_data))
 
-        # 5. Loop de Envio (HTML)
-        sent_count = 0
-        blocked_count = 0
-
-        for uid in lista_final_ids:
-            if not uid or len(uid) < 5: continue
-            try:
-                midia_ok = False
-                if payload.media_url and len(payload.media_url) > 5:
-                    try:
-                        ext = payload.media_url.lower()
-                        if ext.endswith(('.mp4', '.mov', '.avi')):
-                            bot_sender.send_video(uid, payload.media_url, caption=payload.mensagem, reply_markup=markup, parse_mode="HTML")
-                        else:
-                            bot_sender.send_photo(uid, payload.media_url, caption=payload.mensagem, reply_markup=markup, parse_mode="HTML")
-                        midia_ok = True
-                    except: pass 
-                
-                if not midia_ok:
-                    bot_sender.send_message(uid, payload.mensagem, reply_markup=markup, parse_mode="HTML")
-                
-                sent_count += 1
-                time.sleep(0.05) # Delay anti-spam
-                
-            except Exception as e:
-                err = str(e).lower()
-                if "blocked" in err or "kicked" in err or "deactivated" in err or "not found" in err:
-                    blocked_count += 1
+        bot_sender = bot_registry.cliente(bot_db.token)
+        ao_vivo = CAMPAIGN_STATUS.setdefault(campaign_db_id, {})
+        ao_vivo.update({
+            "campaign_id": campanha.campaign_id, "bot_id": bot_db.id, "status": "enviando",
+            "total": campanha.total_leads, "enviados": campanha.sent_success,
+            "bloqueados": campanha.blocked_count, "erros": 0
+        })
 
-        
-        # 6. ATUALIZAÇÃO FINAL NO BANCO (JSON HÍBRIDO + UPDATE DIRETO)
-        
-        config_completa = {
-            "msg": payload.mensagem,          # Chave curta (Legado)
-            "mensagem": payload.mensagem,     # Chave longa (Frontend)
-            "media": payload.media_url,       # Chave curta
-            "media_url": payload.media_url,   # Chave longa
-            "offer": payload.incluir_oferta,  # Chave curta
-            "incluir_oferta": payload.incluir_oferta, # Chave longa
-            "plano_id": payload.plano_oferta_id,
-            "plano_oferta_id": payload.plano_oferta_id,
-            "custom_price": preco_final,
-            "price_mode": payload.price_mode,
-            "expiration_mode": payload.expiration_mode,
-            "expiration_value": payload.expiration_value
-        }
-        
-        # MÁGICA: Update direto no banco para não perder os dados
-        update_data = {
-            "status": "concluido",
-            "sent_success": sent_count,
-            "blocked_count": blocked_count,
-            "config": json.dumps(config_completa),
-            "expiration_at": data_expiracao
-        }
-        
-        if plano_db:
-            update_data["plano_id"] = plano_db.id
-            update_data["promo_price"] = preco_final
+        with ThreadPoolExecutor(max_workers=REMARKETING_ENVIADORES, thread_name_prefix=f"rmk-{campaign_db_id}") as enviadores:
+            while True:
+                lote = _reservar_lote(db, campaign_db_id)
+                if not lote:
+                    # Outro processo ainda está com um lote: espera ele gravar
+                    # ou a reserva vencer (aí o lote volta no _reservar_lote)
+                    em_andamento = db.query(RemarketingEnvio.id).filter(
+                        RemarketingEnvio.campaign_id == campaign_db_id,
+                        RemarketingEnvio.status.in_(["pendente", "processando"])
+                    ).first()
+                    if not em_andamento:
+                        break
+                    time.sleep(REMARKETING_ESPERA_SEGUNDOS)
+                    continue
+                resultados = list(zip(
+                    [envio_id for envio_id, _ in lote],
+                    enviadores.map(
+                        lambda uid: _enviar_para_destinatario(bot_sender, bot_db.id, uid, payload.mensagem, payload.media_url, markup),
+                        [uid for _, uid in lote]
+                    )
+                ))
+                enviados, bloqueados, erros = _gravar_lote(db, campaign_db_id, resultados)
+                ao_vivo["enviados"] += enviados
+                ao_vivo["bloqueados"] += bloqueados
+                ao_vivo["erros"] += erros
+
+        db.query(RemarketingCampaign).filter(
+            RemarketingCampaign.id == campaign_db_id,
+            RemarketingCampaign.status == "enviando"
+        ).update({"status": "concluido"}, synchronize_session=False)
+        db.commit()
+        ao_vivo["status"] = "concluido"
 
-        db.query(RemarketingCampaign).filter(RemarketingCampaign.id == campaign_db_id).update(update_data)
-        db.commit() # 🔥 Commit na sessão dedicada salva os números reais!
-        
-        logger.info(f"✅ FINALIZADO: {sent_count} envios / {blocked_count} bloqueados")
+        db.refresh(campanha)
+        logger.info(f"✅ FINALIZADO: {campanha.sent_success} envios / {campanha.blocked_count} bloqueados")
 
     except Exception as e:
+        db.rollback()
         logger.error(f"Erro na thread de remarketing: {e}")
     finally:
-        db.close() # Fecha a conexão dedicada
+        db.close()
+        with _campanhas_lock:
+            _campanhas_rodando.discard(campaign_db_id)
+
+def iniciar_campanha_remarketing(campaign_db_id: int) -> bool:
+    """Sobe a thread da campanha (uma por campanha neste processo)."""
+    with _campanhas_lock:
+        if campaign_db_id in _campanhas_rodando:
+            return False
+        _campanhas_rodando.add(campaign_db_id)
+    threading.Thread(
+        target=executar_campanha_remarketing, args=(campaign_db_id,),
+        name=f"remarketing-{campaign_db_id}", daemon=True
+    ).start()
+    return True
+
+def retomar_campanhas_remarketing():
+    """Continua as campanhas que ficaram 'enviando' (deploy/crash no meio do disparo)."""
+    db = SessionLocal()
+    try:
+        retomadas = 0
+        for campanha in db.query(RemarketingCampaign).filter(RemarketingCampaign.status == "enviando").all():
+            try: config = json.loads(campanha.config) if campanha.config else {}
+            except: config = {}
+            # Campanhas antigas (sem payload salvo) não têm como ser retomadas
+            if config.get("motor") != MOTOR_REMARKETING_VERSAO:
+                continue
+            if iniciar_campanha_remarketing(campanha.id):
+                retomadas += 1
+        if retomadas:
+            logger.info(f"📢 {retomadas} campanha(s) de remarketing retomada(s)")
+    finally:
+        db.close()
+
+# Só o líder retoma (e de novo no failover); o claim dos lotes impede envio
+# duplicado se a campanha também estiver rodando no worker que a criou.
+coordenador_jobs.registrar("remarketing-retomada", retomar_campanhas_remarketing)
 
 @app.post("/api/admin/remarketing/send")
-def enviar_remarketing(payload: RemarketingRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+def enviar_remarketing(payload: RemarketingRequest, db: Session = Depends(get_db)):
     # 1. Validação de Teste
     if payload.is_test and not payload.specific_user_id:
         ultimo = db.query(Pedido).filter(Pedido.bot_id == payload.bot_id).order_by(Pedido.id.desc()).first()
@@ -3529,17 +5435,21 @@ def enviar_remarketing(payload: RemarketingRequest, background_tasks: Background
             if admin: payload.specific_user_id = admin.telegram_id
             else: raise HTTPException(400, "Nenhum usuário encontrado para teste.")
 
-    # 2. Cria o Registro Inicial (Status: Enviando)
+    # 2. Cria o Registro Inicial (Status: Enviando) já com a oferta resolvida:
+    # o config guarda o payload inteiro para o motor conseguir retomar após um restart
     uuid_campanha = str(uuid.uuid4())
+    config_completa, plano_db, preco_final, data_expiracao = montar_config_campanha(db, payload)
     nova_campanha = RemarketingCampaign(
         bot_id=payload.bot_id,
         campaign_id=uuid_campanha,
         type="teste" if payload.is_test else "massivo",
         target=payload.target,
-        # Salva config inicial compatível
-        config=json.dumps({"msg": payload.mensagem, "mensagem": payload.mensagem, "media": payload.media_url}), 
+        config=json.dumps(config_completa), 
         status="enviando",
         data_envio=datetime.utcnow(),
+        plano_id=plano_db.id if plano_db else None,
+        promo_price=preco_final if plano_db else None,
+        expiration_at=data_expiracao,
         total_leads=0,
         sent_success=0,
         blocked_count=0
@@ -3548,13 +5458,8 @@ def enviar_remarketing(payload: RemarketingRequest, background_tasks: Background
     db.commit()
     db.refresh(nova_campanha)
 
-    # 3. Inicia Background Task (Passa APENAS IDs, não a sessão)
-    background_tasks.add_task(
-        processar_envio_remarketing, 
-        nova_campanha.id,  # ID da campanha para atualizar depois
-        payload.bot_id, 
-        payload
-    )
+    # 3. Inicia o disparo numa thread própria (não ocupa o pool de requests por horas)
+    iniciar_campanha_remarketing(nova_campanha.id)
     
     return {"status": "enviando", "msg": "Campanha iniciada! Acompanhe no histórico.", "campaign_id": nova_campanha.id}
 
@@ -3577,9 +5482,9 @@ def enviar_remarketing_individual(payload: IndividualRemarketingRequest, db: Ses
     media = config.get("media_url") or config.get("media", "")
 
     # 3. Configura Bot
-    bot_db = db.query(Bot).filter(Bot.id == payload.bot_id).first()
+    bot_db = bot_registry.obter_por_id(payload.bot_id, db)
     if not bot_db: raise HTTPException(404, "Bot não encontrado")
-    sender = telebot.TeleBot(bot_db.token)
+    sender = bot_registry.cliente(bot_db.token)
     
     # 4. Botão
     markup = None
@@ -3595,11 +5500,7 @@ def enviar_remarketing_individual(payload: IndividualRemarketingRequest, db: Ses
     try:
         if media:
             try:
-                ext = media.lower()
-                if ext.endswith(('.mp4', '.mov', '.avi')):
-                    sender.send_video(payload.user_telegram_id, media, caption=msg, reply_markup=markup, parse_mode="HTML")
-                else:
-                    sender.send_photo(payload.user_telegram_id, media, caption=msg, reply_markup=markup, parse_mode="HTML")
+                enviar_midia(sender, bot_db.id, payload.user_telegram_id, media, caption=msg, reply_markup=markup, parse_mode="HTML")
             except:
                 sender.send_message(payload.user_telegram_id, msg, reply_markup=markup, parse_mode="HTML")
         else:
@@ -3623,18 +5524,19 @@ def get_remarketing_history(
     bot_id: int, 
     page: int = 1, 
     per_page: int = 10, # Frontend manda 'per_page', não 'limit'
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     try:
         limit = min(per_page, 50)
-        skip = (page - 1) * limit
-        
+
         # Filtra pelo bot_id
         query = db.query(RemarketingCampaign).filter(RemarketingCampaign.bot_id == bot_id)
-        
+
         total = query.count()
-        # Ordena por data (descrescente)
-        campanhas = query.order_by(desc(RemarketingCampaign.data_envio)).offset(skip).limit(limit).all()
+        # Ordena por data (descrescente), paginando por cursor
+        campanhas = paginar_keyset(query, ORDEM_HISTORICO_REMARKETING, cursor, page, limit).all()
+        campanhas, next_cursor = fatiar_pagina(campanhas, limit, chave_historico_remarketing)
             
         data = []
         for c in campanhas:
@@ -3659,8 +5561,11 @@ def get_remarketing_history(
             "total": total,
             "page": page,
             "per_page": limit,
-            "total_pages": total_pages
+            "total_pages": total_pages,
+            "next_cursor": next_cursor
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao buscar histórico: {e}")
         return {"data": [], "total": 0, "page": 1, "total_pages": 0}
@@ -3682,12 +5587,51 @@ def delete_remarketing_history(history_id: int, db: Session = Depends(get_db)):
     if not campanha:
         raise HTTPException(status_code=404, detail="Campanha não encontrada")
     
+    # Envios em massa (sem carregar um por um pelo cascade do ORM)
+    db.query(RemarketingEnvio).filter(RemarketingEnvio.campaign_id == campanha.id).delete(synchronize_session=False)
     db.delete(campanha)
     db.commit()
+    CAMPAIGN_STATUS.pop(campanha.id, None)
     
     return {"status": "ok", "message": "Campanha deletada com sucesso"}
 
 
+# =========================================================
+# 📈 SÉRIES TEMPORAIS (BUCKETS POR DIA / SEMANA / MÊS)
+# =========================================================
+GRANULARIDADES = ("day", "week", "month")
+
+def expr_bucket_data(coluna, granularidade: str, dialeto: str):
+    """Expressão SQL que trunca a data no início do bucket (semana começa na segunda)."""
+    if dialeto == "postgresql":
+        return func.date_trunc(granularidade, coluna)
+    # SQLite (desenvolvimento local)
+    if granularidade == "month":
+        return func.strftime("%Y-%m-01", coluna)
+    if granularidade == "week":
+        return func.date(coluna, "weekday 0", "-6 days")
+    return func.date(coluna)
+
+def normalizar_bucket(valor) -> Optional[datetime]:
+    # Postgres devolve datetime; SQLite devolve 'YYYY-MM-DD'
+    if valor is None: return None
+    if isinstance(valor, str): valor = datetime.fromisoformat(valor[:10])
+    return datetime(valor.year, valor.month, valor.day)
+
+def inicio_do_bucket(dt: datetime, granularidade: str) -> datetime:
+    dia = datetime(dt.year, dt.month, dt.day)
+    if granularidade == "month": return dia.replace(day=1)
+    if granularidade == "week": return dia - timedelta(days=dia.weekday())
+    return dia
+
+def proximo_bucket(dt: datetime, granularidade: str) -> datetime:
+    if granularidade == "month":
+        return datetime(dt.year + (dt.month // 12), dt.month % 12 + 1, 1)
+    return dt + timedelta(days=7 if granularidade == "week" else 1)
+
+def rotulo_bucket(dt: datetime, granularidade: str) -> str:
+    return dt.strftime("%m/%Y") if granularidade == "month" else dt.strftime("%d/%m")
+
 # =========================================================
 # 📊 ROTA DE DASHBOARD (KPIs REAIS E CUMULATIVOS)
 # =========================================================
@@ -3699,6 +5643,7 @@ def dashboard_stats(
     bot_id: Optional[int] = None, 
     start_date: Optional[str] = None, 
     end_date: Optional[str] = None, 
+    granularity: str = "day",  # 'day', 'week' ou 'month' (agrupamento do gráfico)
     db: Session = Depends(get_db)
 ): 
     """
@@ -3718,89 +5663,63 @@ def dashboard_stats(
 
         hoje_inicio = datetime(agora.year, agora.month, agora.day)
 
-        query_leads = db.query(Lead)
-        query_pedidos = db.query(Pedido)
-
-        if bot_id:
-            query_leads = query_leads.filter(Lead.bot_id == bot_id)
-            query_pedidos = query_pedidos.filter(Pedido.bot_id == bot_id)
-
-        # Leads no período
-        leads_periodo = query_leads.filter(
-            Lead.created_at >= dt_inicio,
-            Lead.created_at <= dt_fim
-        ).count()
-
-        leads_hoje = query_leads.filter(Lead.created_at >= hoje_inicio).count()
-        
-        # ============================================================
-        # 💰 [CORRIGIDO] LISTA DE STATUS PAGOS (INCLUI EXPIRADO)
-        # ============================================================
-        status_pagos = ['paid', 'active', 'approved', 'completed', 'succeeded', 'expired']
-        
-        # Vendas no período selecionado
-        vendas_periodo = query_pedidos.filter(
-            Pedido.status.in_(status_pagos),
-            Pedido.created_at >= dt_inicio,
-            Pedido.created_at <= dt_fim
-        )
-        
-        # Total Faturamento
-        total_revenue = db.query(func.sum(Pedido.valor)).filter(
-            Pedido.status.in_(status_pagos), # 🔥 AGORA CONTA EXPIRADOS
-            Pedido.created_at >= dt_inicio,
-            Pedido.created_at <= dt_fim
-        )
-        if bot_id: total_revenue = total_revenue.filter(Pedido.bot_id == bot_id)
-        valor_total_revenue = total_revenue.scalar() or 0.0
-
-        # Assinantes (Transações no período)
-        total_transactions = vendas_periodo.count()
-        
-        # Assinantes Ativos Totais (Base geral - AQUI NÃO CONTA EXPIRADO, POIS É "ATIVO")
-        # Para "Ativos", mantemos a lógica antiga (sem expired)
+        if granularity not in GRANULARIDADES:
+            granularity = "day"
+
+        # Faturamento / vendas / leads vêm do rollup diário (O(dias), não O(pedidos))
+        dia_inicio, dia_fim, dia_hoje = dt_inicio.date(), dt_fim.date(), hoje_inicio.date()
+        no_periodo = and_(DailyStat.day >= dia_inicio, DailyStat.day <= dia_fim)
+        hoje = DailyStat.day == dia_hoje
+
+        kpis = db.query(
+            func.coalesce(func.sum(case((no_periodo, DailyStat.revenue), else_=0)), 0),
+            func.coalesce(func.sum(case((no_periodo, DailyStat.sales), else_=0)), 0),
+            func.coalesce(func.sum(case((hoje, DailyStat.revenue), else_=0)), 0),
+            func.coalesce(func.sum(case((no_periodo, DailyStat.leads), else_=0)), 0),
+            func.coalesce(func.sum(case((hoje, DailyStat.leads), else_=0)), 0)
+        ).filter(DailyStat.day >= min(dia_inicio, dia_hoje))
+        if bot_id: kpis = kpis.filter(DailyStat.bot_id == bot_id)
+        valor_total_revenue, total_transactions, valor_sales_today, leads_periodo, leads_hoje = kpis.one()
+        valor_total_revenue = float(valor_total_revenue or 0.0)
+        valor_sales_today = float(valor_sales_today or 0.0)
+        total_transactions = int(total_transactions or 0)
+        leads_periodo, leads_hoje = int(leads_periodo or 0), int(leads_hoje or 0)
+
+        # Assinantes Ativos Totais (estado atual, AQUI NÃO CONTA EXPIRADO, POIS É "ATIVO")
         status_ativos_reais = ['paid', 'active', 'approved', 'completed', 'succeeded']
-        total_active_users = db.query(Pedido).filter(Pedido.status.in_(status_ativos_reais))
+        total_active_users = db.query(func.count(Pedido.id)).filter(Pedido.status.in_(status_ativos_reais))
         if bot_id: total_active_users = total_active_users.filter(Pedido.bot_id == bot_id)
-        count_active_users = total_active_users.count()
+        count_active_users = total_active_users.scalar() or 0
 
         # Ticket Médio
         ticket_medio = (valor_total_revenue / total_transactions) if total_transactions > 0 else 0.0
 
-        # Vendas Hoje
-        sales_today_query = db.query(func.sum(Pedido.valor)).filter(
-            Pedido.status.in_(status_pagos), # 🔥 AGORA CONTA EXPIRADOS (Se expirou hoje, conta)
-            Pedido.created_at >= hoje_inicio
-        )
-        if bot_id: sales_today_query = sales_today_query.filter(Pedido.bot_id == bot_id)
-        valor_sales_today = sales_today_query.scalar() or 0.0
-
         # Taxa de Conversão
         universo_total = leads_periodo + total_transactions
         conversao = (total_transactions / universo_total * 100) if universo_total > 0 else 0.0
 
         # --- DADOS DO GRÁFICO ---
+        # Um GROUP BY por bucket sobre o rollup; os buckets vazios são preenchidos com zero aqui
+        if granularity == "day" and (dt_fim - dt_inicio).days + 1 > 366:
+            dt_fim_grafico = dt_inicio + timedelta(days=366)
+        else:
+            dt_fim_grafico = dt_fim
+        bucket = expr_bucket_data(DailyStat.day, granularity, db.bind.dialect.name).label("bucket")
+        serie = db.query(bucket, func.sum(DailyStat.revenue)).filter(
+            DailyStat.day >= dia_inicio,
+            DailyStat.day <= dt_fim_grafico.date()
+        )
+        if bot_id: serie = serie.filter(DailyStat.bot_id == bot_id)
+        valores = {normalizar_bucket(b): float(v or 0.0) for b, v in serie.group_by(bucket).all()}
+
         chart_data = []
-        delta = (dt_fim - dt_inicio).days
-        dias_para_grafico = min(delta + 1, 366)
-        
-        for i in range(dias_para_grafico):
-            data_loop = dt_inicio + timedelta(days=i)
-            data_loop_fim = data_loop + timedelta(days=1)
-            
-            soma_dia = db.query(func.sum(Pedido.valor)).filter(
-                Pedido.status.in_(status_pagos), # 🔥 AGORA CONTA EXPIRADOS
-                Pedido.created_at >= data_loop,
-                Pedido.created_at < data_loop_fim
-            )
-            if bot_id: soma_dia = soma_dia.filter(Pedido.bot_id == bot_id)
-            
-            val = soma_dia.scalar() or 0.0
-            
+        cursor = inicio_do_bucket(dt_inicio, granularity)
+        while cursor <= dt_fim_grafico and (granularity != "day" or len(chart_data) < 366):
             chart_data.append({
-                "name": data_loop.strftime("%d/%m"), 
-                "value": val
+                "name": rotulo_bucket(cursor, granularity), 
+                "value": valores.get(cursor, 0.0)
             })
+            cursor = proximo_bucket(cursor, granularity)
 
         return {
             "total_revenue": valor_total_revenue,
@@ -3827,101 +5746,17 @@ def dashboard_stats(
 # 💸 WEBHOOK DE PAGAMENTO (BLINDADO E TAGARELA)
 # =========================================================
 @app.post("/api/webhook")
-async def webhook(req: Request, bg_tasks: BackgroundTasks):
+def webhook(body_str: str = Depends(corpo_da_requisicao), db: Session = Depends(get_db)):
     try:
-        raw = await req.body()
-        try: 
-            payload = json.loads(raw)
-        except: 
-            # Fallback para formato x-www-form-urlencoded
-            payload = {k: v[0] for k,v in urllib.parse.parse_qs(raw.decode()).items()}
-        
-        status_pag = str(payload.get('status')).upper()
-        
-        if status_pag in ['PAID', 'APPROVED', 'COMPLETED', 'SUCCEEDED']:
-            db = SessionLocal()
-            tx = str(payload.get('id')).lower() # ID da transação
-            
-            p = db.query(Pedido).filter(Pedido.transaction_id == tx).first()
-            
-            if p and p.status != 'paid':
-                p.status = 'paid'
-                db.commit() # Salva o status pago
-                
-                # --- 🔔 NOTIFICAÇÃO AO ADMIN ---
-                try:
-                    bot_db = db.query(Bot).filter(Bot.id == p.bot_id).first()
-                    
-                    if bot_db and bot_db.admin_principal_id:
-                        msg_venda = (
-                            f"💰 *VENDA APROVADA (SITE)!*\n\n"
-                            f"👤 Cliente: {p.first_name}\n"
-                            f"💎 Plano: {p.plano_nome}\n"
-                            f"💵 Valor: R$ {p.valor:.2f}\n"
-                            f"🆔 ID/User: {p.telegram_id}"
-                        )
-                        # Chama a função auxiliar de notificação (assumindo que existe no seu código)
-                        notificar_admin_principal(bot_db, msg_venda) 
-                except Exception as e_notify:
-                    logger.error(f"Erro ao notificar admin: {e_notify}")
-
-                # --- ENVIO DO LINK DE ACESSO AO CLIENTE ---
-                if not p.mensagem_enviada:
-                    try:
-                        bot_data = db.query(Bot).filter(Bot.id == p.bot_id).first()
-                        tb = telebot.TeleBot(bot_data.token)
-                        
-                        # 🔥 Tenta converter para INT. Se falhar (é username), ignora envio automático
-                        target_chat_id = None
-                        try:
-                            target_chat_id = int(p.telegram_id)
-                        except:
-                            logger.warning(f"⚠️ ID não numérico ({p.telegram_id}). Cliente deve iniciar o bot manualmente.")
-                        
-                        if target_chat_id:
-                            # Tenta converter o ID do canal VIP com segurança
-                            try: canal_vip_id = int(str(bot_data.id_canal_vip).strip())
-                            except: canal_vip_id = bot_data.id_canal_vip
-
-                            # Tenta desbanir o usuário antes (garantia)
-                            try: tb.unban_chat_member(canal_vip_id, target_chat_id)
-                            except: pass
+        payload = ler_corpo_webhook(body_str)
+        if payload is None:
+            return {"status": "ignored"}
 
-                            # Gera Link Único (Válido para 1 pessoa)
-                            convite = tb.create_chat_invite_link(
-                                chat_id=canal_vip_id, 
-                                member_limit=1, 
-                                name=f"Venda {p.first_name}"
-                            )
-                            link_acesso = convite.invite_link
-
-                            msg_sucesso = f"""
-✅ <b>Pagamento Confirmado!</b>
-
-Seu acesso ao <b>{bot_data.nome}</b> foi liberado.
-Toque no link abaixo para entrar no Canal VIP:
-
-👉 {link_acesso}
-
-⚠️ <i>Este link é único e válido apenas para você.</i>
-"""
-                            # Envia a mensagem com o link para o usuário
-                            tb.send_message(target_chat_id, msg_sucesso, parse_mode="HTML")
-                            
-                            p.mensagem_enviada = True
-                            db.commit()
-                            logger.info(f"🏆 Link enviado para {p.first_name}")
-
-                    except Exception as e_telegram:
-                        logger.error(f"❌ ERRO TELEGRAM: {e_telegram}")
-                        # Fallback (opcional): Tentar avisar se falhar
-                        try:
-                            if target_chat_id:
-                                tb.send_message(target_chat_id, "✅ Pagamento recebido! \n\n⚠️ Houve um erro ao gerar seu link automático. Um administrador entrará em contato em breve.")
-                        except: pass
+        status_pag = str(payload.get('status')).lower()
+        if status_pag in STATUS_GATEWAY_PAGO:
+            # Mesmo pipeline do PIX: liquida no banco e a entrega vai para a fila
+            registrar_pagamento(db, payload.get('id'), "paid", "site", status_pag, payload)
 
-            db.close()
-        
         return {"status": "received"}
 
     except Exception as e:
@@ -3940,14 +5775,13 @@ def enviar_passo_automatico(bot_temp, chat_id, passo, bot_db, db):
     """
     Envia um passo automaticamente após o delay (COM HTML).
     Similar à lógica do next_step_, mas sem callback do usuário.
+    Chamada pelo agendador quando a tarefa do passo vence.
     """
     logger.info(f"✅ [BOT {bot_db.id}] Enviando passo {passo.step_order} automaticamente: {passo.msg_texto[:30]}...")
     
     # 1. Verifica se existe passo seguinte (CRÍTICO: Fazer isso ANTES de tudo)
-    passo_seguinte = db.query(BotFlowStep).filter(
-        BotFlowStep.bot_id == bot_db.id, 
-        BotFlowStep.step_order == passo.step_order + 1
-    ).first()
+    snap = flow_cache.obter(bot_db.id, db)
+    passo_seguinte = snap.passo(passo.step_order + 1)
     
     # 2. Define o callback do botão (Baseado na existência do próximo)
     if passo_seguinte:
@@ -3968,22 +5802,15 @@ def enviar_passo_automatico(bot_temp, chat_id, passo, bot_db, db):
     try:
         if passo.msg_media:
             try:
-                if passo.msg_media.lower().endswith(('.mp4', '.mov')):
-                    sent_msg = bot_temp.send_video(
-                        chat_id, 
-                        passo.msg_media, 
-                        caption=passo.msg_texto, 
-                        reply_markup=markup_step if passo.mostrar_botao else None,
-                        parse_mode="HTML" # 🔥 Adicionado HTML
-                    )
-                else:
-                    sent_msg = bot_temp.send_photo(
-                        chat_id, 
-                        passo.msg_media, 
-                        caption=passo.msg_texto, 
-                        reply_markup=markup_step if passo.mostrar_botao else None,
-                        parse_mode="HTML" # 🔥 Adicionado HTML
-                    )
+                sent_msg = enviar_midia(
+                    bot_temp,
+                    bot_db.id,
+                    chat_id, 
+                    passo.msg_media, 
+                    caption=passo.msg_texto, 
+                    reply_markup=markup_step if passo.mostrar_botao else None,
+                    parse_mode="HTML" # 🔥 Adicionado HTML
+                )
             except Exception as e_media:
                 logger.error(f"Erro ao enviar mídia no passo automático: {e_media}")
                 # Fallback para texto se a mídia falhar
@@ -4001,31 +5828,9 @@ def enviar_passo_automatico(bot_temp, chat_id, passo, bot_db, db):
                 parse_mode="HTML" # 🔥 Adicionado HTML
             )
         
-        # 5. Lógica Automática (Recursividade e Delay)
-        # Se NÃO tem botão E tem delay E tem próximo passo
-        if not passo.mostrar_botao and passo.delay_seconds > 0 and passo_seguinte:
-            logger.info(f"⏰ [BOT {bot_db.id}] Aguardando {passo.delay_seconds}s antes do próximo...")
-            time.sleep(passo.delay_seconds)
-            
-            # Auto-destruir antes de enviar a próxima
-            if passo.autodestruir and sent_msg:
-                try:
-                    bot_temp.delete_message(chat_id, sent_msg.message_id)
-                    logger.info(f"💣 [BOT {bot_db.id}] Mensagem do passo {passo.step_order} auto-destruída (automático)")
-                except:
-                    pass
-            
-            # Chama o próximo passo (Recursivo)
-            enviar_passo_automatico(bot_temp, chat_id, passo_seguinte, bot_db, db)
-            
-        # Se NÃO tem botão E NÃO tem próximo passo (Fim da Linha)
-        elif not passo.mostrar_botao and not passo_seguinte:
-            # Acabaram os passos, vai pro checkout (Oferta Final)
-            # Se tiver delay no último passo antes da oferta, espera também
-            if passo.delay_seconds > 0:
-                 time.sleep(passo.delay_seconds)
-                 
-            enviar_oferta_final(bot_temp, chat_id, bot_db.fluxo, bot_db.id, db)
+        # 5. Lógica Automática: sem botão, o próximo passo (ou a oferta final)
+        # é agendado para daqui delay_seconds em vez de dormir aqui
+        agendar_continuacao_fluxo(db, bot_temp, chat_id, passo, bot_db, sent_msg)
             
     except Exception as e:
         logger.error(f"❌ [BOT {bot_db.id}] Erro crítico ao enviar passo automático: {e}")
@@ -4036,7 +5841,7 @@ def enviar_passo_automatico(bot_temp, chat_id, passo, bot_db, db):
 def enviar_oferta_final(tb, cid, fluxo, bot_id, db):
     """Envia a oferta final (Planos)"""
     mk = types.InlineKeyboardMarkup()
-    planos = db.query(PlanoConfig).filter(PlanoConfig.bot_id == bot_id).all()
+    planos = flow_cache.obter(bot_id, db).planos
     
     if fluxo and fluxo.mostrar_planos_2:
         for p in planos:
@@ -4050,10 +5855,7 @@ def enviar_oferta_final(tb, cid, fluxo, bot_id, db):
     
     try:
         if med:
-            if med.endswith(('.mp4','.mov')): 
-                tb.send_video(cid, med, caption=txt, reply_markup=mk)
-            else: 
-                tb.send_photo(cid, med, caption=txt, reply_markup=mk)
+            enviar_midia(tb, bot_id, cid, med, caption=txt, reply_markup=mk)
         else:
             tb.send_message(cid, txt, reply_markup=mk)
     except:
@@ -4078,26 +5880,20 @@ def get_profile_stats(db: Session = Depends(get_db)):
         # 2. Estatísticas GLOBAIS
         total_bots = db.query(Bot).count()
         
-        q_leads = db.query(Lead.user_id).all()
-        q_pedidos = db.query(Pedido.telegram_id).all()
-        
-        unique_members = set()
-        for r in q_leads:
-            if r[0]: unique_members.add(str(r[0]))
-        for r in q_pedidos:
-            if r[0]: unique_members.add(str(r[0]))
-            
-        total_members = len(unique_members)
-        
-        # ============================================================
-        # 💰 [CORRIGIDO] Status para Contar DINHEIRO (INCLUI EXPIRADO)
-        # ============================================================
-        status_financeiro = ['paid', 'approved', 'active', 'completed', 'succeeded', 'expired']
+        # Contatos únicos em leads+pedidos: COUNT sobre UNION, tudo no banco
+        membros = union(
+            select(Lead.user_id.label("telegram_id")).where(Lead.user_id.isnot(None), Lead.user_id != ""),
+            select(Pedido.telegram_id.label("telegram_id")).where(Pedido.telegram_id.isnot(None), Pedido.telegram_id != "")
+        ).subquery("membros")
+        total_members = db.execute(select(func.count()).select_from(membros)).scalar() or 0
         
-        revenue_query = db.query(func.sum(Pedido.valor)).filter(Pedido.status.in_(status_financeiro))
-        total_revenue = revenue_query.scalar() or 0.0
-        
-        total_sales = db.query(Pedido).filter(Pedido.status.in_(status_financeiro)).count()
+        # 💰 Faturamento e vendas (pagos + expirados) vêm do rollup diário
+        total_revenue, total_sales = db.query(
+            func.coalesce(func.sum(DailyStat.revenue), 0.0),
+            func.coalesce(func.sum(DailyStat.sales), 0)
+        ).one()
+        total_revenue = float(total_revenue or 0.0)
+        total_sales = int(total_sales or 0)
         
         # 3. Lógica de Gamificação
         levels = [
@@ -4218,27 +6014,72 @@ def get_miniapp_config(bot_id: int, db: Session = Depends(get_db)):
 def on_startup():
     print("Starting Container - Zenyx")
     
-    # 1. Cria tabelas básicas se não existirem
+    # 1. Schema: o worker NÃO faz DDL. Migrações rodam antes, via `python migrate.py`.
+    #    Aqui só conferimos a versão (um SELECT) e avisamos se o deploy esqueceu.
     try:
-        init_db()
+        with engine.connect() as conn:
+            versao = versao_do_banco(conn)
+        if versao < VERSAO_SCHEMA:
+            logger.warning(f"⚠️ Banco na versão {versao}, código espera {VERSAO_SCHEMA}. Rode: python migrate.py")
     except Exception as e:
-        logger.error(f"Erro no init_db: {e}")
-
-    # 2. Migrações (COMENTADAS PARA NÃO RODAR TODA HORA)
-    # Descomente apenas se criar uma tabela nova no futuro
-    # try:
-    #     executar_migracao_v3()
-    #     executar_migracao_v4()
-    #     executar_migracao_v5()
-    #     executar_migracao_v6()
-    # except: pass
-    
+        logger.error(f"Erro ao verificar versão do schema: {e}")
+
+    # 1.1 Agendador de passos com delay (recupera o que ficou pendente no último deploy)
+    try:
+        iniciar_agendador_fluxo()
+    except Exception as e:
+        logger.error(f"Erro ao iniciar agendador de fluxo: {e}")
+
+    # 1.2 Entregas de pagamentos que ficaram pela metade no último deploy
+    try:
+        iniciar_fila_entregas()
+    except Exception as e:
+        logger.error(f"Erro ao iniciar fila de entregas: {e}")
+
+    # 1.3 Heap de vencimentos deste worker (kicks agendados pelo webhook/update_user)
+    try:
+        fila_vencimentos.iniciar()
+    except Exception as e:
+        logger.error(f"Erro ao iniciar fila de vencimentos: {e}")
+
+    # 1.4 Jobs periódicos (Ceifador, pool de convites VIP, retomada do
+    #     remarketing): um processo por job, disputado pelo coordenador
+    #     (failover automático se o líder cair)
+    try:
+        coordenador_jobs.iniciar()
+    except Exception as e:
+        logger.error(f"Erro ao iniciar coordenador de jobs: {e}")
+
     logger.info("✅ Sistema Iniciado e Pronto!")
 
+@app.on_event("shutdown")
+def on_shutdown():
+    # Termina os updates que já estão no pool antes de derrubar o processo
+    webhook_executor.shutdown(wait=True)
+    # Tarefas que ainda não venceram continuam no banco e voltam no próximo startup
+    agendador_executor.shutdown(wait=True)
+    # Entregas em andamento terminam; as que estão esperando retry ficam no banco
+    entrega_executor.shutdown(wait=True)
+    # Lote de kicks em andamento termina; o resto volta na recarga do próximo startup
+    ceifador_executor.shutdown(wait=True)
+    # Lembretes reservados e ainda não enviados terminam de sair
+    lembretes_executor.shutdown(wait=True)
+
 @app.get("/")
 def home():
 
     return {"status": "Zenyx SaaS Online - Banco Atualizado"}
+
+@app.get("/api/admin/telegram/fila")
+def status_fila_telegram():
+    """Profundidade da fila de saída do Telegram (chamadas esperando vaga, 429s, pausas)."""
+    return telegram_dispatcher.estatisticas()
+
+@app.get("/api/admin/jobs")
+def status_jobs():
+    """Quais jobs periódicos ESTE worker está liderando (cada worker responde por si)."""
+    return coordenador_jobs.estatisticas()
+
 @app.get("/admin/clean-leads-to-pedidos")
 def limpar_leads_que_viraram_pedidos(db: Session = Depends(get_db)):
     """
@@ -0,0 +1,373 @@
+# =========================================================
+# 🗄️ MIGRAÇÕES VERSIONADAS (RODAR FORA DO SERVIDOR)
+# =========================================================
+# Substitui o "reparo" que rodava a cada boot (force_migration no import,
+# init_db no startup, ALTERs soltos e migration_v3..v7).
+#
+# Rode UMA vez por deploy, antes de subir os workers (release command):
+#   python migrate.py            aplica o que falta
+#   python migrate.py --status   só mostra a versão atual
+#
+# - A tabela schema_version guarda cada versão aplicada.
+# - Postgres: pg_advisory_lock garante que dois deploys/réplicas não
+#   migram ao mesmo tempo (o segundo espera e encontra tudo aplicado).
+#   SQLite: trava de arquivo ao lado do banco.
+# - Cada passo é idempotente (verifica coluna/índice antes de criar),
+#   então pode rodar de novo sem medo se cair no meio.
+#
+# Para mudar o schema: altere o model em database.py e ADICIONE uma
+# versão no final de MIGRACOES. Nunca edite uma versão já publicada.
+
+import sys
+import argparse
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, text, select
+from sqlalchemy.schema import CreateIndex
+
+from database import Base, engine, Pedido, Lead, Entrega, PagamentoEvento, ConviteVip, LembreteRenovacao, Assinatura
+
+logger = logging.getLogger(__name__)
+
+# Chave fixa do advisory lock (qualquer inteiro, só precisa ser sempre o mesmo)
+CHAVE_LOCK_MIGRACAO = 7_202_601
+
+# =========================================================
+# 🧰 HELPERS
+# =========================================================
+def _colunas(conn, tabela, cache):
+    if tabela not in cache:
+        insp = inspect(conn)
+        cache[tabela] = {c["name"] for c in insp.get_columns(tabela)} if insp.has_table(tabela) else None
+    return cache[tabela]
+
+def adicionar_colunas(conn, colunas):
+    """colunas = [(tabela, "nome TIPO [DEFAULT ...]"), ...] - só cria as que faltam."""
+    cache = {}
+    for tabela, definicao in colunas:
+        existentes = _colunas(conn, tabela, cache)
+        nome = definicao.split()[0]
+        if existentes is None or nome in existentes:
+            continue
+        conn.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {definicao}"))
+        existentes.add(nome)
+        logger.info(f"   ➕ {tabela}.{nome}")
+
+def criar_indices(conn, tabela, nomes):
+    """Cria os Index() `nomes` declarados no model (CONCURRENTLY no Postgres)."""
+    postgres = conn.dialect.name == "postgresql"
+    indices = sorted((i for i in tabela.indexes if i.name in nomes), key=lambda i: i.name)
+
+    if postgres:
+        # Um CONCURRENTLY interrompido deixa o índice INVALID e o
+        # IF NOT EXISTS pularia ele para sempre: apaga e recria.
+        invalidos = conn.execute(text("""
+            SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE NOT i.indisvalid AND c.relname = ANY(:nomes)
+        """), {"nomes": nomes}).scalars().all()
+        for nome in invalidos:
+            logger.warning(f"   ⚠️ Índice inválido {nome}, recriando...")
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{nome}"'))
+
+    for indice in indices:
+        sql = str(CreateIndex(indice, if_not_exists=True).compile(dialect=conn.dialect))
+        if postgres:
+            sql = sql.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+        conn.execute(text(sql))
+        logger.info(f"   📇 {indice.name}")
+    conn.execute(text(f"ANALYZE {tabela.name}"))
+
+# =========================================================
+# 📜 VERSÕES
+# =========================================================
+def v1_tabelas_base(conn):
+    # Cria só o que não existe (mesmo efeito do antigo init_db no startup)
+    Base.metadata.create_all(bind=conn)
+
+def v2_colunas_legadas(conn):
+    # Antigo "reparo" de startup + force_migration.py (bancos criados antes dos models atuais)
+    adicionar_colunas(conn, [
+        ("planos_config", "key_id VARCHAR"),
+        ("planos_config", "descricao TEXT"),
+        ("planos_config", "preco_cheio FLOAT"),
+        ("pedidos", "plano_id INTEGER"),
+        ("pedidos", "plano_nome VARCHAR"),
+        ("pedidos", "txid VARCHAR"),
+        ("pedidos", "qr_code TEXT"),
+        ("pedidos", "transaction_id VARCHAR"),
+        ("pedidos", "data_aprovacao TIMESTAMP WITHOUT TIME ZONE"),
+        ("pedidos", "data_expiracao TIMESTAMP WITHOUT TIME ZONE"),
+        ("pedidos", "custom_expiration TIMESTAMP WITHOUT TIME ZONE"),
+        ("pedidos", "link_acesso VARCHAR"),
+        ("pedidos", "mensagem_enviada BOOLEAN DEFAULT FALSE"),
+        ("pedidos", "tracking_id INTEGER"),
+        ("bot_flows", "autodestruir_1 BOOLEAN DEFAULT FALSE"),
+        ("bot_flows", "msg_2_texto TEXT"),
+        ("bot_flows", "msg_2_media VARCHAR"),
+        ("bot_flows", "mostrar_planos_2 BOOLEAN DEFAULT TRUE"),
+        ("bot_flows", "mostrar_planos_1 BOOLEAN DEFAULT FALSE"),
+        ("bot_flows", "start_mode VARCHAR DEFAULT 'padrao'"),
+        ("bot_flows", "miniapp_url VARCHAR"),
+        ("bot_flows", "miniapp_btn_text VARCHAR DEFAULT 'ABRIR LOJA 🛍️'"),
+        ("remarketing_campaigns", "target VARCHAR DEFAULT 'todos'"),
+        ("remarketing_campaigns", "type VARCHAR DEFAULT 'massivo'"),
+        ("remarketing_campaigns", "plano_id INTEGER"),
+        ("remarketing_campaigns", "promo_price FLOAT"),
+        ("remarketing_campaigns", "expiration_at TIMESTAMP WITHOUT TIME ZONE"),
+        ("remarketing_campaigns", "dia_atual INTEGER DEFAULT 0"),
+        ("remarketing_campaigns", "data_inicio TIMESTAMP WITHOUT TIME ZONE DEFAULT now()"),
+        ("remarketing_campaigns", "proxima_execucao TIMESTAMP WITHOUT TIME ZONE"),
+        ("bots", "suporte_username VARCHAR"),
+        ("bots", "pushin_token VARCHAR"),
+        ("leads", "tracking_id INTEGER REFERENCES tracking_links(id)"),
+        ("miniapp_categories", "bg_color VARCHAR DEFAULT '#000000'"),
+        ("miniapp_categories", "banner_desk_url VARCHAR"),
+        ("miniapp_categories", "video_preview_url VARCHAR"),
+        ("miniapp_categories", "model_img_url VARCHAR"),
+        ("miniapp_categories", "model_name VARCHAR"),
+        ("miniapp_categories", "model_desc TEXT"),
+        ("miniapp_categories", "footer_banner_url VARCHAR"),
+        ("miniapp_categories", "deco_lines_url VARCHAR"),
+        ("miniapp_categories", "model_name_color VARCHAR DEFAULT '#ffffff'"),
+        ("miniapp_categories", "model_desc_color VARCHAR DEFAULT '#cccccc'"),
+    ])
+
+def v3_flow_chat(conn):
+    adicionar_colunas(conn, [
+        ("bot_flow_steps", "autodestruir BOOLEAN DEFAULT FALSE"),
+        ("bot_flow_steps", "mostrar_botao BOOLEAN DEFAULT TRUE"),
+    ])
+    conn.execute(text("""
+        UPDATE bot_flow_steps SET autodestruir = FALSE, mostrar_botao = TRUE
+        WHERE autodestruir IS NULL OR mostrar_botao IS NULL
+    """))
+
+def v4_temporizador(conn):
+    adicionar_colunas(conn, [("bot_flow_steps", "delay_seconds INTEGER DEFAULT 0")])
+    conn.execute(text("UPDATE bot_flow_steps SET delay_seconds = 0 WHERE delay_seconds IS NULL"))
+
+def v5_order_bump(conn):
+    # A tabela order_bump_config já vem do v1 (create_all)
+    adicionar_colunas(conn, [("pedidos", "tem_order_bump BOOLEAN DEFAULT FALSE")])
+
+def v6_order_bump_autodestruir(conn):
+    adicionar_colunas(conn, [("order_bump_config", "autodestruir BOOLEAN DEFAULT FALSE")])
+
+def v7_indices_caminhos_quentes(conn):
+    criar_indices(conn, Pedido.__table__, {
+        "ix_pedidos_bot_telegram_status_criado", "ix_pedidos_bot_criado", "ix_pedidos_transaction_id",
+        "ix_pedidos_pendentes", "ix_pedidos_pagos_vencimento",
+    })
+    criar_indices(conn, Lead.__table__, {"ix_leads_user_bot", "ix_leads_bot_criado"})
+
+def v8_entregas(conn):
+    Entrega.__table__.create(bind=conn, checkfirst=True)
+
+def v9_payment_events(conn):
+    PagamentoEvento.__table__.create(bind=conn, checkfirst=True)
+
+def v10_payment_ref(conn, lote=5000):
+    # Referência normalizada do gateway: o webhook deixa de fazer
+    # "txid = x OR transaction_id = x" e passa a sondar um índice único.
+    adicionar_colunas(conn, [("pedidos", "payment_ref VARCHAR")])
+
+    # Histórico em lotes por id (AUTOCOMMIT: cada lote trava só as suas linhas)
+    menor, maior = conn.execute(text("SELECT MIN(id), MAX(id) FROM pedidos")).one()
+    preenchidos = 0
+    inicio = menor or 0
+    while maior is not None and inicio <= maior:
+        preenchidos += conn.execute(text("""
+            UPDATE pedidos
+            SET payment_ref = LOWER(TRIM(COALESCE(NULLIF(TRIM(txid), ''), transaction_id)))
+            WHERE id >= :inicio AND id < :fim AND payment_ref IS NULL
+              AND COALESCE(NULLIF(TRIM(txid), ''), NULLIF(TRIM(transaction_id), '')) IS NOT NULL
+        """), {"inicio": inicio, "fim": inicio + lote}).rowcount
+        inicio += lote
+    logger.info(f"   🔁 payment_ref preenchido em {preenchidos} pedidos")
+
+    # Refs repetidas (ex.: mesmo id em maiúsculo/minúsculo em dois pedidos)
+    # ficam só no pedido mais antigo, senão o índice único não sobe.
+    duplicados = conn.execute(text("""
+        UPDATE pedidos SET payment_ref = NULL
+        WHERE payment_ref IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM pedidos WHERE payment_ref IS NOT NULL GROUP BY payment_ref
+        )
+    """)).rowcount
+    if duplicados:
+        logger.warning(f"   ⚠️ {duplicados} pedidos com referência repetida ficaram sem payment_ref")
+
+    criar_indices(conn, Pedido.__table__, {"uq_pedidos_payment_ref"})
+
+def v11_convites_vip(conn):
+    ConviteVip.__table__.create(bind=conn, checkfirst=True)
+
+def v12_lembretes_renovacao(conn):
+    LembreteRenovacao.__table__.create(bind=conn, checkfirst=True)
+
+def _validade_legada(plano_nome, criado_em):
+    # Pedido antigo, de antes de a liquidação gravar a validade: mesma regra
+    # de nome de plano que o porteiro usava
+    nm = (plano_nome or "").lower()
+    if not nm or "vital" in nm or "mega" in nm or "eterno" in nm or not criado_em:
+        return None
+    dias = 30
+    if "diario" in nm or "24" in nm: dias = 1
+    elif "semanal" in nm: dias = 7
+    elif "trimestral" in nm: dias = 90
+    elif "anual" in nm: dias = 365
+    return criado_em + timedelta(days=dias)
+
+def v13_subscriptions(conn, lote=5000):
+    # Direito de acesso por (bot, usuário): o pedido pago que dá o acesso
+    # mais longo vira a assinatura (vitalício ganha de qualquer data)
+    Assinatura.__table__.create(bind=conn, checkfirst=True)
+    conn.execute(Assinatura.__table__.delete())  # recomeça do zero se caiu no meio
+
+    p = Pedido.__table__
+    melhores = {}
+    ultimo_id = 0
+    while True:
+        linhas = conn.execute(
+            select(p.c.id, p.c.bot_id, p.c.telegram_id, p.c.custom_expiration,
+                   p.c.data_aprovacao, p.c.plano_nome, p.c.created_at)
+            .where(p.c.id > ultimo_id, p.c.status.in_(["paid", "approved", "active"]),
+                   p.c.bot_id.isnot(None), p.c.telegram_id.isnot(None))
+            .order_by(p.c.id).limit(lote)
+        ).all()
+        if not linhas:
+            break
+        ultimo_id = linhas[-1].id
+        for l in linhas:
+            if l.custom_expiration or l.data_aprovacao:
+                validade = l.custom_expiration  # liquidado: None = vitalício
+            else:
+                validade = _validade_legada(l.plano_nome, l.created_at)
+            chave = (l.bot_id, str(l.telegram_id))
+            atual = melhores.get(chave)
+            if atual is None or (atual[0] is not None and (validade is None or validade >= atual[0])):
+                melhores[chave] = (validade, l.id)
+
+    agora = datetime.utcnow()
+    linhas = [
+        {"bot_id": bot_id, "telegram_id": telegram_id, "expires_at": validade,
+         "source_pedido_id": pedido_id, "updated_at": agora}
+        for (bot_id, telegram_id), (validade, pedido_id) in melhores.items()
+    ]
+    for i in range(0, len(linhas), lote):
+        conn.execute(Assinatura.__table__.insert(), linhas[i:i + lote])
+    logger.info(f"   🎫 {len(linhas)} assinaturas criadas a partir dos pedidos pagos")
+
+def v14_indice_vencimentos_ativos(conn):
+    # O parcial antigo só cobria status 'paid' e vinha com bot_id na frente;
+    # o PIX do bot liquida como 'approved' e as varreduras são por faixa global.
+    if conn.dialect.name == "postgresql":
+        conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS "ix_pedidos_pagos_vencimento"'))
+    else:
+        conn.execute(text('DROP INDEX IF EXISTS "ix_pedidos_pagos_vencimento"'))
+    criar_indices(conn, Pedido.__table__, {"ix_pedidos_ativos_vencimento"})
+
+def v15_tarefas_reservado_em(conn):
+    # Tarefa presa em 'processando' passa a ser detectada pela hora do claim
+    adicionar_colunas(conn, [("tarefas_agendadas", "reservado_em TIMESTAMP WITHOUT TIME ZONE")])
+
+# (versão, descrição, função) - SEMPRE em ordem, só acrescente no final
+MIGRACOES = [
+    (1, "Tabelas base (create_all)", v1_tabelas_base),
+    (2, "Colunas legadas do reparo de startup", v2_colunas_legadas),
+    (3, "Flow chat: autodestruir / mostrar_botao", v3_flow_chat),
+    (4, "Temporizador entre mensagens", v4_temporizador),
+    (5, "Order bump nos pedidos", v5_order_bump),
+    (6, "Order bump autodestruir", v6_order_bump_autodestruir),
+    (7, "Índices dos caminhos quentes", v7_indices_caminhos_quentes),
+    (8, "Tabela entregas (liquidação de pagamentos)", v8_entregas),
+    (9, "Ledger payment_events", v9_payment_events),
+    (10, "payment_ref normalizado + índice único", v10_payment_ref),
+    (11, "Pool de convites do canal VIP", v11_convites_vip),
+    (12, "Lembretes de renovação", v12_lembretes_renovacao),
+    (13, "Tabela subscriptions (direito de acesso)", v13_subscriptions),
+    (14, "Índice de vencimentos paid/approved", v14_indice_vencimentos_ativos),
+    (15, "Hora do claim das tarefas agendadas", v15_tarefas_reservado_em),
+]
+
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+# =========================================================
+# 🔒 TRAVA + CONTROLE DE VERSÃO
+# =========================================================
+@contextmanager
+def trava_migracao(conn):
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": CHAVE_LOCK_MIGRACAO})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": CHAVE_LOCK_MIGRACAO})
+        return
+
+    import fcntl
+    caminho = (engine.url.database or "sql_app.db") + ".migrate.lock"
+    with open(caminho, "w") as arquivo:
+        fcntl.flock(arquivo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(arquivo, fcntl.LOCK_UN)
+
+def _garantir_tabela_versao(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            versao INTEGER PRIMARY KEY,
+            descricao VARCHAR,
+            aplicada_em TIMESTAMP WITHOUT TIME ZONE
+        )
+    """))
+
+def versao_do_banco(conn):
+    """Maior versão aplicada (0 = banco nunca migrado). Não faz DDL."""
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(text("SELECT COALESCE(MAX(versao), 0) FROM schema_version")).scalar() or 0
+
+def migrar():
+    # AUTOCOMMIT: cada comando vale na hora (CONCURRENTLY exige isso) e o
+    # advisory lock é de sessão, então continua segurando entre os passos.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        with trava_migracao(conn):
+            _garantir_tabela_versao(conn)
+            atual = versao_do_banco(conn)
+            pendentes = [m for m in MIGRACOES if m[0] > atual]
+            if not pendentes:
+                logger.info(f"✅ Banco já está na versão {atual}. Nada a fazer.")
+                return atual
+
+            for versao, descricao, funcao in pendentes:
+                logger.info(f"🔄 [V{versao}] {descricao}...")
+                inicio = datetime.utcnow()
+                funcao(conn)
+                conn.execute(
+                    text("INSERT INTO schema_version (versao, descricao, aplicada_em) VALUES (:v, :d, :t)"),
+                    {"v": versao, "d": descricao, "t": datetime.utcnow()}
+                )
+                logger.info(f"   ✅ V{versao} aplicada em {(datetime.utcnow() - inicio).total_seconds():.1f}s")
+
+            logger.info(f"🏁 Banco migrado: versão {atual} -> {VERSAO_ATUAL}")
+            return VERSAO_ATUAL
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Aplica as migrações versionadas do banco")
+    parser.add_argument("--status", action="store_true", help="Só mostra a versão atual do banco")
+    args = parser.parse_args()
+
+    if args.status:
+        with engine.connect() as conn:
+            versao = versao_do_banco(conn)
+        print(f"Banco na versão {versao} (código espera {VERSAO_ATUAL})")
+        sys.exit(0 if versao >= VERSAO_ATUAL else 1)
+
+    try:
+        migrar()
+    except Exception as e:
+        logger.error(f"❌ Migração falhou: {e}")
+        sys.exit(1)
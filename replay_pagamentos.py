@@ -0,0 +1,47 @@
+# =========================================================
+# 🧾 REPLAY DO LEDGER DE PAGAMENTOS (payment_events)
+# =========================================================
+# Reaplica os eventos de pagamento gravados pelos webhooks sobre a tabela
+# pedidos. Só mexe em pedido que tem evento aprovado mas NÃO está pago
+# (ex.: banco restaurado de backup, bug na liquidação). Pedidos já pagos
+# ou expirados ficam como estão, então pode rodar quantas vezes quiser.
+#
+#   python replay_pagamentos.py --simular                 só conta
+#   python replay_pagamentos.py --desde 2025-01-31
+#   python replay_pagamentos.py --entregar                já envia o acesso
+#
+# Sem --entregar o cliente recebe o acesso no próximo /start (recuperação).
+
+import argparse
+import logging
+from datetime import datetime
+
+from database import SessionLocal
+from main import reprocessar_eventos_pagamento, entrega_executor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reaplica o ledger payment_events sobre os pedidos")
+    parser.add_argument("--desde", default=None, help="Data inicial (YYYY-MM-DD)")
+    parser.add_argument("--entregar", action="store_true", help="Envia o acesso pelo Telegram agora")
+    parser.add_argument("--simular", action="store_true", help="Só mostra o que seria reaplicado")
+    args = parser.parse_args()
+
+    desde = datetime.fromisoformat(args.desde) if args.desde else None
+    db = SessionLocal()
+    try:
+        contagem = reprocessar_eventos_pagamento(db, desde=desde, entregar=args.entregar, simular=args.simular)
+        prefixo = "🔎 [SIMULAÇÃO]" if args.simular else "✅"
+        logger.info(
+            f"{prefixo} {contagem['eventos']} eventos lidos: {contagem['reaplicados']} reaplicados, "
+            f"{contagem['ja_pagos']} já pagos, {contagem['sem_pedido']} sem pedido."
+        )
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Erro no replay: {e}")
+    finally:
+        db.close()
+        # Espera as entregas disparadas com --entregar terminarem
+        entrega_executor.shutdown(wait=True)
@@ -0,0 +1,78 @@
+# =========================================================
+# 🧪 AMBIENTE DE TESTE (SQLITE + TELEGRAM FALSO)
+# =========================================================
+# O banco é um SQLite temporário migrado com o próprio migrate.py (o mesmo
+# caminho do deploy) e nenhuma chamada sai para o Telegram: o
+# apihelper._make_request do telebot é trocado por um fake que só registra.
+import os
+import sys
+import tempfile
+import itertools
+from datetime import datetime
+
+import pytest
+
+_PASTA_BANCO = tempfile.mkdtemp(prefix="zenyx-testes-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_PASTA_BANCO, 'testes.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import apihelper
+
+CHAMADAS_TELEGRAM = []
+
+def _telegram_falso(token, method_name, method="get", params=None, files=None):
+    CHAMADAS_TELEGRAM.append((token, method_name, dict(params or {})))
+    if method_name == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "bot_teste"}
+    if method_name.startswith("send"):
+        return {"message_id": len(CHAMADAS_TELEGRAM), "date": 0, "chat": {"id": 1, "type": "private"}}
+    if method_name in ("createChatInviteLink", "revokeChatInviteLink"):
+        return {"invite_link": f"https://t.me/+teste{len(CHAMADAS_TELEGRAM)}", "creates_join_request": False,
+                "is_primary": False, "is_revoked": method_name == "revokeChatInviteLink",
+                "creator": {"id": 1, "is_bot": True, "first_name": "Bot"}}
+    return True
+
+apihelper._make_request = _telegram_falso
+
+import migrate
+migrate.migrar()
+
+import database
+import main
+
+_sequencia = itertools.count(1)
+
+@pytest.fixture
+def db():
+    sessao = database.SessionLocal()
+    try:
+        yield sessao
+    finally:
+        sessao.rollback()
+        sessao.close()
+
+@pytest.fixture
+def bot(db):
+    """Bot novo por teste (token único: nada vaza pelo bot_registry)."""
+    n = next(_sequencia)
+    registro = database.Bot(nome=f"Bot {n}", token=f"{n}:teste", id_canal_vip="-100123", admin_principal_id="999")
+    db.add(registro)
+    db.commit()
+    return registro
+
+@pytest.fixture
+def novo_pedido(db, bot):
+    def criar(telegram_id="111", status="paid", custom_expiration=None, **campos):
+        n = next(_sequencia)
+        pedido = database.Pedido(
+            bot_id=bot.id, telegram_id=str(telegram_id), first_name="Fulano",
+            plano_nome=campos.pop("plano_nome", "Mensal"), valor=campos.pop("valor", 10.0),
+            status=status, custom_expiration=custom_expiration,
+            transaction_id=campos.pop("transaction_id", f"tx-{n}"),
+            payment_ref=campos.pop("payment_ref", f"tx-{n}"),
+            created_at=campos.pop("created_at", datetime.utcnow()), **campos
+        )
+        db.add(pedido)
+        db.commit()
+        return pedido
+    return criar
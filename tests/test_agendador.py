@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import main
+
+
+@pytest.fixture
+def heap(monkeypatch):
+    agendadas = []
+    monkeypatch.setattr(main.fila_fluxo, "agendar", lambda quando, tarefa_id: agendadas.append((tarefa_id, quando)))
+    return agendadas
+
+
+@pytest.fixture
+def oferta_falhando(monkeypatch):
+    def falhar(*args, **kwargs):
+        raise RuntimeError("429 Too Many Requests")
+    monkeypatch.setattr(main, "enviar_oferta_final", falhar)
+
+
+def _tarefa(db, bot, **campos):
+    campos.setdefault("executar_em", datetime.utcnow() - timedelta(seconds=1))
+    campos.setdefault("status", "pendente")
+    tarefa = database.TarefaAgendada(bot_id=bot.id, chat_id="123", tipo="oferta", **campos)
+    db.add(tarefa)
+    db.commit()
+    return tarefa.id
+
+
+def _recarregar(db, tarefa_id):
+    db.expire_all()
+    return db.get(database.TarefaAgendada, tarefa_id)
+
+
+def test_tarefa_concluida_e_apagada(db, bot, monkeypatch):
+    enviadas = []
+    monkeypatch.setattr(main, "enviar_oferta_final", lambda tb, chat_id, *args: enviadas.append(chat_id))
+    tarefa_id = _tarefa(db, bot)
+
+    main.executar_tarefa_fluxo(tarefa_id)
+
+    assert enviadas == ["123"]
+    assert _recarregar(db, tarefa_id) is None
+
+
+def test_falha_volta_com_backoff(db, bot, heap, oferta_falhando):
+    tarefa_id = _tarefa(db, bot)
+
+    main.executar_tarefa_fluxo(tarefa_id)
+
+    tarefa = _recarregar(db, tarefa_id)
+    assert (tarefa.status, tarefa.tentativas) == ("erro", 1)
+    assert tarefa.executar_em > datetime.utcnow() + timedelta(seconds=main.AGENDADOR_BACKOFF_SEGUNDOS[0] - 5)
+    assert heap == [(tarefa_id, tarefa.executar_em)]
+
+    # Antes do backoff vencer ninguém pega a tarefa de novo
+    main.executar_tarefa_fluxo(tarefa_id)
+    assert _recarregar(db, tarefa_id).tentativas == 1
+
+
+def test_esgotou_as_tentativas_e_apagada(db, bot, heap, oferta_falhando):
+    tarefa_id = _tarefa(db, bot, status="erro", tentativas=main.AGENDADOR_MAX_TENTATIVAS - 1)
+
+    main.executar_tarefa_fluxo(tarefa_id)
+
+    assert _recarregar(db, tarefa_id) is None
+    assert heap == []
+
+
+def test_claim_abandonado_volta_pela_hora_do_claim(db, bot, heap):
+    travada = datetime.utcnow() - timedelta(minutes=main.AGENDADOR_TRAVADA_MINUTOS + 1)
+    # Atrasou na fila mas foi pego agora: um worker vivo ainda está com ela
+    viva = _tarefa(db, bot, status="processando", executar_em=travada, reservado_em=datetime.utcnow())
+    morta = _tarefa(db, bot, status="processando", executar_em=datetime.utcnow(), reservado_em=travada)
+
+    main._liberar_tarefas_travadas(db)
+
+    assert _recarregar(db, viva).status == "processando"
+    assert _recarregar(db, morta).status == "erro"
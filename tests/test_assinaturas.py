@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+
+import database
+import main
+
+
+def _assinatura(db, bot, telegram_id):
+    db.expire_all()
+    return db.get(database.Assinatura, (bot.id, str(telegram_id)))
+
+
+def _conceder(db, pedido, validade, forcar=False):
+    main.conceder_assinatura(db, pedido, validade, forcar=forcar)
+    db.commit()
+
+
+def test_primeiro_pagamento_cria_a_assinatura(db, bot, novo_pedido):
+    validade = datetime.utcnow() + timedelta(days=30)
+    pedido = novo_pedido(telegram_id="601")
+    _conceder(db, pedido, validade)
+
+    assinatura = _assinatura(db, bot, "601")
+    assert (assinatura.expires_at, assinatura.source_pedido_id) == (validade, pedido.id)
+
+
+def test_pagamento_mais_curto_nao_encurta_e_mais_longo_estende(db, bot, novo_pedido):
+    agora = datetime.utcnow()
+    anual, semanal, bienal = (novo_pedido(telegram_id="602") for _ in range(3))
+    _conceder(db, anual, agora + timedelta(days=365))
+
+    _conceder(db, semanal, agora + timedelta(days=7))
+    assert _assinatura(db, bot, "602").source_pedido_id == anual.id
+
+    _conceder(db, bienal, agora + timedelta(days=730))
+    assinatura = _assinatura(db, bot, "602")
+    assert (assinatura.expires_at, assinatura.source_pedido_id) == (agora + timedelta(days=730), bienal.id)
+
+
+def test_vitalicio_ganha_de_qualquer_data_e_nao_e_substituido(db, bot, novo_pedido):
+    mensal, vitalicio, outro = (novo_pedido(telegram_id="603") for _ in range(3))
+    _conceder(db, mensal, datetime.utcnow() + timedelta(days=30))
+    _conceder(db, vitalicio, None)
+    _conceder(db, outro, datetime.utcnow() + timedelta(days=3650))
+
+    assinatura = _assinatura(db, bot, "603")
+    assert (assinatura.expires_at, assinatura.source_pedido_id) == (None, vitalicio.id)
+
+
+def test_o_proprio_pedido_pode_mudar_a_validade(db, bot, novo_pedido):
+    pedido = novo_pedido(telegram_id="604")
+    _conceder(db, pedido, datetime.utcnow() + timedelta(days=30))
+    menor = datetime.utcnow() + timedelta(days=3)
+    _conceder(db, pedido, menor)
+
+    assert _assinatura(db, bot, "604").expires_at == menor
+
+
+def test_forcar_deixa_o_painel_encurtar(db, bot, novo_pedido):
+    vitalicio, editado = novo_pedido(telegram_id="605"), novo_pedido(telegram_id="605")
+    _conceder(db, vitalicio, None)
+    amanha = datetime.utcnow() + timedelta(days=1)
+    _conceder(db, editado, amanha, forcar=True)
+
+    assinatura = _assinatura(db, bot, "605")
+    assert (assinatura.expires_at, assinatura.source_pedido_id) == (amanha, editado.id)
+
+
+def test_revogar_so_remove_o_acesso_do_proprio_pedido(db, bot, novo_pedido):
+    ativo, estornado = novo_pedido(telegram_id="606"), novo_pedido(telegram_id="606")
+    _conceder(db, ativo, None)
+
+    main.revogar_assinatura(db, estornado)
+    db.commit()
+    assert _assinatura(db, bot, "606") is not None
+
+    main.revogar_assinatura(db, ativo)
+    db.commit()
+    assert _assinatura(db, bot, "606") is None
+
+
+def test_recarga_agenda_pedido_substituido_por_renovacao(db, novo_pedido, monkeypatch):
+    agendados = {}
+    monkeypatch.setattr(main, "agendar_vencimento", lambda pedido_id, quando: agendados.__setitem__(pedido_id, quando))
+    agora = datetime.utcnow()
+    antigo = novo_pedido(telegram_id="607", custom_expiration=agora + timedelta(hours=1))
+    renovacao = novo_pedido(telegram_id="607", status="approved", custom_expiration=agora + timedelta(hours=2))
+    _conceder(db, antigo, antigo.custom_expiration)
+    _conceder(db, renovacao, renovacao.custom_expiration)
+    longe = novo_pedido(telegram_id="608", custom_expiration=agora + timedelta(days=10))
+
+    main.recarregar_vencimentos()
+
+    assert agendados.get(antigo.id) == antigo.custom_expiration
+    assert agendados.get(renovacao.id) == renovacao.custom_expiration
+    assert longe.id not in agendados
+
+
+def test_pedido_com_username_ganha_assinatura_no_id_resolvido(db, bot, novo_pedido, monkeypatch):
+    monkeypatch.setattr(main.entrega_executor, "submit", lambda funcao, entrega_id: None)
+    db.add(database.Lead(user_id="55555", nome="Fulano", username="Fulano", bot_id=bot.id))
+    db.commit()
+    # Checkout web sem id numérico grava o username no telegram_id
+    pedido = novo_pedido(telegram_id="fulano", username="fulano", status="pending",
+                         transaction_id="tx-username-1", payment_ref="tx-username-1")
+
+    assert main.registrar_pagamento(db, "tx-username-1", "paid", "site") == "liquidado"
+    assert _assinatura(db, bot, "fulano") is None
+
+    entrega = db.query(database.Entrega).filter(database.Entrega.pedido_id == pedido.id).one()
+    main.processar_entrega(entrega.id)
+
+    db.expire_all()
+    pedido = db.get(database.Pedido, pedido.id)
+    assert pedido.telegram_id == "55555"
+    assert main.assinatura_ativa(db, bot.id, 55555).source_pedido_id == pedido.id
+    assert _assinatura(db, bot, "fulano") is None
+
+
+def test_start_recupera_venda_e_move_assinatura_legada(db, bot, novo_pedido):
+    validade = datetime.utcnow() + timedelta(days=30)
+    pedido = novo_pedido(telegram_id="ciclano", username="ciclano", custom_expiration=validade)
+    # Linha antiga (backfill) na chave do username
+    db.add(database.Assinatura(bot_id=bot.id, telegram_id="ciclano", expires_at=validade, source_pedido_id=pedido.id))
+    db.commit()
+
+    main.trocar_telegram_id_pedido(db, pedido, "77777")
+    db.commit()
+
+    assert _assinatura(db, bot, "ciclano") is None
+    assinatura = main.assinatura_ativa(db, bot.id, "77777")
+    assert (assinatura.expires_at, assinatura.source_pedido_id) == (validade, pedido.id)
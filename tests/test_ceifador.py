@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import main
+
+
+@pytest.fixture
+def kicks(monkeypatch):
+    # Captura os lotes de kick em vez de chamar o Telegram
+    lotes = []
+    monkeypatch.setattr(main.ceifador_executor, "submit",
+                        lambda funcao, bot_data, vencidos: lotes.append((bot_data.id, [u.id for u in vencidos])))
+    return lotes
+
+
+def _status(db, *pedidos):
+    db.expire_all()
+    return [db.get(database.Pedido, p.id).status for p in pedidos]
+
+
+def test_paid_e_approved_vencidos_sao_expirados_e_removidos(db, novo_pedido, kicks):
+    ontem = datetime.utcnow() - timedelta(days=1)
+    site = novo_pedido(telegram_id="201", status="paid", custom_expiration=ontem)
+    pix = novo_pedido(telegram_id="202", status="approved", custom_expiration=ontem)
+
+    main.ceifar_pedidos([site.id, pix.id])
+
+    assert _status(db, site, pix) == ["expired", "expired"]
+    assert sorted(i for _, ids in kicks for i in ids) == sorted([site.id, pix.id])
+
+
+def test_claim_impede_kick_repetido(db, novo_pedido, kicks):
+    pedido = novo_pedido(telegram_id="203", custom_expiration=datetime.utcnow() - timedelta(minutes=5))
+
+    main.ceifar_pedidos([pedido.id])
+    main.ceifar_pedidos([pedido.id])
+
+    assert [ids for _, ids in kicks] == [[pedido.id]]
+
+
+def test_nao_vencido_e_vitalicio_ficam_intactos(db, novo_pedido, kicks):
+    futuro = novo_pedido(telegram_id="204", custom_expiration=datetime.utcnow() + timedelta(days=2))
+    vitalicio = novo_pedido(telegram_id="205", status="approved", custom_expiration=None)
+    pendente = novo_pedido(telegram_id="206", status="pending", custom_expiration=datetime.utcnow() - timedelta(days=1))
+
+    main.ceifar_pedidos([futuro.id, vitalicio.id, pendente.id])
+
+    assert _status(db, futuro, vitalicio, pendente) == ["paid", "approved", "pending"]
+    assert kicks == []
+
+
+def test_admin_do_bot_nao_e_ceifado(db, bot, novo_pedido, kicks):
+    db.add(database.BotAdmin(bot_id=bot.id, telegram_id="301"))
+    db.commit()
+    ontem = datetime.utcnow() - timedelta(days=1)
+    principal = novo_pedido(telegram_id=bot.admin_principal_id, custom_expiration=ontem)
+    extra = novo_pedido(telegram_id=" 301 ", custom_expiration=ontem)
+
+    main.ceifar_pedidos([principal.id, extra.id])
+
+    assert _status(db, principal, extra) == ["paid", "paid"]
+    assert kicks == []
+
+
+def test_quem_renovou_por_outro_pedido_expira_mas_fica_no_canal(db, bot, novo_pedido, kicks):
+    antigo = novo_pedido(telegram_id="207", custom_expiration=datetime.utcnow() - timedelta(hours=1))
+    renovacao = novo_pedido(telegram_id="207", custom_expiration=datetime.utcnow() + timedelta(days=30))
+    main.conceder_assinatura(db, renovacao, renovacao.custom_expiration)
+    db.commit()
+
+    main.ceifar_pedidos([antigo.id])
+
+    assert _status(db, antigo, renovacao) == ["expired", "paid"]
+    assert kicks == []
+    assert main.assinatura_ativa(db, bot.id, "207") is not None
+
+
+def test_assinatura_vencida_do_pedido_e_encerrada(db, bot, novo_pedido, kicks):
+    pedido = novo_pedido(telegram_id="208", custom_expiration=datetime.utcnow() - timedelta(hours=1))
+    main.conceder_assinatura(db, pedido, pedido.custom_expiration)
+    db.commit()
+
+    main.ceifar_pedidos([pedido.id])
+
+    db.expire_all()
+    assert db.get(database.Assinatura, (bot.id, "208")) is None
+    assert [ids for _, ids in kicks] == [[pedido.id]]
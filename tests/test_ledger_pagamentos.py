@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+
+import database
+import main
+
+
+@pytest.fixture
+def entregas(monkeypatch):
+    # Captura as entregas enfileiradas (nada é enviado de verdade)
+    enfileiradas = []
+    monkeypatch.setattr(main.entrega_executor, "submit", lambda funcao, entrega_id: enfileiradas.append(entrega_id))
+    return enfileiradas
+
+
+def _eventos(db, ref):
+    return db.query(database.PagamentoEvento).filter(database.PagamentoEvento.gateway_ref == ref).all()
+
+
+def test_evento_repetido_nao_duplica_o_ledger(db):
+    evento, novo = main.registrar_evento_pagamento(db, "ref-ledger-1", "pix", "paid", {"id": "REF-LEDGER-1"})
+    db.commit()
+    repetido, novo_de_novo = main.registrar_evento_pagamento(db, "ref-ledger-1", "pix", "paid", {"id": "REF-LEDGER-1"})
+    db.commit()
+
+    assert (novo, novo_de_novo) == (True, False)
+    assert repetido.id == evento.id
+    assert len(_eventos(db, "ref-ledger-1")) == 1
+
+
+def test_retry_do_gateway_liquida_uma_vez_so(db, novo_pedido, entregas):
+    pedido = novo_pedido(status="pending", transaction_id="TX-Retry-1", payment_ref="tx-retry-1")
+
+    assert main.registrar_pagamento(db, " TX-Retry-1 ", "approved", "pix", "paid", {"n": 1}) == "liquidado"
+    # Mesmo id em outra caixa/espaços: mesmo evento
+    assert main.registrar_pagamento(db, "tx-retry-1", "approved", "pix", "paid", {"n": 2}) == "ja_pago"
+
+    db.expire_all()
+    pedido = db.get(database.Pedido, pedido.id)
+    assert pedido.status == "approved"
+    assert pedido.custom_expiration is not None
+    eventos = _eventos(db, "tx-retry-1")
+    assert [(e.resultado, e.pedido_id) for e in eventos] == [("liquidado", pedido.id)]
+    assert len(entregas) == 1
+
+
+def test_evento_sem_pedido_e_reprocessado_quando_o_pedido_aparece(db, novo_pedido, entregas):
+    assert main.registrar_pagamento(db, "tx-cedo-1", "approved", "pix") == "nao_encontrado"
+    assert _eventos(db, "tx-cedo-1")[0].resultado == "nao_encontrado"
+
+    novo_pedido(status="pending", transaction_id="tx-cedo-1", payment_ref="tx-cedo-1")
+    assert main.registrar_pagamento(db, "tx-cedo-1", "approved", "pix") == "liquidado"
+
+    db.expire_all()
+    eventos = _eventos(db, "tx-cedo-1")
+    assert len(eventos) == 1 and eventos[0].resultado == "liquidado"
+    assert len(entregas) == 1
+
+
+def test_ref_vazia_nao_entra_no_ledger(db):
+    assert main.registrar_pagamento(db, "  ", "approved", "pix") == "nao_encontrado"
+    assert main.registrar_pagamento(db, None, "approved", "pix") == "nao_encontrado"
+    assert db.query(database.PagamentoEvento).filter(database.PagamentoEvento.gateway_ref.in_(["", "none"])).count() == 0
+
+
+def test_webhooks_simultaneos_liquidam_uma_vez(novo_pedido, entregas):
+    pedido = novo_pedido(status="pending", transaction_id="tx-corrida-1", payment_ref="tx-corrida-1")
+    resultados, largada = [], threading.Barrier(4)
+
+    def webhook():
+        sessao = database.SessionLocal()
+        try:
+            largada.wait()
+            resultados.append(main.registrar_pagamento(sessao, "tx-corrida-1", "approved", "pix"))
+        finally:
+            sessao.close()
+
+    threads = [threading.Thread(target=webhook) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(resultados) == ["ja_pago"] * 3 + ["liquidado"]
+    assert len(entregas) == 1
+    sessao = database.SessionLocal()
+    try:
+        assert sessao.get(database.Pedido, pedido.id).status == "approved"
+    finally:
+        sessao.close()
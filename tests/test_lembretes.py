@@ -0,0 +1,112 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import main
+
+
+@pytest.fixture
+def novo_pedido(novo_pedido):
+    # Pedido pago bem antes da janela (o caso comum), salvo quando o teste diz quando pagou
+    def criar(*args, **campos):
+        if "pagou_em" not in campos and "data_aprovacao" not in campos:
+            campos["pagou_em"] = datetime.utcnow() - timedelta(days=30)
+        return novo_pedido(*args, **campos)
+    return criar
+
+
+def _reservar(db, tipo="3d", agora=None):
+    agora = agora or datetime.utcnow()
+    antecedencia = dict(main.LEMBRETES_JANELAS)
+    inicio = agora + (antecedencia["1d"] if tipo == "3d" else timedelta(0))
+    return main._reservar_lembretes(db, tipo, inicio, agora + antecedencia[tipo], agora)
+
+
+def _ids(reservados, *pedidos):
+    # A reserva é global: olha só para os pedidos do teste
+    alvo = {p.id for p in pedidos}
+    return sorted(p.id for _, p in reservados if p.id in alvo)
+
+
+def test_paid_e_approved_na_janela_sao_reservados_uma_vez(db, novo_pedido):
+    daqui_2_dias = datetime.utcnow() + timedelta(days=2)
+    site = novo_pedido(telegram_id="401", status="paid", custom_expiration=daqui_2_dias)
+    pix = novo_pedido(telegram_id="402", status="approved", custom_expiration=daqui_2_dias)
+
+    assert _ids(_reservar(db), site, pix) == sorted([site.id, pix.id])
+    assert _ids(_reservar(db), site, pix) == []
+    assert db.query(database.LembreteRenovacao).filter(
+        database.LembreteRenovacao.pedido_id.in_([site.id, pix.id])
+    ).count() == 2
+
+
+def test_fora_da_janela_ou_nao_pago_fica_de_fora(db, novo_pedido):
+    agora = datetime.utcnow()
+    longe = novo_pedido(telegram_id="403", custom_expiration=agora + timedelta(days=10))
+    ultimo_dia = novo_pedido(telegram_id="404", custom_expiration=agora + timedelta(hours=12))
+    vencido = novo_pedido(telegram_id="405", custom_expiration=agora - timedelta(hours=1))
+    pendente = novo_pedido(telegram_id="406", status="pending", custom_expiration=agora + timedelta(days=2))
+
+    assert _ids(_reservar(db, "3d", agora), longe, ultimo_dia, vencido, pendente) == []
+    # O último dia é da janela '1d'
+    assert _ids(_reservar(db, "1d", agora), longe, ultimo_dia, vencido, pendente) == [ultimo_dia.id]
+
+
+def test_quem_ja_renovou_nao_recebe_lembrete(db, novo_pedido):
+    agora = datetime.utcnow()
+    atual = novo_pedido(telegram_id="407", custom_expiration=agora + timedelta(days=2))
+    renovacao = novo_pedido(telegram_id="407", status="approved", custom_expiration=agora + timedelta(days=32))
+    vitalicio_de = novo_pedido(telegram_id="408", custom_expiration=agora + timedelta(days=2))
+    vitalicio = novo_pedido(telegram_id="408", custom_expiration=None)
+
+    assert _ids(_reservar(db, "3d", agora), atual, renovacao, vitalicio_de, vitalicio) == []
+
+
+def test_novo_vencimento_do_mesmo_pedido_ganha_novo_lembrete(db, novo_pedido):
+    agora = datetime.utcnow()
+    pedido = novo_pedido(telegram_id="409", custom_expiration=agora + timedelta(days=2))
+    assert _ids(_reservar(db, "3d", agora), pedido) == [pedido.id]
+
+    # Editado no painel para outra data, ainda na janela
+    pedido.custom_expiration = agora + timedelta(days=2, hours=6)
+    db.commit()
+    assert _ids(_reservar(db, "3d", agora), pedido) == [pedido.id]
+
+
+def test_reservas_simultaneas_nao_duplicam(novo_pedido):
+    agora = datetime.utcnow()
+    pedidos = [novo_pedido(telegram_id=str(500 + i), custom_expiration=agora + timedelta(days=2)) for i in range(20)]
+    resultados, largada = [], threading.Barrier(3)
+
+    def varredura():
+        sessao = database.SessionLocal()
+        try:
+            largada.wait()
+            resultados.extend(_ids(_reservar(sessao, "3d", agora), *pedidos))
+        finally:
+            sessao.close()
+
+    threads = [threading.Thread(target=varredura) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(resultados) == sorted(p.id for p in pedidos)
+
+
+def test_quem_acabou_de_pagar_plano_curto_nao_recebe_lembrete(db, novo_pedido):
+    agora = datetime.utcnow()
+    diario = novo_pedido(telegram_id="410", plano_nome="Diario", pagou_em=agora, custom_expiration=agora + timedelta(days=1))
+    de_3_dias = novo_pedido(telegram_id="411", status="approved", data_aprovacao=agora,
+                            custom_expiration=agora + timedelta(days=3))
+    # Mesmo vencimento, mas pago há 10 dias: esse sim recebe
+    antigo = novo_pedido(telegram_id="412", pagou_em=agora - timedelta(days=10), custom_expiration=agora + timedelta(days=3))
+
+    assert _ids(_reservar(db, "1d", agora), diario, de_3_dias, antigo) == []
+    assert _ids(_reservar(db, "3d", agora), diario, de_3_dias, antigo) == [antigo.id]
+
+    # Dois dias depois o plano de 3 dias entra na janela de 1 dia normalmente
+    assert _ids(_reservar(db, "1d", agora + timedelta(days=2, minutes=1)), diario, de_3_dias, antigo) == [de_3_dias.id, antigo.id]
@@ -0,0 +1,40 @@
+import threading
+
+import main
+
+
+def test_mesma_midia_usa_a_mesma_trava():
+    registro = main.MediaRegistry(ttl=60)
+    url = "https://exemplo.com/video.mp4"
+    assert registro.trava(1, url) is registro.trava(1, url)
+
+
+def test_travas_nao_crescem_com_urls_novas():
+    registro = main.MediaRegistry(ttl=60)
+    travas = {id(registro.trava(1, f"https://exemplo.com/campanha-{i}.jpg")) for i in range(5000)}
+    assert len(travas) <= len(registro._travas)
+
+
+def test_upload_unico_por_url_em_disparo_simultaneo(bot, monkeypatch):
+    registro = main.MediaRegistry(ttl=60)
+    monkeypatch.setattr(main, "media_registry", registro)
+    uploads, largada = [], threading.Barrier(8)
+
+    class Cliente:
+        def send_photo(self, chat_id, foto, **kwargs):
+            if foto.startswith("http"):
+                uploads.append(chat_id)
+                return type("Msg", (), {"photo": [type("Foto", (), {"file_id": "FOTO-1"})()]})()
+            return None
+
+    def enviar(chat_id):
+        largada.wait()
+        main.enviar_midia(Cliente(), bot.id, chat_id, f"https://exemplo.com/banner-{bot.id}.jpg")
+
+    threads = [threading.Thread(target=enviar, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(uploads) == 1
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+import database
+import migrate
+
+
+@pytest.fixture
+def banco_vazio(tmp_path, monkeypatch):
+    """Engine própria num arquivo novo (o banco da sessão de testes fica intacto)."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'migracao.db'}")
+    monkeypatch.setattr(migrate, "engine", engine)
+    yield engine
+    engine.dispose()
+
+
+def test_versoes_em_ordem_e_sem_repeticao():
+    versoes = [versao for versao, _, _ in migrate.MIGRACOES]
+    assert versoes == sorted(set(versoes))
+    assert migrate.VERSAO_ATUAL == versoes[-1]
+
+
+def test_banco_da_sessao_esta_na_versao_atual():
+    with database.engine.connect() as conn:
+        assert migrate.versao_do_banco(conn) == migrate.VERSAO_ATUAL
+        tabelas = set(inspect(conn).get_table_names())
+    assert set(database.Base.metadata.tables) <= tabelas
+
+
+def test_banco_novo_migra_tudo_e_rodar_de_novo_nao_faz_nada(banco_vazio):
+    assert migrate.migrar() == migrate.VERSAO_ATUAL
+    assert migrate.migrar() == migrate.VERSAO_ATUAL
+
+    with banco_vazio.connect() as conn:
+        aplicadas = conn.execute(text("SELECT versao FROM schema_version ORDER BY versao")).scalars().all()
+        insp = inspect(conn)
+        indices_pedidos = {i["name"] for i in insp.get_indexes("pedidos")}
+    assert aplicadas == [versao for versao, _, _ in migrate.MIGRACOES]
+    assert {"uq_pedidos_payment_ref", "ix_pedidos_ativos_vencimento"} <= indices_pedidos
+    assert "ix_pedidos_pagos_vencimento" not in indices_pedidos
+
+
+def test_status_sem_migracao_e_versao_zero(banco_vazio):
+    with banco_vazio.connect() as conn:
+        assert migrate.versao_do_banco(conn) == 0
+
+
+def test_banco_legado_ganha_colunas_payment_ref_e_assinaturas(banco_vazio):
+    criado = datetime(2025, 1, 10)
+    with banco_vazio.begin() as conn:
+        # Esquema de antes do reparo de startup: pedidos sem as colunas novas
+        conn.execute(text("CREATE TABLE bots (id INTEGER PRIMARY KEY, nome VARCHAR, token VARCHAR, id_canal_vip VARCHAR)"))
+        conn.execute(text("""
+            CREATE TABLE pedidos (
+                id INTEGER PRIMARY KEY, bot_id INTEGER, telegram_id VARCHAR, first_name VARCHAR,
+                valor FLOAT, status VARCHAR, created_at TIMESTAMP, txid VARCHAR, plano_nome VARCHAR
+            )
+        """))
+        conn.execute(text("INSERT INTO bots (id, nome, token, id_canal_vip) VALUES (1, 'Legado', '1:x', '-1')"))
+        conn.execute(text("""
+            INSERT INTO pedidos (id, bot_id, telegram_id, status, created_at, txid, plano_nome) VALUES
+                (1, 1, '555', 'paid', :criado, ' ABC-1 ', 'Semanal'),
+                (2, 1, '556', 'pending', :criado, 'abc-1', 'Semanal'),
+                (3, 1, '557', 'approved', :criado, 'XYZ', 'Vitalício')
+        """), {"criado": criado})
+
+    assert migrate.migrar() == migrate.VERSAO_ATUAL
+
+    with banco_vazio.connect() as conn:
+        refs = dict(conn.execute(text("SELECT id, payment_ref FROM pedidos")).all())
+        assinaturas = {
+            linha.telegram_id: linha for linha in
+            conn.execute(text("SELECT telegram_id, expires_at, source_pedido_id FROM subscriptions")).all()
+        }
+    # Normalizado; a ref repetida fica só no pedido mais antigo
+    assert refs == {1: "abc-1", 2: None, 3: "xyz"}
+    # Só os pagos viram assinatura, com a validade pelo nome do plano
+    assert set(assinaturas) == {"555", "557"}
+    assert assinaturas["555"].source_pedido_id == 1
+    assert str(assinaturas["555"].expires_at).startswith(str((criado + timedelta(days=7)).date()))
+    assert assinaturas["557"].expires_at is None
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import database
+import main
+
+client = TestClient(main.app)
+
+
+def _percorrer(url, chave="data"):
+    """Segue o next_cursor até o fim e devolve os ids na ordem entregue."""
+    ids, cursor, paginas = [], None, 0
+    while True:
+        resposta = client.get(url + (f"&cursor={cursor}" if cursor else ""))
+        assert resposta.status_code == 200, resposta.text
+        corpo = resposta.json()
+        ids += [linha["id"] for linha in corpo[chave]]
+        cursor, paginas = corpo.get("next_cursor"), paginas + 1
+        if not cursor:
+            return ids, paginas
+
+
+def test_leads_com_created_at_empatado_nao_repetem_nem_somem(db, bot):
+    mesmo_instante = datetime(2025, 3, 1, 12, 0)
+    db.add_all([
+        database.Lead(user_id=str(1000 + i), nome=f"Lead {i}", bot_id=bot.id,
+                      created_at=mesmo_instante if i % 2 else mesmo_instante - timedelta(minutes=i))
+        for i in range(25)
+    ])
+    db.commit()
+
+    ids, paginas = _percorrer(f"/api/admin/leads?bot_id={bot.id}&per_page=10")
+    esperado = [l.id for l in db.query(database.Lead).filter(database.Lead.bot_id == bot.id)
+                .order_by(database.Lead.created_at.desc(), database.Lead.id.desc())]
+    assert ids == esperado
+    assert paginas == 3
+
+
+def test_sem_cursor_page_continua_usando_offset(db, bot):
+    db.add_all([database.Lead(user_id=str(i), bot_id=bot.id, created_at=datetime(2025, 1, 1) + timedelta(hours=i))
+                for i in range(7)])
+    db.commit()
+
+    pagina_2 = client.get(f"/api/admin/leads?bot_id={bot.id}&per_page=3&page=2").json()
+    por_cursor, _ = _percorrer(f"/api/admin/leads?bot_id={bot.id}&per_page=3")
+    assert [l["id"] for l in pagina_2["data"]] == por_cursor[3:6]
+
+
+def test_cursor_invalido_responde_400(bot):
+    assert client.get(f"/api/admin/leads?bot_id={bot.id}&cursor=lixo").status_code == 400
+
+
+@pytest.mark.parametrize("rota", [
+    "/api/admin/bots/{bot_id}/remarketing/history?limit=4",
+    "/api/admin/remarketing/history/{bot_id}?per_page=4",
+])
+def test_historico_remarketing_com_data_envio_nula(db, bot, rota):
+    campanhas = [
+        database.RemarketingCampaign(bot_id=bot.id, campaign_id=f"c-{bot.id}-{i}-{rota[-1]}",
+                                     data_envio=datetime(2025, 1, 1) + timedelta(days=i))
+        for i in range(9)
+    ]
+    db.add_all(campanhas)
+    db.commit()
+    # Campanhas legadas sem data de envio
+    for c in campanhas[::3]:
+        c.data_envio = None
+    db.commit()
+
+    ids, _ = _percorrer(rota.format(bot_id=bot.id))
+    assert sorted(ids) == sorted(c.id for c in campanhas)
+    assert len(ids) == len(set(ids))
+    # As sem data ficam no fim (mais antigas), as datadas em ordem decrescente
+    nulas = {c.id for c in campanhas[::3]}
+    assert set(ids[-len(nulas):]) == nulas
@@ -0,0 +1,70 @@
+import json
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import main
+
+
+@pytest.fixture
+def campanha(db, bot):
+    registro = database.RemarketingCampaign(
+        bot_id=bot.id, campaign_id=f"retomada-{bot.id}", status="enviando",
+        config=json.dumps({"motor": main.MOTOR_REMARKETING_VERSAO,
+                           "payload": {"bot_id": bot.id, "mensagem": "Oferta!"}}),
+        sent_success=0, blocked_count=0,
+    )
+    db.add(registro)
+    db.commit()
+    return registro
+
+
+def _envios(db, campanha, quantidade, inicio=70000, **campos):
+    envios = [database.RemarketingEnvio(campaign_id=campanha.id, telegram_id=str(inicio + i), **campos)
+              for i in range(quantidade)]
+    db.add_all(envios)
+    db.commit()
+    return envios
+
+
+def _situacao(db, campanha):
+    db.expire_all()
+    status = [s for (s,) in db.query(database.RemarketingEnvio.status)
+              .filter(database.RemarketingEnvio.campaign_id == campanha.id)]
+    return db.get(database.RemarketingCampaign, campanha.id).status, sorted(set(status))
+
+
+def test_lote_abandonado_por_worker_morto_e_reenviado(db, campanha):
+    # Deploy rápido: o processo anterior reservou o lote há 11 min e morreu
+    reservado = datetime.utcnow() - timedelta(minutes=main.REMARKETING_RESERVA_MINUTOS + 1)
+    _envios(db, campanha, 5, status="processando", lote="morto", reservado_em=reservado)
+    _envios(db, campanha, 3, inicio=80000, status="pendente")
+
+    main.executar_campanha_remarketing(campanha.id)
+
+    assert _situacao(db, campanha) == ("concluido", ["enviado"])
+    assert db.get(database.RemarketingCampaign, campanha.id).sent_success == 8
+
+
+def test_espera_lote_de_outro_processo_antes_de_concluir(db, campanha, monkeypatch):
+    monkeypatch.setattr(main, "REMARKETING_ESPERA_SEGUNDOS", 0.05)
+    alheios = _envios(db, campanha, 2, status="processando", lote="vivo", reservado_em=datetime.utcnow())
+
+    disparo = threading.Thread(target=main.executar_campanha_remarketing, args=(campanha.id,))
+    disparo.start()
+    disparo.join(0.5)
+    # Reserva recente de outro processo: não reenvia nem conclui
+    assert disparo.is_alive()
+    assert _situacao(db, campanha) == ("enviando", ["processando"])
+
+    # O outro processo grava o lote dele
+    main._gravar_lote(db, campanha.id, [(e.id, ("enviado", None)) for e in alheios])
+    disparo.join(5)
+    assert not disparo.is_alive()
+    assert _situacao(db, campanha) == ("concluido", ["enviado"])
+
+
+def test_retomada_roda_so_no_lider_dos_jobs():
+    assert main.coordenador_jobs._jobs.get("remarketing-retomada") is main.retomar_campanhas_remarketing
@@ -0,0 +1,97 @@
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import main
+
+
+def _erro_429(retry_after):
+    return ApiTelegramException("sendMessage", None, {
+        "ok": False, "error_code": 429, "description": "Too Many Requests",
+        "parameters": {"retry_after": retry_after},
+    })
+
+
+@pytest.fixture
+def esperas(monkeypatch):
+    # Registra os sleeps do dispatcher em vez de dormir de verdade
+    registro = []
+    monkeypatch.setattr(main.time, "sleep", registro.append)
+    return registro
+
+
+def test_token_bucket_libera_capacidade_e_depois_cobra_a_taxa():
+    bucket = main.TokenBucket(taxa=1.0, capacidade=3)
+    inicio = bucket.atualizado
+    assert [bucket.reservar(inicio) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reservar(inicio) == pytest.approx(1.0)
+    assert bucket.reservar(inicio) == pytest.approx(2.0)
+    # Depois de 2s os dois tokens devidos foram repostos: próximo espera 1s
+    assert bucket.reservar(inicio + 2) == pytest.approx(1.0)
+
+
+def test_token_bucket_ocioso_quando_reabastecido():
+    bucket = main.TokenBucket(taxa=1.0, capacidade=2)
+    inicio = bucket.atualizado
+    bucket.reservar(inicio)
+    assert not bucket.ocioso(inicio)
+    assert bucket.ocioso(inicio + 1)
+
+
+def test_rajada_no_mesmo_chat_espera_pelo_limite_do_chat(esperas):
+    dispatcher = main.TelegramDispatcher()
+    for _ in range(4):
+        dispatcher.executar("1:abc", 42, lambda: "ok")
+    # 3 de rajada; o 4º espera ~1/TG_LIMITE_CHAT_POR_SEG
+    assert len(esperas) == 1
+    assert esperas[0] == pytest.approx(1 / main.TG_LIMITE_CHAT_POR_SEG, abs=0.05)
+    assert dispatcher.estatisticas()["bots"]["1"]["enviados"] == 4
+
+
+def test_chats_diferentes_nao_se_bloqueiam(esperas):
+    dispatcher = main.TelegramDispatcher()
+    for chat_id in range(10):
+        dispatcher.executar("1:abc", chat_id, lambda: "ok")
+    assert esperas == []
+
+
+def test_429_pausa_o_bot_pelo_retry_after_e_tenta_de_novo(esperas):
+    dispatcher = main.TelegramDispatcher()
+    respostas = iter([_erro_429(5), "ok"])
+
+    def chamada():
+        resposta = next(respostas)
+        if isinstance(resposta, Exception):
+            raise resposta
+        return resposta
+
+    assert dispatcher.executar("2:abc", 7, chamada) == "ok"
+    assert esperas and esperas[-1] == pytest.approx(5, abs=0.1)
+    bot = dispatcher.estatisticas()["bots"]["2"]
+    assert bot["erros_429"] == 1
+    assert bot["enviados"] == 1
+
+
+def test_429_repetido_desiste_depois_do_maximo_de_tentativas(esperas):
+    dispatcher = main.TelegramDispatcher()
+    chamadas = []
+
+    def chamada():
+        chamadas.append(1)
+        raise _erro_429(1)
+
+    with pytest.raises(ApiTelegramException):
+        dispatcher.executar("3:abc", None, chamada)
+    assert len(chamadas) == main.TG_MAX_TENTATIVAS_429 + 1
+
+
+def test_outros_erros_do_telegram_nao_sao_repetidos(esperas):
+    dispatcher = main.TelegramDispatcher()
+    chamadas = []
+
+    def chamada():
+        chamadas.append(1)
+        raise ApiTelegramException("sendMessage", None, {"ok": False, "error_code": 403, "description": "Forbidden"})
+
+    with pytest.raises(ApiTelegramException):
+        dispatcher.executar("4:abc", 9, chamada)
+    assert len(chamadas) == 1
@@ -0,0 +1,164 @@
+# =========================================================
+# 🔎 VERIFICAÇÃO DOS ÍNDICES (EXPLAIN SOBRE BASE SEMEADA)
+# =========================================================
+# Cria um banco descartável, semeia pedidos/leads em volume realista,
+# roda EXPLAIN nas consultas quentes e confere se cada uma usa o índice
+# esperado (declarados em database.py, criados pelas versões 7, 10, 13 e 14 do migrate.py).
+#
+# Uso:
+#   python verificar_indices.py                      (SQLite temporário)
+#   python verificar_indices.py --url postgresql://.../banco_descartavel
+#   python verificar_indices.py --pedidos 200000 --bots 50 --mostrar-plano
+#
+# ATENÇÃO: --url recria as tabelas do zero. Nunca aponte para produção.
+
+import os
+import sys
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select, text
+
+from database import Base, Bot, Pedido, Lead, Assinatura
+
+STATUS_POSSIVEIS = ["pending"] * 5 + ["paid"] * 3 + ["expired", "approved"]
+
+def semear(engine, total_bots, total_pedidos, total_leads):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    agora = datetime.utcnow()
+    rnd = random.Random(42)
+
+    with engine.begin() as conn:
+        conn.execute(Bot.__table__.insert(), [
+            {"id": i, "nome": f"Bot {i}", "token": f"{800000000 + i}:verificacao", "status": "ativo"}
+            for i in range(1, total_bots + 1)
+        ])
+        lote, assinaturas = [], {}
+        for i in range(1, total_pedidos + 1):
+            status = rnd.choice(STATUS_POSSIVEIS)
+            lote.append({
+                "id": i,
+                "bot_id": rnd.randint(1, total_bots),
+                "telegram_id": str(100000 + rnd.randint(0, total_pedidos // 3)),
+                "valor": 19.9,
+                "status": status,
+                "txid": f"tx-{i}",
+                "transaction_id": f"TX-{i}",
+                "payment_ref": f"tx-{i}",
+                "created_at": agora - timedelta(minutes=rnd.randint(0, 60 * 24 * 90)),
+                "custom_expiration": (agora + timedelta(days=rnd.randint(-30, 30))) if status in ("paid", "approved") and rnd.random() < 0.7 else None,
+            })
+            if status in ("paid", "approved"):
+                assinaturas[(lote[-1]["bot_id"], lote[-1]["telegram_id"])] = {
+                    "bot_id": lote[-1]["bot_id"], "telegram_id": lote[-1]["telegram_id"],
+                    "expires_at": lote[-1]["custom_expiration"], "source_pedido_id": i,
+                }
+            if len(lote) >= 5000:
+                conn.execute(Pedido.__table__.insert(), lote)
+                lote = []
+        if lote:
+            conn.execute(Pedido.__table__.insert(), lote)
+        if assinaturas:
+            conn.execute(Assinatura.__table__.insert(), list(assinaturas.values()))
+
+        lote = []
+        for i in range(1, total_leads + 1):
+            lote.append({
+                "id": i,
+                "user_id": str(100000 + rnd.randint(0, total_leads)),
+                "bot_id": rnd.randint(1, total_bots),
+                "created_at": agora - timedelta(minutes=rnd.randint(0, 60 * 24 * 90)),
+            })
+            if len(lote) >= 5000:
+                conn.execute(Lead.__table__.insert(), lote)
+                lote = []
+        if lote:
+            conn.execute(Lead.__table__.insert(), lote)
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE"))
+
+def consultas_quentes():
+    """(descrição, consulta, índices aceitos)"""
+    agora = datetime.utcnow()
+    return [
+        ("Porteiro / status / reenvio (assinatura pela PK)",
+         select(Assinatura.expires_at).where(Assinatura.bot_id == 3, Assinatura.telegram_id == "100123"),
+         {"sqlite_autoindex_subscriptions_1", "subscriptions_pkey"}),
+        ("Pedidos pagos do usuário (bot + usuário + status)",
+         select(Pedido.id).where(Pedido.bot_id == 3, Pedido.telegram_id == "100123", Pedido.status.in_(["paid", "approved"]))
+         .order_by(Pedido.created_at.desc()).limit(1),
+         {"ix_pedidos_bot_telegram_status_criado"}),
+        ("Recuperação do /start (último pedido do usuário)",
+         select(Pedido.id).where(Pedido.bot_id == 3, Pedido.telegram_id == "100123")
+         .order_by(Pedido.created_at.desc()).limit(1),
+         {"ix_pedidos_bot_telegram_status_criado"}),
+        ("Lead do usuário",
+         select(Lead.id).where(Lead.user_id == "100123", Lead.bot_id == 3),
+         {"ix_leads_user_bot"}),
+        ("Webhook de pagamento (payment_ref)",
+         select(Pedido.id).where(Pedido.payment_ref == "tx-77"),
+         {"uq_pedidos_payment_ref"}),
+        ("Pendentes do bot (funil meio)",
+         select(Pedido.id).where(Pedido.bot_id == 3, Pedido.status == "pending")
+         .order_by(Pedido.created_at.desc()).limit(50),
+         {"ix_pedidos_pendentes"}),
+        ("Lembretes de renovação (faixa de vencimento)",
+         select(Pedido.id).where(Pedido.status.in_(["paid", "approved"]),
+                                 Pedido.custom_expiration.isnot(None),
+                                 Pedido.custom_expiration > agora, Pedido.custom_expiration <= agora + timedelta(days=3)),
+         {"ix_pedidos_ativos_vencimento"}),
+        ("Ceifador (recarga por faixa de vencimento)",
+         select(Assinatura.source_pedido_id, Assinatura.expires_at)
+         .where(Assinatura.expires_at.isnot(None), Assinatura.expires_at <= agora + timedelta(hours=6)),
+         {"ix_subscriptions_expires_at"}),
+        ("Lista de contatos (keyset)",
+         select(Pedido.id).where(Pedido.bot_id == 3)
+         .order_by(Pedido.created_at.desc(), Pedido.id.desc()).limit(50),
+         {"ix_pedidos_bot_criado"}),
+        ("Lista de leads (keyset)",
+         select(Lead.id).where(Lead.bot_id == 3)
+         .order_by(Lead.created_at.desc(), Lead.id.desc()).limit(50),
+         {"ix_leads_bot_criado"}),
+    ]
+
+def explicar(conn, dialeto, consulta):
+    sql = str(consulta.compile(dialect=dialeto, compile_kwargs={"literal_binds": True}))
+    prefixo = "EXPLAIN " if dialeto.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    linhas = conn.execute(text(prefixo + sql)).all()
+    return "\n".join(str(l[-1]) for l in linhas)
+
+def verificar(engine, mostrar_plano=False):
+    falhas = 0
+    with engine.connect() as conn:
+        for descricao, consulta, aceitos in consultas_quentes():
+            plano = explicar(conn, engine.dialect, consulta)
+            usado = [nome for nome in aceitos if nome in plano]
+            ok = bool(usado)
+            falhas += 0 if ok else 1
+            print(f"{'✅' if ok else '❌'} {descricao}: {usado[0] if usado else 'sem índice esperado'}")
+            if mostrar_plano or not ok:
+                print("   " + plano.replace("\n", "\n   "))
+    return falhas
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Confere via EXPLAIN se as consultas quentes usam os índices")
+    parser.add_argument("--url", default=None, help="Banco DESCARTÁVEL (padrão: SQLite temporário)")
+    parser.add_argument("--bots", type=int, default=20)
+    parser.add_argument("--pedidos", type=int, default=50000)
+    parser.add_argument("--leads", type=int, default=50000)
+    parser.add_argument("--mostrar-plano", action="store_true")
+    args = parser.parse_args()
+
+    url = args.url or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "verificar_indices.db")
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    engine = create_engine(url)
+
+    print(f"🌱 Semeando {args.pedidos} pedidos e {args.leads} leads em {engine.dialect.name}...")
+    semear(engine, args.bots, args.pedidos, args.leads)
+    falhas = verificar(engine, args.mostrar_plano)
+    print(f"\n{'✅ Todos os caminhos quentes usam índice.' if not falhas else f'❌ {falhas} consulta(s) sem o índice esperado.'}")
+    sys.exit(1 if falhas else 0)